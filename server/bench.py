@@ -0,0 +1,511 @@
+"""Timing comparisons on the sample files in uploads/.
+
+Usage:
+    python bench.py headers [--repeat N] [files...]
+    python bench.py projection [--repeat N] [files...]
+    python bench.py backends [--repeat N] [--backend NAME ...] [files...]
+    python bench.py cache [--repeat N] [files...]
+    python bench.py reconcile [--repeat N] [--employees N ...] [--loop-max N]
+    python bench.py presence [--repeat N] [--employees N ...] [--loop-max N]
+    python bench.py rules [--repeat N] [--employees N ...] [--extra N]
+    python bench.py json [--repeat N] [--company NAME] [pointage paie]
+    python bench.py stream [--employees N ...]
+    python bench.py suite [--repeat N] [--company NAME ...] [--threshold PCT] [--history FILE] [--warm]
+
+suite is the end-to-end suite of bench_suite.py, with its baseline history
+and regression threshold.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import bench_suite
+import frame_cache
+import ingest
+import readers
+import reconcile
+import responses
+import rules
+
+UPLOAD_FOLDER = 'uploads'
+
+# Header terms used by the /upload services, tried in order on each file.
+HEADER_TERMS = [
+    ["CIN", "NORMAL"],
+    ["NCIN", "JRS/HRS"],
+    ["NCIN", "COLUMN_1"],
+    ["NCIN", "COLUMN_2"],
+    ["NCIN"],
+]
+
+# Largest fixture: the scif April month, 1123 employees.
+JSON_FIXTURE = ("scif", "Pointage_GRH_-_Avril_2025.xlsx", "JournalPaieExport_SCIF_SUD_04-25_1_glbl.xlsx")
+
+# Commit whose cobco.compare_files still reconciled row by row: the loop
+# the reconcile benchmark times the rule profile against.
+ROW_BY_ROW_COMMIT = "20766d8"
+
+# Columns read by the projection benchmark: the union of the keywords the
+# /upload services keep.
+PROJECTED_COLUMNS = [
+    "CIN", "NORMAL", "TAUX", "JRS", "HRS", "SALAIRE", "FERIE", "FÉRIÉ", "25%", "HS 25", "HS 50",
+    "TRANSP", "ACOMPTE", "NET", "AMO", "CNSS", "EMBAUCHE",
+]
+
+
+def sample_files(names=None):
+    if names:
+        return names
+    return sorted(
+        os.path.join(UPLOAD_FOLDER, name) for name in os.listdir(UPLOAD_FOLDER)
+        if ingest.is_excel(name) or ingest.is_csv(name)
+    )
+
+
+def header_terms_for(file_path):
+    """Pick the first set of header terms found in the file, or None."""
+    if ingest.is_excel(file_path):
+        head = pd.read_excel(file_path, header=None, nrows=ingest.HEADER_SCAN_ROWS, dtype=object)
+    else:
+        head = pd.read_csv(file_path, header=None, nrows=ingest.HEADER_SCAN_ROWS, dtype=str, **ingest.CSV_OPTIONS)
+    for terms in HEADER_TERMS:
+        if ingest.find_header_row(head.itertuples(index=False, name=None), terms) is not None:
+            return terms
+    return None
+
+
+def two_pass_read_file_with_header(file_path, header_terms):
+    """Header detection as the services did it before ingest.py: one full
+    parse with header=None to locate the header, then a second parse."""
+    if ingest.is_excel(file_path):
+        df = pd.read_excel(file_path, header=None)
+    else:
+        df = pd.read_csv(file_path, header=None, low_memory=False, **ingest.CSV_OPTIONS)
+    df = df.map(lambda x: str(x).upper().strip() if pd.notna(x) else "")
+    header_row = None
+    for idx, row in df.iterrows():
+        row_values = ' '.join(row.values.astype(str))
+        if all(term.upper() in row_values for term in header_terms):
+            header_row = idx
+            break
+    if header_row is None:
+        raise ValueError(f"Could not find header row containing: {header_terms}")
+    if ingest.is_excel(file_path):
+        df = pd.read_excel(file_path, header=header_row)
+    else:
+        df = pd.read_csv(file_path, header=header_row, low_memory=False, **ingest.CSV_OPTIONS)
+    return ingest.clean_columns(df)
+
+
+def best_of(repeat, func, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_headers(files, repeat):
+    print(f"{'file':<60} {'rows':>6} {'two-pass':>10} {'single':>10} {'speedup':>8}")
+    total_old = total_new = 0.0
+    for file_path in files:
+        terms = header_terms_for(file_path)
+        if terms is None:
+            print(f"{os.path.basename(file_path):<60} {'no header':>6}")
+            continue
+        old_time, old_df = best_of(repeat, two_pass_read_file_with_header, file_path, terms)
+        new_time, new_df = best_of(repeat, ingest.parse_file_with_header, file_path, terms)
+        pd.testing.assert_frame_equal(old_df, new_df)
+        total_old += old_time
+        total_new += new_time
+        print(f"{os.path.basename(file_path):<60} {len(new_df):>6} "
+              f"{old_time:>9.3f}s {new_time:>9.3f}s {old_time / new_time:>7.2f}x")
+    if total_new:
+        print(f"{'total':<60} {'':>6} {total_old:>9.3f}s {total_new:>9.3f}s {total_old / total_new:>7.2f}x")
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    try:
+        result = func(*args)
+        return tracemalloc.get_traced_memory()[1], result
+    finally:
+        tracemalloc.stop()
+
+
+def bench_projection(files, repeat):
+    print(f"{'file':<60} {'cols':>9} {'full':>9} {'stream':>9} {'speedup':>8} {'full MB':>8} {'stream MB':>9}")
+    for file_path in files:
+        if not ingest.is_xlsx(file_path):
+            continue
+        terms = header_terms_for(file_path)
+        if terms is None:
+            continue
+        full_time, full_df = best_of(repeat, ingest.parse_file_with_header, file_path, terms)
+        stream_time, stream_df = best_of(repeat, ingest.parse_file_with_header, file_path, terms, PROJECTED_COLUMNS)
+        pd.testing.assert_frame_equal(full_df[stream_df.columns], stream_df)
+        full_peak, _ = peak_memory(ingest.parse_file_with_header, file_path, terms)
+        stream_peak, _ = peak_memory(ingest.parse_file_with_header, file_path, terms, PROJECTED_COLUMNS)
+        print(f"{os.path.basename(file_path):<60} {len(stream_df.columns):>4}/{len(full_df.columns):<4} "
+              f"{full_time:>8.3f}s {stream_time:>8.3f}s {full_time / stream_time:>7.2f}x "
+              f"{full_peak / 2**20:>8.1f} {stream_peak / 2**20:>9.1f}")
+
+
+def bench_backends(files, repeat, backends):
+    """Time each Excel reader backend on full and projected reads; frames
+    are checked against those of the first backend listed."""
+    backends = backends or readers.available_backends()
+    print(f"available: {', '.join(readers.available_backends())}; "
+          f"default: {readers.excel_backend().name}")
+    print(f"{'file':<60} {'backend':<10} {'full':>9} {'projected':>10} {'same':>5}")
+    totals = dict.fromkeys(backends, 0.0)
+    for file_path in files:
+        if not ingest.is_excel(file_path):
+            continue
+        terms = header_terms_for(file_path)
+        if terms is None:
+            continue
+        reference = None
+        for name in backends:
+            full_time, full_df = best_of(repeat, ingest.parse_file_with_header, file_path, terms, None, name)
+            projected_time, projected_df = best_of(
+                repeat, ingest.parse_file_with_header, file_path, terms, PROJECTED_COLUMNS, name)
+            if reference is None:
+                reference = (full_df, projected_df)
+            same = reference[0].equals(full_df) and reference[1].equals(projected_df)
+            totals[name] += full_time + projected_time
+            print(f"{os.path.basename(file_path):<60} {name:<10} "
+                  f"{full_time:>8.3f}s {projected_time:>9.3f}s {'yes' if same else 'NO':>5}")
+    for name, total in totals.items():
+        print(f"{'total':<60} {name:<10} {total:>8.3f}s")
+
+
+def bench_cache(files, repeat):
+    """Parse each file into an empty frame cache, then load it back."""
+    print(f"{'file':<60} {'parse':>9} {'cached':>9} {'speedup':>8} {'KB':>7}")
+    with tempfile.TemporaryDirectory() as folder:
+        cache = frame_cache.FrameCache(folder)
+        ingest.frames = cache
+        try:
+            for file_path in files:
+                terms = header_terms_for(file_path)
+                if terms is None:
+                    continue
+                key = ingest.cache_key(file_path, terms)
+                parse_time, parsed = best_of(repeat, ingest.parse_file_with_header, file_path, terms)
+                cache.put(key, parsed)
+                load_time, loaded = best_of(repeat, ingest.read_file_with_header, file_path, terms)
+                pd.testing.assert_frame_equal(parsed, loaded)
+                size = os.path.getsize(cache._path(key))
+                print(f"{os.path.basename(file_path):<60} {parse_time:>8.3f}s {load_time:>8.3f}s "
+                      f"{parse_time / load_time:>7.1f}x {size / 1024:>7.0f}")
+        finally:
+            ingest.frames = frame_cache.frames
+        print(cache.stats())
+
+
+def synthetic_sides(employees, seed=0):
+    """Paie and grouped pointage frames shaped like cobco's compare_files
+    for `employees` CINs: about 5% only in the pointage, 5% only in the
+    paie, 20% with more hours worked than paid and 10% with a different
+    HS 25.
+    """
+    rng = np.random.default_rng(seed)
+    cins = np.array([f"AB{i:06d}" for i in range(employees)], dtype=object)
+    side = rng.random(employees)
+    hours = rng.choice([26.0, 104.5, 191.0], employees)
+    hs25 = rng.choice([0.0, 0.0, 2.0, 8.5], employees)
+    hs50 = rng.choice([0.0, 0.0, 0.0, 4.0], employees)
+    pointage = pd.DataFrame({
+        "CIN": cins,
+        "Heures_Pointage": hours + (rng.random(employees) < 0.2) * rng.integers(1, 9, employees),
+        "HS25_POINTAGE": hs25,
+        "HS50_POINTAGE": hs50,
+    })[side > 0.05]
+    paie = pd.DataFrame({
+        "CIN": cins,
+        "Heures_Paie": hours,
+        "HS25_PAIE": hs25 + (rng.random(employees) < 0.1),
+        "HS50_PAIE": hs50,
+        "ACOMPTE": 0.0,
+        "NET_PAYE": rng.uniform(3000, 9000, employees).round(2),
+        "AMO": rng.choice([0.0, 186.38, 241.5], employees),
+        "CNSS": rng.choice([0.0, 257.4, 333.6], employees),
+        "DATE_EMBAUCHE": pd.Timestamp("2024-01-01") + pd.to_timedelta(rng.integers(0, 700, employees), unit="D"),
+    })[side < 0.95]
+    return paie, pointage
+
+
+def synthetic_comparison(employees, seed=0):
+    """The merged frame of synthetic_sides() as cobco.compare_files builds
+    it, and the CIN columns of both sides."""
+    paie, pointage = synthetic_sides(employees, seed)
+    df_comparaison = reconcile.outer_merge(paie, pointage, ("IN_PAIE", "IN_POINTAGE"))
+    df_comparaison["Écart"] = df_comparaison["Heures_Pointage"] - df_comparaison["Heures_Paie"]
+    return df_comparaison, pointage["CIN"], paie["CIN"]
+
+
+def row_by_row_results(commit=ROW_BY_ROW_COMMIT):
+    """cobco's comparison as compare_files computed it at `commit`, before
+    reconcile.py: its iterrows() pass, with a scan of both CIN columns per
+    employee for the absence checks. The loop is read from the commit with
+    git show, not copied here, and returned as a function of
+    (df_comparaison, pointage_cins, paie_cins)."""
+    source = subprocess.run(["git", "show", f"{commit}:server/cobco.py"], capture_output=True, text=True,
+                            check=True).stdout
+    start = source.index("    results = []\n")
+    end = source.index("    return {", start)
+    loop = compile(textwrap.dedent(source[start:end]), f"{commit}:server/cobco.py", "exec")
+
+    def results(df_comparaison, pointage_cins, paie_cins):
+        scope = {
+            "pd": pd,
+            "df_comparaison": df_comparaison,
+            "df_pointage": pd.DataFrame({"CIN": pointage_cins}),
+            "ncin_col_pointage": "CIN",
+            "df_paie": pd.DataFrame({"CIN": paie_cins}),
+        }
+        exec(loop, scope)
+        return scope["results"]
+    return results
+
+
+def bench_reconcile(sizes, repeat, loop_max):
+    """cobco's rule profile against the row-by-row loop it replaced, on
+    synthetic months of each size."""
+    import cobco
+
+    row_by_row = row_by_row_results()
+    print(f"{'employees':>10} {'row-by-row':>11} {'columns':>9} {'speedup':>8} {'same':>5}")
+    for employees in sizes:
+        frames = synthetic_comparison(employees)
+        new_time, new_results = best_of(repeat, cobco.COMPARISON_RULES.evaluate, frames[0])
+        if employees > loop_max:
+            print(f"{employees:>10} {'skipped':>11} {new_time:>8.3f}s")
+            continue
+        old_time, old_results = best_of(1, row_by_row, *frames)
+        same = old_results == new_results
+        print(f"{employees:>10} {old_time:>10.3f}s {new_time:>8.3f}s {old_time / new_time:>7.1f}x "
+              f"{'yes' if same else 'NO':>5}")
+
+
+def plain_merge(paie, pointage):
+    return pd.merge(paie, pointage, on="CIN", how="outer").fillna(0)
+
+
+def scan_presence(cins, pointage_cins, paie_cins):
+    return [any(pointage_cins == cin) for cin in cins], [any(paie_cins == cin) for cin in cins]
+
+
+def isin_presence(cins, pointage_cins, paie_cins):
+    return cins.isin(pointage_cins).tolist(), cins.isin(paie_cins).tolist()
+
+
+def bench_presence(sizes, repeat, loop_max):
+    """Which file each employee is in: a scan of both CIN columns per
+    employee (as compare_files did), a hashed lookup (Series.isin), and the
+    merge indicator of reconcile.outer_merge, timed as its extra cost over
+    the plain outer merge."""
+    print(f"{'employees':>10} {'scan':>10} {'isin':>9} {'indicator':>10} {'vs scan':>9} {'same':>5}")
+    for employees in sizes:
+        paie, pointage = synthetic_sides(employees)
+        plain_time, _ = best_of(repeat, plain_merge, paie, pointage)
+        merge_time, merged = best_of(repeat, reconcile.outer_merge, paie, pointage, ("IN_PAIE", "IN_POINTAGE"))
+        indicator_time = max(merge_time - plain_time, 1e-6)
+        flags = merged["IN_POINTAGE"].tolist(), merged["IN_PAIE"].tolist()
+        isin_time, isin_flags = best_of(repeat, isin_presence, merged["CIN"], pointage["CIN"], paie["CIN"])
+        same = isin_flags == flags
+        if employees > loop_max:
+            print(f"{employees:>10} {'skipped':>10} {isin_time:>8.4f}s {indicator_time:>9.4f}s "
+                  f"{'':>9} {'yes' if same else 'NO':>5}")
+            continue
+        scan_time, scan_flags = best_of(1, scan_presence, merged["CIN"], pointage["CIN"], paie["CIN"])
+        same = same and scan_flags == flags
+        print(f"{employees:>10} {scan_time:>9.3f}s {isin_time:>8.4f}s {indicator_time:>9.4f}s "
+              f"{scan_time / indicator_time:>8.0f}x {'yes' if same else 'NO':>5}")
+
+
+def bench_rules(sizes, repeat, extra):
+    """cobco's rule profile as is and with `extra` more rules (copies of its
+    HS 25 check), for the cost of one added check."""
+    import cobco
+
+    base = cobco.COMPARISON_RULES
+    checks = [rules.rule("HS25_POINTAGE", "HS25_PAIE", "HS 25 Pointage ({left}) ≠ HS 25 Paie ({right})",
+                         status=f"extra{n}Status") for n in range(extra)]
+    extended = rules.RuleProfile(base.rules + checks, base.presence, base.absent_prefix, base.prime, base.fields)
+    print(f"{'employees':>10} {'profile':>9} {f'+{extra} rules':>10} {'per rule':>9}")
+    for employees in sizes:
+        df = synthetic_comparison(employees)[0]
+        base_time, _ = best_of(repeat, base.evaluate, df)
+        extended_time, _ = best_of(repeat, extended.evaluate, df)
+        per_rule = (extended_time - base_time) / max(extra, 1)
+        print(f"{employees:>10} {base_time:>8.3f}s {extended_time:>9.3f}s {per_rule:>8.4f}s")
+
+
+def bench_json(company, pointage, paie, repeat):
+    """Encoding of the compare_files response of one fixture: Flask's JSON
+    encoder against responses.OrjsonProvider, for the row and the columnar
+    results."""
+    from flask import Flask
+
+    module = importlib.import_module(company)
+    flask_json = Flask("flask_json").json
+    fast_json = responses.use_fast_json(Flask("fast_json")).json
+    print(f"{'format':<9} {'employees':>9} {'flask':>9} {'orjson':>9} {'speedup':>8} {'size':>9}")
+    for columnar in (False, True):
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = module.compare_files(pointage, paie, response_format="columnar" if columnar else "rows")
+        flask_time, flask_body = best_of(repeat, flask_json.dumps, response)
+        fast_time, fast_body = best_of(repeat, fast_json.dumps, response)
+        same = json.loads(flask_body) == json.loads(fast_body)
+        employees = response["summary"]["total"]
+        print(f"{'columnar' if columnar else 'rows':<9} {employees:>9} {flask_time * 1000:>7.1f}ms "
+              f"{fast_time * 1000:>7.1f}ms {flask_time / fast_time:>7.1f}x {len(fast_body) / 1000:>7.0f}kB"
+              f"{'' if same else '  (differs)'}")
+
+
+def traced(function, *args):
+    """(seconds, peak bytes allocated, result) of one call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def whole_body(profile, columns, summary):
+    return responses.dumps({"results": profile.rows(columns), "summary": summary})
+
+
+def streamed_body(profile, columns, summary):
+    """(seconds to the first result line, bytes) of the NDJSON body, its
+    lines dropped as they are made."""
+    start = time.perf_counter()
+    first = None
+    size = 0
+    for line in responses.ndjson({"summary": summary}, profile.row_chunks(columns)).response:
+        if first is None and size:
+            first = time.perf_counter() - start
+        size += len(line)
+    return first, size
+
+
+def bench_stream(sizes):
+    """One JSON document against the format=ndjson stream, from cobco's
+    result columns on synthetic months: time to the first result and peak
+    memory while the body is built."""
+    import cobco
+
+    profile = cobco.COMPARISON_RULES
+    print(f"{'employees':>10} {'json body':>11} {'json peak':>10} {'ndjson first':>13} {'ndjson peak':>12} "
+          f"{'size':>9}")
+    for employees in sizes:
+        columns = profile.columns(synthetic_comparison(employees)[0])
+        summary = {"total": len(columns["status"])}
+        json_time, json_peak, body = traced(whole_body, profile, columns, summary)
+        _, stream_peak, (first, size) = traced(streamed_body, profile, columns, summary)
+        print(f"{employees:>10} {json_time * 1000:>9.1f}ms {json_peak / 2**20:>8.1f}MB "
+              f"{first * 1000:>11.1f}ms {stream_peak / 2**20:>10.1f}MB {size / 2**20:>7.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    headers = subparsers.add_parser("headers", help="two-pass vs single-pass header detection")
+    headers.add_argument("--repeat", type=int, default=1)
+    headers.add_argument("files", nargs="*")
+
+    projection = subparsers.add_parser("projection", help="full read vs streamed column projection")
+    projection.add_argument("--repeat", type=int, default=1)
+    projection.add_argument("files", nargs="*")
+
+    backends = subparsers.add_parser("backends", help="Excel reader backends, full and projected reads")
+    backends.add_argument("--repeat", type=int, default=1)
+    backends.add_argument("--backend", action="append", choices=sorted(readers.EXCEL_BACKENDS),
+                          help="backend to time (repeatable); default: all installed")
+    backends.add_argument("files", nargs="*")
+
+    cache = subparsers.add_parser("cache", help="parse vs load from the frame cache")
+    cache.add_argument("--repeat", type=int, default=1)
+    cache.add_argument("files", nargs="*")
+
+    reconcile = subparsers.add_parser("reconcile", help="row-by-row vs column-wise reconciliation")
+    reconcile.add_argument("--repeat", type=int, default=1)
+    reconcile.add_argument("--employees", type=int, action="append",
+                           help="synthetic month size (repeatable); default: 1000, 10000, 100000")
+    reconcile.add_argument("--loop-max", type=int, default=10000,
+                           help="largest size the row-by-row loop is timed on (it is quadratic)")
+
+    presence = subparsers.add_parser("presence", help="per-row CIN scans vs hashed lookup vs merge indicator")
+    presence.add_argument("--repeat", type=int, default=3)
+    presence.add_argument("--employees", type=int, action="append",
+                          help="synthetic month size (repeatable); default: 1000, 10000, 100000")
+    presence.add_argument("--loop-max", type=int, default=10000,
+                          help="largest size the per-row scans are timed on (they are quadratic)")
+
+    rule_costs = subparsers.add_parser("rules", help="cost of the checks of a rule profile")
+    rule_costs.add_argument("--repeat", type=int, default=3)
+    rule_costs.add_argument("--employees", type=int, action="append",
+                            help="synthetic month size (repeatable); default: 1000, 10000, 100000")
+    rule_costs.add_argument("--extra", type=int, default=10, help="rules added to the profile")
+
+    json_bench = subparsers.add_parser("json", help="Flask's JSON encoder vs orjson on a compare_files response")
+    json_bench.add_argument("--repeat", type=int, default=5)
+    json_bench.add_argument("--company", default=JSON_FIXTURE[0], help="module whose compare_files is used")
+    json_bench.add_argument("files", nargs="*", help="pointage and paie files; default: the largest fixture")
+
+    stream = subparsers.add_parser("stream", help="whole JSON body vs format=ndjson stream")
+    stream.add_argument("--employees", type=int, action="append",
+                        help="synthetic month size (repeatable); default: 1000, 10000, 100000")
+
+    suite = subparsers.add_parser("suite", help="each company's upload end to end and per stage, against a baseline")
+    bench_suite.add_arguments(suite)
+
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+
+    if args.command == "headers":
+        bench_headers(sample_files(args.files), args.repeat)
+    elif args.command == "projection":
+        bench_projection(sample_files(args.files), args.repeat)
+    elif args.command == "backends":
+        bench_backends(sample_files(args.files), args.repeat, args.backend)
+    elif args.command == "cache":
+        bench_cache(sample_files(args.files), args.repeat)
+    elif args.command == "reconcile":
+        bench_reconcile(args.employees or [1000, 10000, 100000], args.repeat, args.loop_max)
+    elif args.command == "presence":
+        bench_presence(args.employees or [1000, 10000, 100000], args.repeat, args.loop_max)
+    elif args.command == "rules":
+        bench_rules(args.employees or [1000, 10000, 100000], args.repeat, args.extra)
+    elif args.command == "json":
+        files = args.files or [os.path.join(UPLOAD_FOLDER, name) for name in JSON_FIXTURE[1:]]
+        bench_json(args.company, files[0], files[1], args.repeat)
+    elif args.command == "stream":
+        bench_stream(args.employees or [1000, 10000, 100000])
+    elif args.command == "suite":
+        return bench_suite.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""Each company's upload timed end to end and per stage, against a baseline.
+
+Usage:
+    python bench_suite.py [--repeat N] [--company NAME ...] [--threshold PCT] [--history FILE] [--warm]
+    python bench.py suite ...    (same options)
+
+The suite posts each company's upload on the fixtures of SUITE_FIXTURES,
+through its Flask app, and reports the time and peak memory (tracemalloc)
+of the whole request and of each stage (see stages.py). Each run is
+appended to a JSON history (--history, by default cache/bench_history.json)
+and compared with the last passing run of the same host: the command exits
+with status 1 when a time or a peak grew by more than --threshold percent.
+Caches are emptied before each upload unless --warm.
+
+No bundled timesheet has the layout main.py reads, so the novometal upload
+is not a fixture: its timesheet is synthesised from the payroll journal
+(see novometal_timesheet). The output and the history say so.
+
+The micro-benchmarks of single steps are in bench.py.
+"""
+import argparse
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import warnings
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import frame_cache
+import ingest
+import layout_cache
+import stages
+import timings
+import upload_store
+
+UPLOAD_FOLDER = 'uploads'
+
+# Fixtures the suite runs each company on: (pointage, paie) in uploads/.
+SUITE_FIXTURES = {
+    "cobco": ("Pointage_Mars_GRH_2025-_CIN-Cobco.xlsx", "JournalPaieExport_COBCO_0325.xlsx"),
+    "scif": ("Pointage_GRH_-_Avril_2025.xlsx", "JournalPaieExport_SCIF_SUD_04-25_1_glbl.xlsx"),
+    "casaEaro": ("Paie_GRH_03_2025_CASA_AERO_-CIN_-_Correct.xlsx", "JournalPaieExport_CASA_AERO_03-2025.xlsx"),
+    "other": ("GRAND_CERAME_6_3.xlsx", "JournalPaieExport_-_GRAND_CERAME.xlsx"),
+    "sbbc": ("Book_9.xlsx", "JournalPaieExport_SBBC_0325_1.xlsx"),
+    # No timesheet in uploads/ has the layout main.py reads; it is derived
+    # from the payroll journal, see novometal_timesheet
+    "main": (None, "JOURNAL_DE_PAIE_NOVOMETAL_02-2025_1.xlsx"),
+}
+# Name the synthesised novometal timesheet is uploaded under
+SYNTHESISED_TIMESHEET = "novometal_timesheet.xlsx"
+
+SUITE_HISTORY = os.path.join(frame_cache.CACHE_FOLDER, "bench_history.json")
+# Stages shorter than this in the baseline are not checked for time
+# regressions: at that scale the noise exceeds any threshold.
+SUITE_MIN_STAGE_MS = 5.0
+
+
+class StagePeaks(stages.Listener):
+    """Peak memory traced by tracemalloc in each stage, tracemalloc running."""
+
+    def __init__(self):
+        self.peaks = {}
+        self.current = None
+
+    def stage(self, name):
+        if self.current is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peaks[self.current] = max(self.peaks.get(self.current, 0), peak)
+        tracemalloc.reset_peak()
+        self.current = name
+
+
+def novometal_timesheet(payroll):
+    """A timesheet in the layout main.py reads (Matricule and HN/JN on the
+    first row) for the employees of the payroll journal `payroll`: their
+    paid hours, every 7th employee with 8 more, so some rows disagree."""
+    paid = pd.read_excel(io.BytesIO(payroll), skiprows=9).dropna(subset=["Matricule"])
+    hours = pd.to_numeric(paid["Jrs/Hrs"], errors="coerce").fillna(0).to_numpy()
+    hours[::7] += 8
+    buffer = io.BytesIO()
+    pd.DataFrame({"Matricule": paid["Matricule"].to_numpy(), "HN/JN": hours}).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def suite_fixture(company):
+    """(route, [(form field, file name, bytes), ...], {file name: sha256},
+    [names of the synthesised files]) of the upload the suite posts for
+    `company`."""
+    pointage, paie = SUITE_FIXTURES[company]
+    contents = {}
+    for name in (pointage, paie):
+        if name is not None:
+            with open(os.path.join(UPLOAD_FOLDER, name), "rb") as f:
+                contents[name] = f.read()
+    digests = {name: hashlib.sha256(data).hexdigest() for name, data in contents.items()}
+    synthesised = []
+    if pointage is None:
+        pointage = SYNTHESISED_TIMESHEET
+        contents[pointage] = novometal_timesheet(contents[paie])
+        synthesised.append(pointage)
+    if company in ("main", "sbbc"):
+        route, fields = "/api/compare", ("timesheet", "payroll")
+    else:
+        route, fields = "/upload", ("pointage", "paie")
+    files = [(field, name, contents[name]) for field, name in zip(fields, (pointage, paie))]
+    return route, files, digests, synthesised
+
+
+@contextlib.contextmanager
+def cold_caches():
+    """Empty frame and layout caches, in a temporary folder."""
+    layouts = layout_cache.layouts
+    with tempfile.TemporaryDirectory() as folder:
+        ingest.frames = frame_cache.FrameCache(folder)
+        ingest.layouts = layout_cache.layouts = layout_cache.LayoutCache(os.path.join(folder, "layouts.json"))
+        try:
+            yield
+        finally:
+            ingest.frames = frame_cache.frames
+            ingest.layouts = layout_cache.layouts = layouts
+
+
+def suite_run(client, route, files, warm=False, traced=False):
+    """Post one upload; returns its timings.Timer and, if `traced`, its
+    StagePeaks and the peak memory of the whole request."""
+    timer = timings.Timer()
+    peaks = StagePeaks() if traced else None
+    data = {field: (io.BytesIO(content), name) for field, name, content in files}
+    with contextlib.ExitStack() as stack:
+        if not warm:
+            stack.enter_context(cold_caches())
+        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+        if traced:
+            tracemalloc.start()
+            stack.callback(tracemalloc.stop)
+            stack.enter_context(stages.listening(peaks))
+        stack.enter_context(stages.listening(timer))
+        response = client.post(route, data=data, content_type="multipart/form-data")
+        timer.stop()
+        peak = None
+        if traced:
+            peaks.stage(None)
+            peak = max(peaks.peaks.values(), default=tracemalloc.get_traced_memory()[1])
+    if response.status_code != 200:
+        raise RuntimeError(f"{route}: {response.status_code} {(response.get_json() or {}).get('error')}")
+    return timer, peaks, peak
+
+
+def bench_company(company, repeat, warm=False):
+    """The suite's measures of one company: best of `repeat` runs for the
+    times, one more run under tracemalloc for the memory."""
+    module = importlib.import_module(company)
+    client = module.app.test_client()
+    route, files, digests, synthesised = suite_fixture(company)
+    if warm:
+        suite_run(client, route, files, warm)
+    best = None
+    for _ in range(repeat):
+        timer, _, _ = suite_run(client, route, files, warm)
+        if best is None or timer.total() < best.total():
+            best = timer
+    _, peaks, peak = suite_run(client, route, files, warm, traced=True)
+    return {
+        "fixtures": digests,
+        "synthesised": synthesised,
+        "rows": best.rows,
+        "milliseconds": best.total(),
+        "peakBytes": peak,
+        "stages": {
+            name: {"milliseconds": ms, "peakBytes": peaks.peaks.get(name)}
+            for name, ms in best.milliseconds().items()
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def suite_baseline(history, run):
+    """The last run of `history` that passed, on the same host and with the
+    same cache mode as `run`, or None."""
+    for previous in reversed(history):
+        if previous.get("passed") and previous["host"] == run["host"] and previous["caches"] == run["caches"]:
+            return previous
+    return None
+
+
+def regressions(baseline, run, threshold, min_stage_ms=SUITE_MIN_STAGE_MS):
+    """What grew by more than `threshold` percent from `baseline` to `run`,
+    per company and stage, for the companies run on the same fixtures."""
+    limit = 1 + threshold / 100
+    found = []
+
+    def check(label, key, before, after):
+        if before and after and after > before * limit:
+            found.append(f"{label} {key}: {before:,.0f} -> {after:,.0f} (+{(after / before - 1) * 100:.1f}%)")
+
+    for company, result in run["companies"].items():
+        previous = baseline["companies"].get(company)
+        if previous is None or previous["fixtures"] != result["fixtures"]:
+            continue
+        check(company, "milliseconds", previous["milliseconds"], result["milliseconds"])
+        check(company, "peakBytes", previous["peakBytes"], result["peakBytes"])
+        for name, measures in result["stages"].items():
+            before = previous["stages"].get(name)
+            if before is None:
+                continue
+            if before["milliseconds"] >= min_stage_ms:
+                check(f"{company}/{name}", "milliseconds", before["milliseconds"], measures["milliseconds"])
+            check(f"{company}/{name}", "peakBytes", before["peakBytes"], measures["peakBytes"])
+    return found
+
+
+def bench_suite(companies, repeat, history_path, threshold, warm=False, record=True):
+    """Run each company's upload end to end on its fixtures, stage by
+    stage; compare with the last passing run in the history and append
+    this one. Returns the exit status: 1 if anything regressed by more
+    than `threshold` percent."""
+    timings.log.disabled = True
+    upload_store.UPLOAD_ARCHIVE = False
+    run = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "repeat": repeat,
+        "caches": "warm" if warm else "cold",
+        "threshold": threshold,
+        "companies": {},
+    }
+    print(f"{'company':<10} {'stage':<10} {'rows':>12} {'time':>10} {'peak':>9}")
+    for company in companies:
+        result = run["companies"][company] = bench_company(company, repeat, warm)
+        rows = "/".join(str(count) for count in result["rows"].values())
+        print(f"{company:<10} {'total':<10} {rows:>12} {result['milliseconds']:>8.1f}ms "
+              f"{result['peakBytes'] / 2**20:>7.1f}MB")
+        for name in result["synthesised"]:
+            print(f"{'':<10} note: {name} is synthesised (novometal_timesheet), not a bundled fixture")
+        for name, measures in result["stages"].items():
+            peak = measures["peakBytes"]
+            print(f"{'':<10} {name:<10} {'':>12} {measures['milliseconds']:>8.1f}ms "
+                  f"{peak / 2**20 if peak is not None else 0:>7.1f}MB")
+
+    history = load_history(history_path)
+    baseline = suite_baseline(history, run)
+    found = regressions(baseline, run, threshold) if baseline else []
+    run["passed"] = not found
+    if baseline is None:
+        print("no baseline: this run becomes the baseline")
+    else:
+        print(f"baseline: {baseline['date']} ({baseline.get('commit') or 'no commit'})")
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    if record:
+        history.append(run)
+        os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+        with open(history_path, "w", encoding="utf-8") as f:
+            json.dump(history, f, indent=1)
+    return 1 if found else 0
+
+
+def add_arguments(parser):
+    """The suite's options, on `parser`."""
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--company", action="append", choices=sorted(SUITE_FIXTURES),
+                        help="company module to run (repeatable); default: all")
+    parser.add_argument("--threshold", type=float, default=25.0,
+                        help="regression allowed over the baseline, in percent")
+    parser.add_argument("--history", default=SUITE_HISTORY, help="JSON history the run is compared with and added to")
+    parser.add_argument("--warm", action="store_true", help="keep the frame and layout caches between uploads")
+    parser.add_argument("--no-record", dest="record", action="store_false", help="do not add the run to the history")
+    return parser
+
+
+def run(args):
+    """bench_suite() with the options parsed by add_arguments()."""
+    return bench_suite(args.company or list(SUITE_FIXTURES), args.repeat, args.history, args.threshold,
+                       args.warm, args.record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    args = add_arguments(parser).parse_args()
+    warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,114 +1,165 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
+import logging
 import os
-from werkzeug.utils import secure_filename
+from ingest import read_files_with_header
+from layout_cache import resolve_columns
+from upload_store import uploads
+from reconcile import outer_merge
+from rules import RuleProfile, rule
+from columns import ColumnMatcher, NCIN, JRS_HRS, HS25, HS50, ACOMPTE, NET_PAYE, AMO, CNSS, DATE_EMBAUCHE
 from datetime import datetime
+from responses import ndjson, use_fast_json
+from runs import add_run_routes, runs
+from jobs import add_job_routes, maybe_submit
+from stages import count, stage
+from timings import timed, with_timings
+from logs import event, logger
+from metrics import add_metrics
 
+log = logger("cobco")
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+use_fast_json(app)
+add_run_routes(app)
+add_job_routes(app)
 
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Fields compare_files reads from each file (see columns.py). Columns none
+# of them can match are skipped while the workbooks are read.
+POINTAGE_FIELDS = ColumnMatcher({
+    "NCIN": NCIN,
+    "JRS/HRS": JRS_HRS,
+    "HS25": HS25,
+    "HS50": HS50,
+})
+# How compare_files aggregates the pointage per employee; CSV pointage files
+# are aggregated this way while they are read.
+POINTAGE_TOTALS = {"JRS/HRS": "sum", "HS25": "sum", "HS50": "sum"}
+PAIE_FIELDS = ColumnMatcher({
+    "NCIN": NCIN,
+    "JRS/HRS": JRS_HRS,
+    "HS25": HS25,
+    "HS50": HS50,
+    "ACOMPTE": ACOMPTE,
+    "NET_PAYE": NET_PAYE,
+    "AMO": AMO,
+    "CNSS": CNSS,
+    "DATE_EMBAUCHE": DATE_EMBAUCHE,
+})
+# What compare_files checks on the merged frame (see rules.py)
+COMPARISON_RULES = RuleProfile(
+    [
+        # Hours comparison (JRS/HRS vs JRS/HRS) of the employees in both files
+        rule("Heures_Pointage", "Heures_Paie",
+             "Heures Pointage: {left:.2f} Heures Paie: {right:.2f} Différence de {gap:.2f} heures",
+             employees="both", code="heures"),
+        # HS 25 / HS 50 comparisons (HS 25 vs HS 25, HS 50 vs HS 50)
+        rule("HS25_POINTAGE", "HS25_PAIE", "HS 25 Pointage ({left}) ≠ HS 25 Paie ({right})",
+             left_only="HS 25 Pointage ({value}) mais absent dans Paie",
+             right_only="HS 25 Paie ({value}) mais absent dans Pointage",
+             status="hs25Status"),
+        rule("HS50_POINTAGE", "HS50_PAIE", "HS 50 Pointage ({left}) ≠ HS 50 Paie ({right})",
+             left_only="HS 50 Pointage ({value}) mais absent dans Paie",
+             right_only="HS 50 Paie ({value}) mais absent dans Pointage",
+             status="hs50Status"),
+    ],
+    fields={
+        "hs25Pointage": "HS25_POINTAGE",
+        "hs25Paie": "HS25_PAIE",
+        "hs50Pointage": "HS50_POINTAGE",
+        "hs50Paie": "HS50_PAIE",
+        "acompte": "ACOMPTE",
+        "netPaye": "NET_PAYE",
+        "amo": "AMO",
+        "cnss": "CNSS",
+    },
+)
+
 @app.route('/test', methods=['GET'])
 def test():
     return jsonify({"message": "Backend is working"}), 200
 
 @app.route('/upload', methods=['POST'])
+@timed("cobco")
 def upload_files():
     if 'pointage' not in request.files or 'paie' not in request.files:
         return jsonify({'error': 'Les deux fichiers sont requis'}), 400
 
-    pointage_file = request.files['pointage']
-    paie_file = request.files['paie']
+    # Several files per side (e.g. CENTRE and SUD) are compared as one
+    pointage_files = request.files.getlist('pointage')
+    paie_files = request.files.getlist('paie')
 
-    if pointage_file.filename == '' or paie_file.filename == '':
+    if any(f.filename == '' for f in pointage_files + paie_files):
         return jsonify({'error': 'Aucun fichier sélectionné'}), 400
 
-    pointage_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(pointage_file.filename))
-    paie_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(paie_file.filename))
+    # Parsed from memory or from the content-addressed store (see upload_store.py)
+    month = request.form.get('month')
+    pointage = [uploads.accept(f, "cobco", month) for f in pointage_files]
+    paie = [uploads.accept(f, "cobco", month) for f in paie_files]
+    # sheets=all: every sheet of each workbook that has the header is read
+    all_sheets = request.form.get('sheets') == 'all'
+    # messages=codes: inconsistencies as codes and operands (see rules.py)
+    codes = request.form.get('messages') == 'codes'
+    # format=columnar: one array per field instead of one object per employee;
+    # format=ndjson: the summary, then one line per employee, streamed
+    response_format = request.form.get('format', 'rows')
+    # size=N: results kept server-side, first page only (see runs.py)
+    page_size = request.form.get('size', type=int)
+    if page_size is not None and page_size < 1:
+        return jsonify({'error': 'Paramètres de page invalides'}), 400
 
-    pointage_file.save(pointage_path)
-    paie_file.save(paie_path)
+    # mode=async: compared in the job pool, followed at /jobs/<id> (see jobs.py)
+    submission = maybe_submit(request, compare_files, pointage, paie, all_sheets, codes, response_format, company="cobco")
+    if submission is not None:
+        return submission
 
     try:
-        comparison_results = compare_files(pointage_path, paie_path)
-        return jsonify(comparison_results), 200
+        comparison_results = compare_files(pointage, paie, all_sheets, codes, response_format, page_size)
+        stage("serialize")
+        # timings=1: time spent in each stage so far (see timings.py)
+        if response_format == 'ndjson' and not page_size:
+            return ndjson(with_timings({"summary": comparison_results["summary"]}), comparison_results["results"]), 200
+        return jsonify(with_timings(comparison_results)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def find_header_row(file_path, search_terms):
-    """Find the row number that contains all search terms in an Excel file."""
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=None)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=None, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Convert all cells to strings and uppercase for case-insensitive search
-    df = df.applymap(lambda x: str(x).upper().strip() if pd.notna(x) else "")
-    
-    for idx, row in df.iterrows():
-        row_values = ' '.join(row.values.astype(str))
-        if all(term.upper() in row_values for term in search_terms):
-            return idx
-    return None
-
-def read_file_with_header(file_path, header_terms):
-    """Read file with dynamic header row detection."""
-    header_row = find_header_row(file_path, header_terms)
-    if header_row is None:
-        raise ValueError(f"Could not find header row containing: {header_terms}")
-    
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=header_row)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=header_row, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Clean column names
-    df.columns = [str(col).strip().upper() for col in df.columns]
-    return df
-
-def compare_files(pointage_path, paie_path):
+def compare_files(pointage_path, paie_path, all_sheets=False, codes=False, response_format="rows", page_size=None):
+    stage("read")
     # Read files with dynamic header detection
     try:
         # Both files now use NCIN and have JRS/HRS columns
-        df_pointage = read_file_with_header(pointage_path, ["NCIN", "JRS/HRS"])
-        df_paie = read_file_with_header(paie_path, ["NCIN", "JRS/HRS"])
+        df_pointage = read_files_with_header(pointage_path, ["NCIN", "JRS/HRS"], keep=POINTAGE_FIELDS,
+                                             group_by="NCIN", agg=POINTAGE_TOTALS, all_sheets=all_sheets)
+        df_paie = read_files_with_header(paie_path, ["NCIN", "JRS/HRS"], keep=PAIE_FIELDS, all_sheets=all_sheets)
     except ValueError as e:
         raise Exception(f"Erreur lors de la lecture des fichiers: {str(e)}")
+    count(pointage=len(df_pointage), paie=len(df_paie))
     
-    # Print column names for debugging
-    print("Pointage columns:", df_pointage.columns.tolist())
-    print("Paie columns:", df_paie.columns.tolist())
-    
-    # Identify the correct columns - using more flexible matching
-    ncin_col_pointage = next((col for col in df_pointage.columns if "NCIN" in col or "CIN" in col), None)
-    jrs_hrs_col_pointage = next((col for col in df_pointage.columns if "JRS" in col and "HRS" in col), None)
-    
-    # For the "HS 25" and "HS 50" columns in pointage
-    hs25_pointage_col = next((col for col in df_pointage.columns if "HS 25" in col and "MT" not in col), None)
-    hs50_pointage_col = next((col for col in df_pointage.columns if "HS 50" in col and "MT" not in col), None)
+    # Columns read, logged at debug level (see logs.py)
+    event(log, "columns", logging.DEBUG, company="cobco", pointage=df_pointage.columns.tolist(),
+          paie=df_paie.columns.tolist())
     
-    # Paie file columns
-    ncin_col_paie = next((col for col in df_paie.columns if "NCIN" in col or "CIN" in col), None)
-    jrs_hrs_col_paie = next((col for col in df_paie.columns if "JRS" in col and "HRS" in col), None)
-    
-    # For the "HS 25" and "HS 50" columns in paie
-    hs25_paie_col = next((col for col in df_paie.columns if "HS 25" in col and "MT" not in col), None)
-    hs50_paie_col = next((col for col in df_paie.columns if "HS 50" in col and "MT" not in col), None)
-            
-    # New columns for paie validations
-    acompte_col = next((col for col in df_paie.columns if "ACOMPTE" in col), None)
-    net_paye_col = next((col for col in df_paie.columns if "NET" in col and "PAYE" in col), None)
-    amo_col = next((col for col in df_paie.columns if "AMO" in col), None)
-    cnss_col = next((col for col in df_paie.columns if "CNSS" in col), None)
-    date_embauche_col = next((col for col in df_paie.columns if "DATE" in col and "EMBAUCHE" in col), None)
+    # Identify the correct columns (cached per header layout)
+    pointage_fields = resolve_columns(df_pointage, "cobco.pointage", POINTAGE_FIELDS)
+    paie_fields = resolve_columns(df_paie, "cobco.paie", PAIE_FIELDS)
+    ncin_col_pointage = pointage_fields["NCIN"]
+    jrs_hrs_col_pointage = pointage_fields["JRS/HRS"]
+    hs25_pointage_col = pointage_fields["HS25"]
+    hs50_pointage_col = pointage_fields["HS50"]
+    ncin_col_paie = paie_fields["NCIN"]
+    jrs_hrs_col_paie = paie_fields["JRS/HRS"]
+    hs25_paie_col = paie_fields["HS25"]
+    hs50_paie_col = paie_fields["HS50"]
+    acompte_col = paie_fields["ACOMPTE"]
+    net_paye_col = paie_fields["NET_PAYE"]
+    amo_col = paie_fields["AMO"]
+    cnss_col = paie_fields["CNSS"]
+    date_embauche_col = paie_fields["DATE_EMBAUCHE"]
     
     # Check required columns
     required_pointage_cols = {
@@ -126,6 +177,7 @@ def compare_files(pointage_path, paie_path):
     if missing_paie:
         raise Exception(f"Colonnes manquantes dans Journal de Paie: {', '.join(missing_paie)}. Colonnes disponibles: {df_paie.columns.tolist()}")
         
+    stage("ncin")
     # Clean and standardize NCIN for better matching
     df_pointage[ncin_col_pointage] = df_pointage[ncin_col_pointage].astype(str).str.strip().str.upper()
     df_paie[ncin_col_paie] = df_paie[ncin_col_paie].astype(str).str.strip().str.upper()
@@ -135,6 +187,7 @@ def compare_files(pointage_path, paie_path):
     df_paie = df_paie[df_paie[ncin_col_paie] != 'NAN']
     df_paie = df_paie[df_paie[ncin_col_paie] != 'N/A']
     
+    stage("numeric")
     # Convert columns to numeric
     df_pointage[jrs_hrs_col_pointage] = pd.to_numeric(df_pointage[jrs_hrs_col_pointage], errors="coerce").fillna(0)
     df_paie[jrs_hrs_col_paie] = pd.to_numeric(df_paie[jrs_hrs_col_paie], errors="coerce").fillna(0)
@@ -163,6 +216,7 @@ def compare_files(pointage_path, paie_path):
     if date_embauche_col:
         df_paie[date_embauche_col] = pd.to_datetime(df_paie[date_embauche_col], errors="coerce")
     
+    stage("groupby")
     # Group pointage by NCIN and aggregate data
     agg_dict = {
         jrs_hrs_col_pointage: 'sum'
@@ -175,6 +229,7 @@ def compare_files(pointage_path, paie_path):
         
     df_pointage_grouped = df_pointage.groupby(ncin_col_pointage).agg(agg_dict).reset_index()
     
+    stage("merge")
     # Rename columns for the grouped dataframe
     rename_dict_pointage = {
         ncin_col_pointage: "CIN",
@@ -227,170 +282,30 @@ def compare_files(pointage_path, paie_path):
         
     df_paie = df_paie[paie_cols].rename(columns=rename_dict_paie)
     
-    # Merge on CIN - using outer join to catch all cases
-    df_comparaison = pd.merge(df_paie, df_pointage_grouped, on="CIN", how="outer").fillna(0)
+    # Merge on CIN - using outer join to catch all cases; IN_PAIE / IN_POINTAGE
+    # tell which file each employee is in
+    df_comparaison = outer_merge(df_paie, df_pointage_grouped, ("IN_PAIE", "IN_POINTAGE"))
     df_comparaison["Écart"] = df_comparaison["Heures_Pointage"] - df_comparaison["Heures_Paie"]
     
-    # Generate results
-    results = []
-    for _, row in df_comparaison.iterrows():
-        # Skip rows with empty/NaN CIN values in the final results
-        if pd.isna(row["CIN"]) or str(row["CIN"]).strip() in ['', 'NAN', 'N/A']:
-            continue
-            
-        prime_rendement = 0
-        status = "Correct"  # Default to correct unless we find issues
-        inconsistencies = []
-        
-        # First check for employee absence cases
-        # This is only for complete absence (CIN missing in one file)
-        in_pointage = any(df_pointage[ncin_col_pointage] == row["CIN"])
-        in_paie = any(df_paie["CIN"] == row["CIN"])
-        
-        if not in_pointage and in_paie:
-            status = "Employé absent dans pointage"
-            inconsistencies.append("Employé absent dans pointage")
-        elif in_pointage and not in_paie:
-            status = "Employé absent dans journal de paie"
-            inconsistencies.append("Employé absent dans journal de paie")
-        else:
-            # Hours comparison (JRS/HRS vs JRS/HRS)
-            # Check for hours discrepancy
-            if abs(row["Écart"]) > 0.01:
-                status = "Incohérence"
-                inconsistencies.append(f"Heures Pointage: {row['Heures_Pointage']:.2f} Heures Paie: {row['Heures_Paie']:.2f} Différence de {abs(row['Écart']):.2f} heures")
-                
-                # Calculate Prime de Rendement when worked hours exceed paid hours
-                if row["Heures_Pointage"] > row["Heures_Paie"]:
-                    prime_rendement = row["Heures_Pointage"] - row["Heures_Paie"]
-        
-        # HS 25 comparison (HS 25 vs HS 25)
-        hs25_status = "Correct"
-        if "HS25_POINTAGE" in df_comparaison.columns and "HS25_PAIE" in df_comparaison.columns:
-            if abs(row["HS25_POINTAGE"] - row["HS25_PAIE"]) > 0.01:
-                hs25_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"HS 25 Pointage ({row['HS25_POINTAGE']}) ≠ HS 25 Paie ({row['HS25_PAIE']})")
-        elif "HS25_POINTAGE" in df_comparaison.columns and row["HS25_POINTAGE"] > 0:
-            hs25_status = "Incohérence"
-            if status == "Correct":
-                status = "Incohérence"
-            inconsistencies.append(f"HS 25 Pointage ({row['HS25_POINTAGE']}) mais absent dans Paie")
-        elif "HS25_PAIE" in df_comparaison.columns and row["HS25_PAIE"] > 0:
-            hs25_status = "Incohérence"
-            if status == "Correct":
-                status = "Incohérence"
-            inconsistencies.append(f"HS 25 Paie ({row['HS25_PAIE']}) mais absent dans Pointage")
-        
-        # HS 50 comparison (HS 50 vs HS 50)
-        hs50_status = "Correct"
-        if "HS50_POINTAGE" in df_comparaison.columns and "HS50_PAIE" in df_comparaison.columns:
-            if abs(row["HS50_POINTAGE"] - row["HS50_PAIE"]) > 0.01:
-                hs50_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"HS 50 Pointage ({row['HS50_POINTAGE']}) ≠ HS 50 Paie ({row['HS50_PAIE']})")
-        elif "HS50_POINTAGE" in df_comparaison.columns and row["HS50_POINTAGE"] > 0:
-            hs50_status = "Incohérence"
-            if status == "Correct":
-                status = "Incohérence"
-            inconsistencies.append(f"HS 50 Pointage ({row['HS50_POINTAGE']}) mais absent dans Paie")
-        elif "HS50_PAIE" in df_comparaison.columns and row["HS50_PAIE"] > 0:
-            hs50_status = "Incohérence"
-            if status == "Correct":
-                status = "Incohérence"
-            inconsistencies.append(f"HS 50 Paie ({row['HS50_PAIE']}) mais absent dans Pointage")
-        
-        # New: Paie validations
-        paie_validations = {}
-        
-        # AMO & CNSS Check
-        amo_cnss_check = {"status": "Valid"}  # Default to Valid
-        if "AMO" in df_comparaison.columns and "CNSS" in df_comparaison.columns:
-            amo = float(row["AMO"]) if pd.notna(row["AMO"]) else 0
-            cnss = float(row["CNSS"]) if pd.notna(row["CNSS"]) else 0
-            
-            amo_cnss_check = {
-                "amo": amo,
-                "cnss": cnss,
-                "status": "Valid" if amo > 0 and cnss > 0 else "Employé non déclaré"
-            }
-        paie_validations["amoCnssCheck"] = amo_cnss_check
-        
-        # Date d'Embauche Check with updated contract duration logic
-        embauche_date_check = {"status": "Valid"}  # Default to Valid
-        if "DATE_EMBAUCHE" in df_comparaison.columns and pd.notna(row["DATE_EMBAUCHE"]):
-            try:
-                date_embauche = pd.to_datetime(row["DATE_EMBAUCHE"])
-                today = pd.to_datetime('today')
-                anciennete = (today - date_embauche).days / 30  # Convert to months
-                
-                embauche_date_check = {
-                    "dateEmbauche": date_embauche.strftime('%Y-%m-%d') if not pd.isna(date_embauche) else "Non spécifiée",
-                    "anciennete": f"{anciennete:.1f} mois",
-                    "status": "Fin de Contrat" if anciennete > 5 else "Valide"
-                }
-            except Exception as e:
-                embauche_date_check = {
-                    "dateEmbauche": "Format invalide",
-                    "anciennete": "Non calculée",
-                    "status": "Non vérifié",
-                    "error": str(e)
-                }
-                
-        paie_validations["embaucheDateCheck"] = embauche_date_check
-        
-        result_item = {
-            "CIN": row["CIN"],
-            "heuresTravaillees": row["Heures_Pointage"],
-            "heuresPayees": row["Heures_Paie"],
-            "difference": row["Écart"],
-            "status": status,
-            "primeRendement": prime_rendement,
-            "hs25Status": hs25_status,
-            "hs50Status": hs50_status,
-            "inconsistencies": inconsistencies,
-            "paieValidations": paie_validations
-        }
-        
-        # Add optional fields if they exist in the dataframe
-        if "HS25_POINTAGE" in df_comparaison.columns:
-            result_item["hs25Pointage"] = row["HS25_POINTAGE"]
-        if "HS25_PAIE" in df_comparaison.columns:
-            result_item["hs25Paie"] = row["HS25_PAIE"]
-        if "HS50_POINTAGE" in df_comparaison.columns:
-            result_item["hs50Pointage"] = row["HS50_POINTAGE"]
-        if "HS50_PAIE" in df_comparaison.columns:
-            result_item["hs50Paie"] = row["HS50_PAIE"]
-        if "ACOMPTE" in df_comparaison.columns:
-            result_item["acompte"] = row["ACOMPTE"]
-        if "NET_PAYE" in df_comparaison.columns:
-            result_item["netPaye"] = row["NET_PAYE"]
-        if "AMO" in df_comparaison.columns:
-            result_item["amo"] = row["AMO"]
-        if "CNSS" in df_comparaison.columns:
-            result_item["cnss"] = row["CNSS"]
-        if "DATE_EMBAUCHE" in df_comparaison.columns:
-            # Format date as string for JSON serialization if it's a datetime
-            if isinstance(row["DATE_EMBAUCHE"], pd.Timestamp):
-                result_item["dateEmbauche"] = row["DATE_EMBAUCHE"].strftime('%Y-%m-%d')
-            else:
-                result_item["dateEmbauche"] = row["DATE_EMBAUCHE"]
-            
-        results.append(result_item)
-    
-    return {
-        "results": results,
-        "summary": {
-            "total": len(results),
-            "correct": sum(1 for r in results if r["status"] == "Correct"),
-            "inconsistencies": sum(1 for r in results if r["status"] != "Correct"),
-            "totalPrimeRendement": sum(r["primeRendement"] for r in results),
-            "hs25Inconsistencies": sum(1 for r in results if r.get("hs25Status") == "Incohérence"),
-            "hs50Inconsistencies": sum(1 for r in results if r.get("hs50Status") == "Incohérence")
-        }
-    }
+    # Generate results from the rule profile
+    stage("rules")
+    columns = COMPARISON_RULES.columns(df_comparaison, codes=codes or bool(page_size))
+    count(results=len(columns["status"]))
+    stage("summary")
+    summary = COMPARISON_RULES.summary(columns)
+    stage("results")
+    if page_size:
+        run = runs.add(COMPARISON_RULES, columns, summary, company="cobco", render=not codes)
+        return {"run": run.id, "summary": summary, **run.page(size=page_size)}
+    # format=columnar: one list per result key, statuses dictionary-encoded
+    if response_format == "columnar":
+        return {"format": "columnar", "results": COMPARISON_RULES.columnar(columns), "summary": summary}
+    # format=ndjson: result dicts built chunk by chunk while they are sent
+    if response_format == "ndjson":
+        return {"results": COMPARISON_RULES.row_chunks(columns), "summary": summary}
+    return {"results": COMPARISON_RULES.rows(columns), "summary": summary}
+
+add_metrics(app, "cobco")
 
 if __name__ == '__main__':
     app.run(debug=True, port=8002)
\ No newline at end of file
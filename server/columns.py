@@ -0,0 +1,104 @@
+import re
+import unicodedata
+
+from layout_cache import fingerprint
+
+
+def normalize_header(text):
+    """Uppercase `text`, drop accents and all whitespace.
+
+    "Jours Fériés", "JOURS FERIES" and "JOURS  FERIES\\n" all normalise to
+    "JOURSFERIES", so patterns need only one spelling.
+    """
+    text = unicodedata.normalize("NFKD", str(text).upper())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return re.sub(r"\s+", "", text)
+
+
+def field(*alternatives, exclude=()):
+    """Pattern of one logical field.
+
+    A column matches when its header contains one of `alternatives` and none
+    of `exclude`. An alternative is a string, or a tuple of strings that must
+    all appear, e.g. field(("DATE", "EMBAUCHE")). Alternatives are in order
+    of preference: a column matching an earlier one wins over any column
+    matching only a later one.
+    """
+    return {
+        "any": [tuple(a) if isinstance(a, tuple) else (a,) for a in alternatives],
+        "exclude": list(exclude),
+    }
+
+
+# Fields shared by the pointage / journal de paie exports of every company.
+NCIN = field("CIN")
+JRS_HRS = field(("JRS", "HRS"))
+HS25 = field("HS 25", exclude=["MT"])
+HS50 = field("HS 50", exclude=["MT"])
+FERIE = field("FERIE")
+ACOMPTE = field("ACOMPTE")
+NET_PAYE = field(("NET", "PAYE"))
+AMO = field("AMO")
+CNSS = field("CNSS")
+DATE_EMBAUCHE = field(("DATE", "EMBAUCHE"))
+
+
+class ColumnMatcher:
+    """Declarative field-pattern table compiled into a single matcher.
+
+    `fields` maps each logical field to a field() pattern. The keywords of
+    all patterns are normalised and deduplicated once; resolve() then walks
+    the headers a single time and tests each against every distinct keyword.
+    A field takes the first header matching its most preferred alternative,
+    so the result is the same as one `next(col for col in columns if ...)`
+    scan per alternative, tried in order.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.signature = fingerprint("fields", fields)
+        # keywords a column must contain one of to be picked by some field,
+        # usable as the `keep` projection of ingest.read_file_with_header
+        self.keywords = []
+        self._tests = []
+        for pattern in fields.values():
+            for alternative in pattern["any"]:
+                for keyword in alternative:
+                    self._index(keyword, self.keywords)
+        compiled = []
+        for name, pattern in fields.items():
+            alternatives = [[self._index(k) for k in alternative] for alternative in pattern["any"]]
+            exclude = [self._index(k) for k in pattern["exclude"]]
+            compiled.append((name, alternatives, exclude))
+        self._compiled = compiled
+
+    def _index(self, keyword, also=None):
+        keyword = normalize_header(keyword)
+        if also is not None and keyword not in also:
+            also.append(keyword)
+        if keyword not in self._tests:
+            self._tests.append(keyword)
+        return self._tests.index(keyword)
+
+    def resolve(self, columns):
+        """Map each field to its best matching column, or None."""
+        resolved = dict.fromkeys(self.fields)
+        rank = {}
+        pending = self._compiled
+        for col in columns:
+            if not pending:
+                break
+            text = normalize_header(col)
+            present = [keyword in text for keyword in self._tests]
+            still_pending = []
+            for name, alternatives, exclude in pending:
+                if not any(present[i] for i in exclude):
+                    for i, alt in enumerate(alternatives[:rank.get(name, len(alternatives))]):
+                        if all(present[k] for k in alt):
+                            resolved[name] = col
+                            rank[name] = i
+                            break
+                if rank.get(name) != 0:
+                    still_pending.append((name, alternatives, exclude))
+            pending = still_pending
+        return resolved
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+from layout_cache import CACHE_FOLDER, fingerprint
+from logs import event, logger
+
+FRAME_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'frames')
+FRAME_CACHE_MAX_BYTES = 256 * 2**20
+
+# Bump when ingest.py changes the frames it produces, so stale entries are
+# never served.
+FRAME_FORMAT_VERSION = 1
+
+log = logger("cache")
+
+
+# Digests already computed in this process (e.g. by upload_store while the
+# upload was received), keyed by path and stat, so files are not re-hashed.
+KNOWN_DIGESTS_SIZE = 1024
+_known_digests = OrderedDict()
+_known_digests_lock = threading.Lock()
+
+
+def _stat_key(file_path):
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns
+
+
+def remember_digest(file_path, digest):
+    key = _stat_key(file_path)
+    with _known_digests_lock:
+        _known_digests[key] = digest
+        _known_digests.move_to_end(key)
+        while len(_known_digests) > KNOWN_DIGESTS_SIZE:
+            _known_digests.popitem(last=False)
+
+
+def file_digest(file_path, chunk_size=2**20):
+    """sha256 of a file's bytes."""
+    key = _stat_key(file_path)
+    with _known_digests_lock:
+        known = _known_digests.get(key)
+    if known is not None:
+        return known
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    remember_digest(file_path, digest)
+    return digest
+
+
+class FrameCache:
+    """Size-bounded on-disk cache of parsed frames, keyed by content hash.
+
+    Each entry is one pickled DataFrame (pandas stores it column block by
+    column block, attrs included) in `folder`. The least recently used
+    entries, by file mtime, are removed once the folder grows past
+    `max_bytes`.
+
+    Pickle rather than Parquet/Arrow: pyarrow is not a dependency of the
+    services, the frames hold object columns mixing str, int, float and
+    datetime cells exactly as the readers produced them, which Parquet
+    would coerce to one type per column, and df.attrs["layout"] must come
+    back too. Entries are only written and read by the services themselves.
+    """
+
+    def __init__(self, folder=FRAME_CACHE_FOLDER, max_bytes=FRAME_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.folder, f"{key}.pkl")
+
+    def get(self, key):
+        """Return the cached frame for `key`, or None. An entry that cannot
+        be loaded (truncated, corrupt, written by another pandas) is a miss
+        and is removed."""
+        path = self._path(key)
+        try:
+            df = pd.read_pickle(path)
+            if not isinstance(df, pd.DataFrame):
+                raise TypeError(f"not a DataFrame: {type(df).__name__}")
+            os.utime(path)
+        except FileNotFoundError:
+            df = None
+        except Exception as e:
+            df = None
+            event(log, "frame_cache_entry_dropped", logging.WARNING, key=key, error=repr(e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return df
+
+    def put(self, key, df):
+        if self.max_bytes <= 0:
+            return
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            tmp_path = os.path.join(self.folder, f".{uuid.uuid4().hex}.tmp")
+            df.to_pickle(tmp_path)
+            os.replace(tmp_path, self._path(key))
+            self._evict()
+        except OSError as e:
+            event(log, "frame_cache_not_saved", logging.WARNING, error=str(e))
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        try:
+            entries = self._entries()
+        except OSError:
+            entries = []
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(entries),
+                "bytes": sum(size for _, size, _ in entries),
+                "maxBytes": self.max_bytes,
+                "evictions": self.evictions,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+frames = FrameCache()
+
+
+def frame_key(digest, *params):
+    return fingerprint("frame", FRAME_FORMAT_VERSION, digest, *params)
@@ -0,0 +1,395 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+from columns import ColumnMatcher, normalize_header
+from frame_cache import file_digest, frame_key, frames
+from layout_cache import HEADER_LAYOUTS_MAX, fingerprint, header_key, layout_fingerprint, layouts
+from logs import event, logger
+from readers import excel_backend, sheet_names
+from stages import stage
+
+# Header rows sit near the top of every export we receive (row 0 to 9 on the
+# files in uploads/), so detection only looks at this many leading rows.
+HEADER_SCAN_ROWS = 50
+
+CSV_OPTIONS = {"delimiter": ";", "encoding": "ISO-8859-1"}
+
+# Rows parsed per chunk when a CSV file is aggregated while it is read.
+CSV_CHUNK_ROWS = 50000
+
+# Worker processes parsing the sheets/files of one side in parallel.
+INGEST_WORKERS = int(os.environ.get("SHEETSYNC_INGEST_WORKERS", min(4, os.cpu_count() or 1)))
+
+log = logger("ingest")
+
+
+def source_name(source):
+    """File name of a path, or of an in-memory upload_store.UploadedFile."""
+    return getattr(source, "name", source)
+
+
+def open_source(source):
+    """What pandas/openpyxl read: the path itself, or a fresh buffer over an
+    in-memory upload. Each read of an upload gets its own buffer."""
+    return source.open() if hasattr(source, "open") else source
+
+
+def is_excel(file_path):
+    file_path = source_name(file_path)
+    return file_path.endswith('.xlsx') or file_path.endswith('.xls')
+
+
+def is_xlsx(file_path):
+    return source_name(file_path).endswith('.xlsx')
+
+
+def is_csv(file_path):
+    return source_name(file_path).endswith('.csv')
+
+
+def header_text(value):
+    """Uppercased, stripped text of a cell as used for header matching."""
+    return str(value).upper().strip() if pd.notna(value) else ""
+
+
+def find_header_row(rows, search_terms, max_rows=HEADER_SCAN_ROWS):
+    """Return the position of the first row that contains all search terms.
+
+    `rows` is any iterable of row value sequences (e.g. a sheet parsed with
+    header=None); only the first `max_rows` rows are inspected.
+    """
+    terms = [term.upper() for term in search_terms]
+    for idx, values in enumerate(rows):
+        if idx >= max_rows:
+            break
+        row_values = ' '.join(header_text(v) for v in values)
+        if all(term in row_values for term in terms):
+            return idx
+    return None
+
+
+def header_cells(values):
+    """Header texts of a row, without its trailing empty cells."""
+    cells = [header_text(v) for v in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return cells
+
+
+def locate_header(head, header_terms, sheet_name):
+    """Find the header row among the leading rows `head` of a sheet.
+
+    The layout cache keeps, per sheet name and search terms, the header
+    rows and cells seen before (most recent first): a sheet whose row holds
+    the same cells is recognised with one lookup and one comparison per
+    known layout, without matching the search terms. Returns (header_row,
+    layout fingerprint).
+    """
+    key = header_key(header_terms, sheet_name)
+    known = (layouts.peek(key) or {}).get("layouts", [])
+    for layout in known:
+        row = layout["headerRow"]
+        if row < len(head) and header_cells(head[row]) == layout["cells"]:
+            layouts.record("header", True)
+            return row, layout_fingerprint(header_terms, sheet_name, row, layout["cells"])
+
+    layouts.record("header", False)
+    header_row = find_header_row(head, header_terms)
+    if header_row is None:
+        raise header_not_found(header_terms)
+    cells = header_cells(head[header_row])
+    layouts.put(key, {"layouts": [{"headerRow": header_row, "cells": cells}, *known][:HEADER_LAYOUTS_MAX]})
+    return header_row, layout_fingerprint(header_terms, sheet_name, header_row, cells)
+
+
+class HeaderNotFoundError(ValueError):
+    pass
+
+
+def header_not_found(header_terms):
+    return HeaderNotFoundError(f"Could not find header row containing: {header_terms}")
+
+
+def frame_from_rows(rows, skip_blank_lines=True):
+    """Build the DataFrame read_excel would have produced from `rows`.
+
+    The first row holds the header. Values are re-typed by the same
+    TextParser that read_excel uses, so the result matches a read_excel call
+    with header= pointing at that row, without parsing the file again.
+    """
+    return TextParser(rows, header=0, skip_blank_lines=skip_blank_lines).read()
+
+
+def clean_columns(df):
+    df.columns = [str(col).strip().upper() for col in df.columns]
+    return df
+
+
+def is_empty(value):
+    return value is None or value == ""
+
+
+def keep_column(name, keep):
+    name = normalize_header(name) if pd.notna(name) else ""
+    return any(normalize_header(keyword) in name for keyword in keep)
+
+
+def stream_xlsx_columns(file_path, header_terms, keep, backend=None, sheet=None):
+    """Read only the columns of an .xlsx sheet whose header mentions one of `keep`.
+
+    The first sheet is streamed row by row from the reader backend (see
+    readers.py); cells outside the selected columns are never converted or
+    stored.
+    """
+    backend = excel_backend(backend)
+    convert_cell = backend.convert_cell
+    stage("parse")
+    with backend.open_sheet(open_source(file_path), sheet) as (sheet_name, rows):
+        head = []
+        for values in rows:
+            head.append(values)
+            if len(head) >= HEADER_SCAN_ROWS:
+                break
+        stage("header")
+        header_row, layout = locate_header(head, header_terms, sheet_name)
+        stage("parse")
+
+        header = head[header_row]
+        positions = [i for i, name in enumerate(header) if not is_empty(name) and keep_column(name, keep)]
+
+        def project(values):
+            return [convert_cell(values[i]) if i < len(values) else "" for i in positions]
+
+        data = [project(header)]
+        last_row_with_data = 0
+        for values in head[header_row + 1:]:
+            data.append(project(values))
+            if not all(is_empty(v) for v in values):
+                last_row_with_data = len(data) - 1
+        for values in rows:
+            data.append(project(values))
+            if not all(is_empty(v) for v in values):
+                last_row_with_data = len(data) - 1
+
+    # read_excel drops trailing rows that are empty in every column, but keeps
+    # rows that are only empty within the selected ones
+    df = frame_from_rows(data[:last_row_with_data + 1], skip_blank_lines=False)
+    df.attrs["layout"] = layout
+    return df
+
+
+def group_frame(df, key, how):
+    """Group `df` per `key` with the `how` (column -> function) aggregation,
+    after cleaning the key the way the services clean NCINs and coercing the
+    aggregated columns to numbers (unparsable -> 0)."""
+    df[key] = df[key].astype(str).str.strip().str.upper()
+    for col in how:
+        df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+    return df.groupby(key, sort=False).agg(how)
+
+
+def aggregate_csv(file_path, header_row, fields, group_by, agg, chunksize=CSV_CHUNK_ROWS):
+    """Read a CSV file in chunks of `chunksize` rows, already grouped per `group_by`.
+
+    `fields` (a ColumnMatcher) maps the logical fields to the file's columns;
+    only the `group_by` column and those of `agg` (field -> "sum"/"first"/...)
+    are parsed, all as strings. In each chunk the key is cleaned the way the
+    services clean NCINs, values are coerced to numbers (unparsable -> 0) and
+    grouped; the partial results are then combined with the same functions.
+    The services' own per-NCIN groupby gives the same totals on this frame
+    as on the full file. Returns None if the key column is missing.
+    """
+    names = pd.read_csv(open_source(file_path), header=header_row, nrows=0, **CSV_OPTIONS).columns
+    mapping = fields.resolve(names)
+    key = mapping[group_by]
+    if key is None:
+        return None
+    how = {mapping[name]: func for name, func in agg.items() if mapping[name] is not None and mapping[name] != key}
+    if not how:
+        return None
+
+    partials = []
+    chunks = pd.read_csv(open_source(file_path), header=header_row, usecols=[key, *how], dtype=str,
+                         chunksize=chunksize, **CSV_OPTIONS)
+    for chunk in chunks:
+        partials.append(group_frame(chunk, key, how))
+    if not partials:
+        return pd.DataFrame(columns=[key, *how])
+    df = pd.concat(partials).groupby(level=0, sort=False).agg(how)
+    return df.reset_index()[[col for col in names if col == key or col in how]]
+
+
+def parse_file_with_header(file_path, header_terms, keep=None, backend=None, group_by=None, agg=None, sheet=None):
+    """Parse file with dynamic header row detection.
+
+    `file_path` is a path or an in-memory upload (upload_store.UploadedFile).
+
+    Excel sheets are parsed once; the header is searched in the leading rows
+    and the final frame is built from that same parse. CSV files only have
+    their first rows read for detection. The fingerprint of the header row
+    is kept in df.attrs["layout"] for layout_cache.resolve_columns.
+
+    When `keep` lists header keywords (or is a columns.ColumnMatcher, whose
+    keywords are used), only the columns whose header contains one of them
+    are returned; .xlsx files are then streamed and CSV files parsed with
+    usecols, so the other columns are never materialised.
+
+    CSV files can also be pre-aggregated while read: with `keep` a
+    ColumnMatcher, `group_by` a field name and `agg` a field -> function
+    mapping, see aggregate_csv. Other formats ignore `group_by`.
+
+    Excel files are read with the reader backend named `backend`, by
+    default the one readers.excel_backend() selects, from the sheet named
+    `sheet`, by default the first one.
+    """
+    fields = keep if isinstance(keep, ColumnMatcher) else None
+    if fields is not None:
+        keep = fields.keywords
+
+    if keep and is_xlsx(file_path):
+        return clean_columns(stream_xlsx_columns(file_path, header_terms, keep, backend, sheet))
+
+    if is_excel(file_path):
+        stage("parse")
+        with excel_backend(backend).excel_file(open_source(file_path)) as xl:
+            sheet_name = xl.sheet_names[0] if sheet is None else sheet
+            raw = xl.parse(sheet_name, header=None, dtype=object)
+        stage("header")
+        head = list(raw.head(HEADER_SCAN_ROWS).itertuples(index=False, name=None))
+        header_row, layout = locate_header(head, header_terms, sheet_name)
+        stage("parse")
+        df = frame_from_rows(raw.iloc[header_row:].fillna("").values.tolist())
+    elif is_csv(file_path):
+        stage("header")
+        head = pd.read_csv(open_source(file_path), header=None, nrows=HEADER_SCAN_ROWS, dtype=str, **CSV_OPTIONS)
+        head = list(head.itertuples(index=False, name=None))
+        header_row, layout = locate_header(head, header_terms, "")
+        stage("parse")
+        df = None
+        if group_by and fields is not None:
+            df = aggregate_csv(file_path, header_row, fields, group_by, agg)
+        if df is None:
+            usecols = (lambda col: keep_column(col, keep)) if keep else None
+            df = pd.read_csv(open_source(file_path), header=header_row, usecols=usecols, low_memory=False, **CSV_OPTIONS)
+    else:
+        raise ValueError("Format de fichier non supporté")
+
+    if keep:
+        df = df[[col for col in df.columns if keep_column(col, keep)]]
+    df.attrs["layout"] = layout
+    return clean_columns(df)
+
+
+def cache_key(file_path, header_terms, keep=None, backend=None, group_by=None, agg=None, sheet=None):
+    """Frame cache key of a parse. Excel frames are keyed by the reader
+    backend too: backends type some cells differently (see readers.py), so
+    a frame parsed by one is never served to another."""
+    keywords = keep.signature if isinstance(keep, ColumnMatcher) else keep
+    digest = getattr(file_path, "digest", None) or file_digest(file_path)
+    reader = excel_backend(backend).name if is_excel(file_path) else None
+    return frame_key(digest, [term.upper() for term in header_terms], keywords, group_by, agg, sheet, reader)
+
+
+def read_file_with_header(file_path, header_terms, keep=None, backend=None, group_by=None, agg=None, sheet=None):
+    """parse_file_with_header, cached by file content (see frame_cache.py).
+
+    A workbook uploaded again, under any name, is loaded from the cache
+    instead of being parsed. The returned frame is the caller's own copy.
+    """
+    key = cache_key(file_path, header_terms, keep, backend, group_by, agg, sheet)
+    df = frames.get(key)
+    if df is None:
+        df = parse_file_with_header(file_path, header_terms, keep, backend, group_by, agg, sheet)
+        stage("read")
+        frames.put(key, df)
+    return df
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def worker_pool():
+    """Process pool shared by all requests. Workers are spawned rather than
+    forked, as the services run threads (archiving, Flask) that may hold
+    locks at fork time."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(INGEST_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def combine_parts(parts, fields, group_by=None, agg=None):
+    """Concatenate frames read from several sheets/files into one.
+
+    Each part's columns are mapped to the logical fields of `fields` (a
+    ColumnMatcher) and renamed after the first part having each field, so
+    sheets with slightly different headers line up. With `group_by`/`agg`
+    the result is aggregated per key, as aggregate_csv does.
+    """
+    if fields is None:
+        df = pd.concat(parts, ignore_index=True)
+    else:
+        mappings = [fields.resolve(part.columns) for part in parts]
+        names = {name: next((m[name] for m in mappings if m[name] is not None), None) for name in fields.fields}
+        df = pd.concat([
+            pd.DataFrame({names[name]: part[m[name]] for name in fields.fields if m[name] is not None})
+            for part, m in zip(parts, mappings)
+        ], ignore_index=True)
+        key = names.get(group_by) if group_by else None
+        how = {names[name]: func for name, func in (agg or {}).items() if names[name] is not None and names[name] != key}
+        if key is not None and how:
+            stage("groupby")
+            df = group_frame(df, key, how).reset_index()
+            stage("read")
+    df.attrs["layout"] = fingerprint("parts", [part.attrs.get("layout") for part in parts])
+    return df
+
+
+def read_files_with_header(sources, header_terms, keep=None, backend=None, group_by=None, agg=None,
+                           all_sheets=False):
+    """read_file_with_header over one or several files, and with `all_sheets`
+    over every sheet of each workbook.
+
+    With more than one file or sheet, each is parsed in a worker process and
+    the results are combined by combine_parts; sheets without the header
+    terms (e.g. summaries) are skipped. A single file and sheet is read in
+    the calling process, exactly as read_file_with_header does.
+    """
+    if not isinstance(sources, (list, tuple)):
+        sources = [sources]
+    tasks = []
+    for source in sources:
+        if all_sheets and is_excel(source):
+            names = sheet_names(open_source(source), backend, xlsx=is_xlsx(source))
+            tasks.extend((source, name) for name in names)
+        else:
+            tasks.append((source, None))
+    if len(tasks) == 1:
+        source, sheet = tasks[0]
+        return read_file_with_header(source, header_terms, keep, backend, group_by, agg, sheet)
+
+    pool = worker_pool()
+    futures = [
+        pool.submit(read_file_with_header, source, header_terms, keep, backend, group_by, agg, sheet)
+        for source, sheet in tasks
+    ]
+    parts = []
+    for (source, sheet), future in zip(tasks, futures):
+        try:
+            parts.append(future.result())
+        except HeaderNotFoundError:
+            if sheet is None:
+                raise
+            event(log, "sheet_skipped", logging.WARNING, file=source_name(source), sheet=sheet, reason="header_not_found")
+    if not parts:
+        raise header_not_found(header_terms)
+    fields = keep if isinstance(keep, ColumnMatcher) else None
+    return combine_parts(parts, fields, group_by, agg)
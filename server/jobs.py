@@ -0,0 +1,183 @@
+"""Comparisons run in the background.
+
+With mode=async in the upload form, /upload and /api/compare submit the
+comparison to a pool of JOB_WORKERS processes and answer at once (202)
+with a job id (see maybe_submit, which every company's view calls); /jobs/<id> then reports its state and stage (see
+stages.py) and, once done, the response the request would have given:
+
+    {"job": "...", "company": "cobco", "state": "running", "stage": "rules"}
+    {"job": "...", "company": "cobco", "state": "done", "stage": "results", "result": {...}, "timings": {...}}
+    {"job": "...", "company": "cobco", "state": "failed", "error": "...", "status": 500}
+
+At most JOB_QUEUE_MAX jobs wait for a worker; past that, submissions are
+refused with 503. The last JOBS_MAX finished jobs are kept.
+
+Each job is timed in its worker (see timings.py): "timings" gives the
+milliseconds spent in each stage, and the log line has the job id as
+run id, like the log line and X-Run-Id header of the request submitting
+it.
+"""
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import jsonify
+
+from ingest import INGEST_WORKERS
+from stages import Listener, identify, listening
+from timings import Timer
+
+JOB_WORKERS = int(os.environ.get("SHEETSYNC_JOB_WORKERS", INGEST_WORKERS))
+JOB_QUEUE_MAX = int(os.environ.get("SHEETSYNC_JOB_QUEUE_MAX", JOB_WORKERS * 4))
+JOBS_MAX = int(os.environ.get("SHEETSYNC_JOBS_MAX", "100"))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Progress(Listener):
+    """Writes the stage of a job to the shared dict `progress`."""
+
+    def __init__(self, job_id, progress):
+        self.job_id = job_id
+        self.progress = progress
+
+    def stage(self, name):
+        self.progress[self.job_id] = name
+
+
+def run_job(job_id, progress, company, function, args, kwargs):
+    """function(*args, **kwargs) in a worker, its stages written to
+    progress[job_id]. Returns its result and its timings."""
+    timer = Timer(company, job_id)
+    with listening(Progress(job_id, progress)), listening(timer):
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            timer.stop()
+            timer.log(status=getattr(e, "status", 500))
+            raise
+    timer.stop()
+    timer.log(status=200)
+    return result, timer.milliseconds()
+
+
+class Job:
+    def __init__(self, job_id, future, company=None):
+        self.id = job_id
+        self.future = future
+        self.company = company
+
+    def state(self):
+        if self.future.done():
+            return "failed" if self.future.exception() is not None else "done"
+        return "running" if self.future.running() else "queued"
+
+    def describe(self, stage=None):
+        """The job as /jobs/<id> reports it."""
+        state = self.state()
+        body = {"job": self.id, "company": self.company, "state": state, "stage": stage}
+        if state == "done":
+            body["result"], body["timings"] = self.future.result()
+        elif state == "failed":
+            error = self.future.exception()
+            body["error"] = str(error)
+            body["status"] = getattr(error, "status", 500)
+        return body
+
+
+class JobStore:
+    """Jobs submitted to the pool: all unfinished ones and the last
+    `max_jobs` finished."""
+
+    def __init__(self, max_jobs=JOBS_MAX, workers=JOB_WORKERS, queue_max=JOB_QUEUE_MAX):
+        self.max_jobs = max_jobs
+        self.workers = workers
+        self.queue_max = queue_max
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._progress = None
+
+    def pool(self):
+        """The worker pool, spawned on first use like ingest.worker_pool,
+        and the shared dict the workers report stages in."""
+        if self._pool is None:
+            context = multiprocessing.get_context("spawn")
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=context)
+            self._progress = context.Manager().dict()
+        return self._pool, self._progress
+
+    def submit(self, function, *args, company=None, **kwargs):
+        """Run function(*args, **kwargs) in the pool; raises QueueFull when
+        too many jobs are waiting."""
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if not job.future.done())
+            if pending >= self.workers + self.queue_max:
+                raise QueueFull()
+            pool, progress = self.pool()
+            job_id = uuid.uuid4().hex
+            future = pool.submit(run_job, job_id, progress, company, function, args, kwargs)
+            job = self._jobs[job_id] = Job(job_id, future, company)
+            self._evict()
+        return job
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.future.done()]
+        for job_id in finished[:max(0, len(finished) - self.max_jobs)]:
+            del self._jobs[job_id]
+            self._progress.pop(job_id, None)
+
+    def get(self, job_id):
+        """The job `job_id`, or None if unknown or evicted."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def describe(self, job):
+        return job.describe(self._progress.get(job.id))
+
+
+jobs = JobStore()
+
+
+def submitted(function, *args, company=None, **kwargs):
+    """The 202 response of submitting function(*args, **kwargs) as a job,
+    or 503 if the queue is full."""
+    try:
+        job = jobs.submit(function, *args, company=company, **kwargs)
+    except QueueFull:
+        return jsonify({'error': 'Trop de comparaisons en attente, réessayez plus tard'}), 503
+    identify(job.id)
+    return jsonify(jobs.describe(job)), 202
+
+
+def maybe_submit(request, function, *args, company=None, paged=True, streamed=True):
+    """With mode=async in the form of `request`, the response of submitting
+    function(*args) as a job (see submitted); None otherwise, the view then
+    compares at once. A job gives the whole result: when the view serves
+    size=N pages (`paged`) or streams format=ndjson (`streamed`), asking for
+    them with mode=async is refused with 400."""
+    if request.form.get('mode') != 'async':
+        return None
+    if (paged and request.form.get('size', type=int)) or (streamed and request.form.get('format') == 'ndjson'):
+        refused = [option for option, served in (("size", paged), ("format=ndjson", streamed)) if served]
+        refused = "ni " + " ni ".join(refused) if len(refused) > 1 else "pas " + refused[0]
+        return jsonify({'error': f"Le mode asynchrone n'accepte {refused}"}), 400
+    return submitted(function, *args, company=company)
+
+
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Comparaison introuvable ou expirée'}), 404
+    return jsonify(jobs.describe(job)), 200
+
+
+def add_job_routes(app):
+    """Serve /jobs/<id> on `app`."""
+    app.add_url_rule('/jobs/<job_id>', 'job_status', job_status, methods=['GET'])
+    return app
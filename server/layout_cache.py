@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from logs import event, logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+CACHE_FOLDER = 'cache'
+LAYOUT_CACHE_PATH = os.path.join(CACHE_FOLDER, 'layouts.json')
+LAYOUT_CACHE_SIZE = 512
+# Header layouts remembered per sheet name and search terms
+HEADER_LAYOUTS_MAX = 8
+
+log = logger("cache")
+
+
+def fingerprint(*parts):
+    """Stable hash of JSON-serialisable parts."""
+    payload = json.dumps(parts, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class LayoutCache:
+    """Persistent, size-bounded LRU map from layout fingerprints to what was
+    resolved for them (header row, logical field -> column mapping).
+
+    Entries are kept in a JSON file so repeat layouts are recognised across
+    restarts. Each save merges the entries other processes saved meanwhile,
+    under a lock file where fcntl is available, so processes sharing the
+    file do not drop each other's entries. Hits and misses are counted per
+    kind of lookup.
+    """
+
+    def __init__(self, path=LAYOUT_CACHE_PATH, max_entries=LAYOUT_CACHE_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _read(self):
+        """The entries saved in the file, oldest first."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            return OrderedDict()
+
+    def _trim(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self):
+        self._entries = self._read()
+        self._trim()
+        self.evictions = 0
+
+    def _save(self, changed):
+        """Write the entries, with those saved by other processes since
+        they were read; the `changed` keys are put last, most recent."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self._read()
+            entries.update(self._entries)
+            for key in changed:
+                entries.move_to_end(key)
+            self._entries = entries
+            self._trim()
+            tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(self._entries.items()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def peek(self, key):
+        """Return the entry for `key` without touching the counters."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def record(self, kind, hit):
+        with self._lock:
+            if hit:
+                self.hits[kind] += 1
+            else:
+                self.misses[kind] += 1
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._trim()
+            try:
+                self._save([key])
+            except OSError as e:
+                event(log, "layout_cache_not_saved", logging.WARNING, error=str(e))
+
+    def stats(self):
+        with self._lock:
+            kinds = sorted(set(self.hits) | set(self.misses))
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "evictions": self.evictions,
+                "hits": {kind: self.hits[kind] for kind in kinds},
+                "misses": {kind: self.misses[kind] for kind in kinds},
+            }
+
+
+layouts = LayoutCache()
+
+
+def header_key(header_terms, sheet_name):
+    """Key of the header layouts seen for `sheet_name` with `header_terms`."""
+    return fingerprint("header", [term.upper() for term in header_terms], sheet_name)
+
+
+def layout_fingerprint(header_terms, sheet_name, row_index, cells):
+    """Fingerprint of a header layout: sheet name, header row and cells,
+    column count."""
+    return fingerprint("layout", [term.upper() for term in header_terms], sheet_name, len(cells), row_index, cells)
+
+
+def columns_key(layout, role, matcher):
+    return fingerprint("columns", layout, role, matcher.signature)
+
+
+def resolve_columns(df, role, matcher):
+    """Return matcher.resolve(df.columns) (a logical field -> column mapping),
+    cached per layout.
+
+    `df` must come from ingest.read_file_with_header, which records the
+    fingerprint of its header row in df.attrs["layout"]. `role` names the
+    side being resolved (e.g. "scif.pointage"); `matcher` is a
+    columns.ColumnMatcher, whose signature is part of the key so editing a
+    field table drops the mappings cached for it.
+    """
+    layout = df.attrs.get("layout")
+    if layout is None:
+        return matcher.resolve(df.columns)
+
+    key = columns_key(layout, role, matcher)
+    entry = layouts.peek(key)
+    if entry is not None and all(col is None or col in df.columns for col in entry["columns"].values()):
+        layouts.record("columns", True)
+        return entry["columns"]
+
+    layouts.record("columns", False)
+    mapping = matcher.resolve(df.columns)
+    layouts.put(key, {"columns": mapping})
+    return mapping
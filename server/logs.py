@@ -0,0 +1,46 @@
+"""Structured logs of the services.
+
+Every "sheetsync.<name>" logger writes one JSON line per event to stderr,
+with the id of the comparison being served when there is one (see
+stages.run_id):
+
+    {"event": "columns", "run": "...", "company": "scif", "pointage": [...], "paie": [...]}
+
+SHEETSYNC_LOG_LEVEL sets the level, INFO by default: DEBUG adds the
+columns read from each file, which the services used to print.
+"""
+import json
+import logging
+import os
+
+from responses import dumps
+from stages import run_id
+
+LOG_LEVEL = os.environ.get("SHEETSYNC_LOG_LEVEL", "INFO").upper()
+
+_root = logging.getLogger("sheetsync")
+if not _root.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    _root.addHandler(_handler)
+    _root.setLevel(LOG_LEVEL)
+    _root.propagate = False
+
+
+def logger(name):
+    """The logger "sheetsync.<name>"."""
+    return logging.getLogger(f"sheetsync.{name}")
+
+
+def event(log, name, level=logging.INFO, /, **fields):
+    """Write the event `name` and its `fields` on `log` as one JSON line."""
+    if not log.isEnabledFor(level):
+        return
+    record = {"event": name, "run": run_id(), **fields}
+    if record["run"] is None:
+        del record["run"]
+    try:
+        line = dumps(record).decode()
+    except TypeError:
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True, default=str)
+    log.log(level, line)
@@ -1,38 +1,69 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
+import logging
 from io import BytesIO
+from readers import read_excel
+from reconcile import add_merged_validations, merged_records, merged_summary
 from datetime import datetime
-
+from responses import RequestError, ndjson, record_chunks, use_fast_json
+from jobs import add_job_routes, maybe_submit
+from stages import count, stage
+from timings import timed, with_timings
+from logs import event, logger
+from metrics import add_metrics
+
+log = logger("novometal")
 app = Flask(__name__)
 CORS(app)
+use_fast_json(app)
+add_job_routes(app)
 
 @app.route('/api/compare', methods=['POST'])
+@timed("novometal")
 def compare():
-    try:
-        if 'timesheet' not in request.files or 'payroll' not in request.files:
-            return jsonify({
-                'error': 'Les deux fichiers sont requis'
-            }), 400
-        timesheet_file = request.files['timesheet']
-        payroll_file = request.files['payroll']
+    if 'timesheet' not in request.files or 'payroll' not in request.files:
+        return jsonify({'error': 'Les deux fichiers sont requis'}), 400
+    timesheet_data = request.files['timesheet'].read()
+    payroll_data = request.files['payroll'].read()
+    # format=ndjson: le résumé, puis une ligne par employé, envoyées au fil de l'eau
+    response_format = request.form.get('format', 'rows')
+
+    # mode=async: comparaison dans le pool de jobs, suivie sur /jobs/<id> (voir jobs.py)
+    submission = maybe_submit(request, compare_files, timesheet_data, payroll_data, company="novometal", paged=False)
+    if submission is not None:
+        return submission
 
+    try:
+        results = compare_files(timesheet_data, payroll_data, response_format)
+    except RequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    stage("serialize")
+    # timings=1: durée de chaque étape jusqu'ici (voir timings.py)
+    if response_format == 'ndjson':
+        return ndjson(with_timings({'status': results['status'], 'summary': results['summary']}), results['data'])
+    return jsonify(with_timings(results))
+
+def compare_files(timesheet_data, payroll_data, response_format="rows"):
+    """Comparaison des contenus des deux fichiers; RequestError avec le code HTTP en cas d'erreur."""
+    try:
+        stage("parse")
         # Lire les fichiers Excel avec pandas
         try:
             # Lire le fichier de pointage
-            timesheet_df = pd.read_excel(BytesIO(timesheet_file.read()))
+            timesheet_df = read_excel(BytesIO(timesheet_data))
 
             # Lire le fichier de journal de paie 
-            payroll_df = pd.read_excel(BytesIO(payroll_file.read()), skiprows=9)  # Ignorer les premières lignes
+            payroll_df = read_excel(BytesIO(payroll_data), skiprows=9)  # Ignorer les premières lignes
         except Exception as e:
-            print("Erreur de lecture des fichiers Excel:", str(e))
-            return jsonify({
-                'error': 'Erreur de lecture des fichiers Excel. Vérifiez le format des fichiers.'
-            }), 400
+            event(log, "read_failed", logging.WARNING, company="novometal", error=str(e))
+            raise RequestError('Erreur de lecture des fichiers Excel. Vérifiez le format des fichiers.')
+        count(pointage=len(timesheet_df), paie=len(payroll_df))
+        stage("map")
 
-        # Afficher les colonnes pour déboguer
-        print("Colonnes du fichier de pointage :", timesheet_df.columns.tolist())
-        print("Colonnes du fichier de paie :", payroll_df.columns.tolist())
+        # Colonnes lues, journalisées au niveau debug (voir logs.py)
+        event(log, "columns", logging.DEBUG, company="novometal", pointage=timesheet_df.columns.tolist(),
+              paie=payroll_df.columns.tolist())
 
         # Vérifier si les colonnes AMO, CNSS et Date d'Embauche existent dans le journal de paie
         amo_col = next((col for col in payroll_df.columns if "AMO" in str(col).upper()), None)
@@ -87,10 +118,9 @@ def compare():
 
         except KeyError as e:
             missing_column = str(e).strip("'")
-            return jsonify({
-                'error': f'Colonne manquante: {missing_column}'
-            }), 400
+            raise RequestError(f'Colonne manquante: {missing_column}')
 
+        stage("merge")
         # Fusionner les DataFrames
         merged_df = pd.merge(
             timesheet_mapped,
@@ -118,86 +148,36 @@ def compare():
                                      (merged_df['statusPayroll'] == 'Employé absent dans journal de paie')
 
         # Combine status information
-        merged_df['status'] = merged_df.apply(lambda row: 
-            f"{row['statusTimesheet']}, {row['statusPayroll']}" 
-            if row['statusTimesheet'] != row['statusPayroll'] 
-            else row['statusTimesheet'], 
-            axis=1)
+        merged_df['status'] = merged_df['statusTimesheet'].where(
+            merged_df['statusTimesheet'] == merged_df['statusPayroll'],
+            merged_df['statusTimesheet'] + ", " + merged_df['statusPayroll'])
 
         # Filtrer les résultats finaux pour exclure les Matricules vides/NAN
         merged_df = merged_df[merged_df['employeeId'].astype(str).str.strip() != '']
         merged_df = merged_df[~merged_df['employeeId'].astype(str).str.upper().str.contains('NAN')]
 
         # Ajouter les validations de paie (AMO, CNSS, date d'embauche)
-        def add_paie_validations(row):
-            paie_validations = {}
-            
-            # AMO & CNSS Check
-            amo_cnss_check = {"status": "Valid"}  # Default to Valid
-            if 'amo' in row and 'cnss' in row:
-                amo = float(row['amo']) if pd.notna(row['amo']) else 0
-                cnss = float(row['cnss']) if pd.notna(row['cnss']) else 0
-                
-                amo_cnss_check = {
-                    "amo": amo,
-                    "cnss": cnss,
-                    "status": "Valid" if amo > 0 and cnss > 0 else "Employé non déclaré"
-                }
-            paie_validations["amoCnssCheck"] = amo_cnss_check
-            
-            # Date d'Embauche Check with updated contract duration logic (matching port 8002)
-            embauche_date_check = {"status": "Valid"}  # Default to Valid
-            if 'dateEmbauche' in row:
-                date_embauche = row['dateEmbauche']
-                if pd.notna(date_embauche) and isinstance(date_embauche, pd.Timestamp):
-                    today = pd.to_datetime('today')
-                    anciennete_days = (today - date_embauche).days
-                    anciennete_months = anciennete_days / 30  # Match port 8002 calculation
-                    
-                    embauche_date_check = {
-                        "dateEmbauche": date_embauche.strftime('%Y-%m-%d'),  # Use ISO format
-                        "anciennete": f"{anciennete_months:.1f} mois",
-                        # Updated logic to match port 8002: "Fin de Contrat" if > 5 months
-                        "status": "Fin de Contrat" if anciennete_months > 5 else "Valide"
-                    }
-                else:
-                    embauche_date_check = {
-                        "dateEmbauche": "Non spécifiée",
-                        "anciennete": "Non calculée",
-                        "status": "Non vérifié"
-                    }
-            paie_validations["embaucheDateCheck"] = embauche_date_check
-            
-            return paie_validations
-        
-        # Appliquer les validations de paie à chaque ligne
-        merged_df['paieValidations'] = merged_df.apply(add_paie_validations, axis=1)
-
-        # Convertir en liste de dictionnaires
-        results = merged_df.to_dict('records')
-
-        # Ajouter un résumé des résultats
-        summary = {
-            "total": len(results),
-            "correct": sum(1 for r in results if not r["hasIncoherence"]),
-            "inconsistencies": sum(1 for r in results if r["hasIncoherence"]),
-            "employeesNotDeclared": sum(1 for r in results if 'paieValidations' in r and 
-                                      r['paieValidations']['amoCnssCheck']['status'] == "Employé non déclaré"),
-            "contractEnding": sum(1 for r in results if 'paieValidations' in r and 
-                                r['paieValidations']['embaucheDateCheck']['status'] == "Fin de Contrat")
-        }
-
-        return jsonify({
-            'status': 'success',
-            'data': results,
-            'summary': summary
-        })
-
+        count(results=len(merged_df))
+        stage("validations")
+        merged_df = add_merged_validations(merged_df)
+
+        # Résumé des résultats
+        stage("summary")
+        summary = merged_summary(merged_df)
+
+        stage("results")
+        # format=ndjson: les résultats construits par paquets pendant l'envoi
+        if response_format == 'ndjson':
+            return {'status': 'success', 'data': record_chunks(merged_df, merged_records), 'summary': summary}
+        return {'status': 'success', 'data': merged_records(merged_df), 'summary': summary}
+
+    except RequestError:
+        raise
     except Exception as e:
-        print(f"Erreur: {str(e)}")
-        return jsonify({
-            'error': f'Erreur lors du traitement des fichiers: {str(e)}'
-        }), 500
+        event(log, "failed", logging.ERROR, company="novometal", error=str(e))
+        raise RequestError(f'Erreur lors du traitement des fichiers: {str(e)}', 500) from e
+
+add_metrics(app, "novometal")
 
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
\ No newline at end of file
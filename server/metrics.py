@@ -0,0 +1,274 @@
+"""Request metrics in the Prometheus text format.
+
+add_metrics(app, company) wraps the /upload, /api/compare and /test views
+of `app` and serves /metrics, which a local collector can scrape:
+
+    sheetsync_request_duration_seconds       latency histogram per endpoint and company
+    sheetsync_requests_total                 requests per endpoint, company and status
+    sheetsync_requests_in_flight             requests being served
+    sheetsync_upload_bytes                   histogram of the size of upload requests
+    sheetsync_rows_parsed_total              rows read from the uploaded files
+    sheetsync_rows_per_second                rows read per second spent reading them
+    sheetsync_request_peak_rss_growth_bytes  how much each request raised the peak RSS
+    sheetsync_compare_slot_wait_seconds      time waiting for a comparison slot (service.py)
+    sheetsync_cache_*                        frame and layout cache hits, misses, hit ratio
+    process_resident_memory_bytes            current RSS
+    process_peak_resident_memory_bytes       peak RSS since the process started
+
+Rows and reading time come from the stages of the request (see stages.py):
+the rows counted for the files and the time in "read", "header" and
+"parse". NDJSON bodies are measured once they have been sent.
+
+The peak RSS of the process is read from /proc/self/status (VmHWM), or
+ru_maxrss where /proc is not available, and never reset: resetting it
+(/proc/self/clear_refs) would race with the other requests in flight.
+Each request observes how much it grew between the start and the end of
+the request, 0 when it stayed under the peak already reached; requests
+running at the same time may each be charged with the same growth.
+
+Metrics are kept per process: with service.py, one /metrics covers every
+company. Cache lookups made in ingest worker processes are not counted.
+"""
+import sys
+import threading
+import time
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from frame_cache import frames
+from layout_cache import layouts
+from stages import listening
+from timings import Timer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Routes add_metrics measures
+OBSERVED_ROUTES = ("/upload", "/api/compare", "/test")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (10e3, 50e3, 100e3, 500e3, 1e6, 5e6, 10e6, 50e6, 100e6)
+ROWS_RATE_BUCKETS = (1e2, 1e3, 5e3, 1e4, 5e4, 1e5, 5e5, 1e6)
+RSS_GROWTH_BUCKETS = (0, 1e6, 4e6, 16e6, 64e6, 128e6, 256e6, 512e6, 1e9, 2e9)
+
+# Stages whose time counts as reading the files
+READ_STAGES = ("read", "header", "parse")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_lock = threading.Lock()
+registry = []
+
+
+def label_text(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{label_text(self.labels, key)} {number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """For totals counted elsewhere (e.g. cache hits)."""
+        with _lock:
+            self.values[self.key(labels)] = value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with _lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = label_text(self.labels + ("le",), key + (number(bound),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = label_text(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {number(total)}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+request_duration = Histogram("sheetsync_request_duration_seconds", "Time to serve a request.",
+                             ("endpoint", "company"))
+requests_total = Counter("sheetsync_requests_total", "Requests served.", ("endpoint", "company", "status"))
+in_flight = Gauge("sheetsync_requests_in_flight", "Requests being served.", ("endpoint", "company"))
+upload_bytes = Histogram("sheetsync_upload_bytes", "Size of upload requests in bytes.",
+                         ("endpoint", "company"), BYTES_BUCKETS)
+rows_parsed = Counter("sheetsync_rows_parsed_total", "Rows read from uploaded files.", ("company",))
+rows_rate = Histogram("sheetsync_rows_per_second", "Rows read per second spent reading files.",
+                      ("company",), ROWS_RATE_BUCKETS)
+peak_rss_growth = Histogram("sheetsync_request_peak_rss_growth_bytes",
+                            "Growth of the peak resident memory of the process while serving a request.",
+                            ("endpoint", "company"), RSS_GROWTH_BUCKETS)
+cache_hits = Counter("sheetsync_cache_hits_total", "Cache lookups that hit.", ("cache",))
+cache_misses = Counter("sheetsync_cache_misses_total", "Cache lookups that missed.", ("cache",))
+cache_ratio = Gauge("sheetsync_cache_hit_ratio", "Share of cache lookups that hit.", ("cache",))
+resident = Gauge("process_resident_memory_bytes", "Resident memory of the process.")
+peak_resident = Gauge("process_peak_resident_memory_bytes", "Peak resident memory of the process.")
+# Observed by service.in_slot, before the measured view runs: the latency
+# above does not include it.
+slot_wait = Histogram("sheetsync_compare_slot_wait_seconds", "Time waiting for a comparison slot.", ("company",))
+
+
+def proc_status(field):
+    """A memory field of /proc/self/status in bytes, or None."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    """Peak RSS of the process, or None if unknown."""
+    peak = proc_status("VmHWM")
+    if peak is None and resource is not None:
+        # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak *= 1 if sys.platform == "darwin" else 1024
+    return peak
+
+
+def observe_caches():
+    """Copy the cache counters into their metrics."""
+    stats = frames.stats()
+    caches = {"frames": (stats["hits"], stats["misses"])}
+    stats = layouts.stats()
+    for kind in stats["hits"]:
+        caches[f"layouts.{kind}"] = (stats["hits"][kind], stats["misses"][kind])
+    for cache, (hits, misses) in caches.items():
+        cache_hits.set(hits, cache=cache)
+        cache_misses.set(misses, cache=cache)
+        cache_ratio.set(hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+
+
+def render():
+    observe_caches()
+    rss = proc_status("VmRSS")
+    if rss is not None:
+        resident.set(rss)
+    peak = peak_rss_bytes()
+    if peak is not None:
+        peak_resident.set(peak)
+    lines = []
+    for metric in registry:
+        with _lock:
+            lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def metrics():
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+def observed(view, endpoint, company=None):
+    """`view`, measured as `endpoint` of `company`."""
+    labels = {"endpoint": endpoint, "company": company or ""}
+
+    @wraps(view)
+    def run(*args, **kwargs):
+        in_flight.inc(**labels)
+        if request.method == "POST" and request.content_length:
+            upload_bytes.observe(request.content_length, **labels)
+        started = time.perf_counter()
+        peak_before = peak_rss_bytes()
+        timer = Timer(company)
+
+        def finish(status):
+            request_duration.observe(time.perf_counter() - started, **labels)
+            requests_total.inc(status=status, **labels)
+            if peak_before is not None:
+                peak_rss_growth.observe(peak_rss_bytes() - peak_before, **labels)
+            rows = sum(count for name, count in timer.rows.items() if name != "results")
+            if rows:
+                rows_parsed.inc(rows, company=labels["company"])
+                seconds = sum(timer.milliseconds().get(name, 0) for name in READ_STAGES) / 1000
+                if seconds > 0:
+                    rows_rate.observe(rows / seconds, company=labels["company"])
+            in_flight.dec(**labels)
+
+        try:
+            with listening(timer):
+                response = make_response(view(*args, **kwargs))
+        except Exception:
+            finish(500)
+            raise
+        if response.is_streamed:
+            response.call_on_close(lambda: finish(response.status_code))
+        else:
+            finish(response.status_code)
+        return response
+    return run
+
+
+def add_metrics(app, company=None):
+    """Measure the OBSERVED_ROUTES of `app` as `company`'s and serve
+    /metrics on it. Call it once all the routes are defined."""
+    for rule in app.url_map.iter_rules():
+        if rule.rule in OBSERVED_ROUTES:
+            app.view_functions[rule.endpoint] = observed(app.view_functions[rule.endpoint], rule.rule, company)
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
+    return app
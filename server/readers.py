@@ -0,0 +1,160 @@
+"""Spreadsheet reader backends.
+
+Every Excel read of the services goes through the backend returned by
+excel_backend(): calamine (python-calamine) when it is installed, openpyxl
+otherwise. Set SHEETSYNC_EXCEL_BACKEND to force one, and use
+`python bench.py backends` to compare them on the files in uploads/.
+"""
+import importlib.util
+import os
+import zipfile
+from contextlib import contextmanager
+from datetime import date, timedelta
+from xml.etree import ElementTree
+
+import numpy as np
+import pandas as pd
+
+# Tried in this order when SHEETSYNC_EXCEL_BACKEND is not set.
+BACKEND_PREFERENCE = ["calamine", "openpyxl"]
+
+
+class ExcelBackend:
+    """One way of reading workbooks.
+
+    `engine` is the pandas read_excel engine, used for the formats listed in
+    `formats`; other files are left to pandas' own engine choice.
+    `open_sheet(source, sheet=None)` (a path or a binary buffer) is a context
+    manager giving the name and a row iterator of the sheet named `sheet`, by
+    default the first worksheet, for ingest.stream_xlsx_columns; the raw
+    cell values are turned into what read_excel would hold by `convert_cell`.
+    """
+
+    def __init__(self, name, module, formats, open_sheet, convert_cell):
+        self.name = name
+        self.module = module
+        self.engine = name
+        self.formats = formats
+        self.open_sheet = open_sheet
+        self.convert_cell = convert_cell
+
+    def available(self):
+        return importlib.util.find_spec(self.module) is not None
+
+    def engine_for(self, source):
+        if isinstance(source, str) and not source.endswith(self.formats):
+            return None
+        return self.engine
+
+    def read_excel(self, source, **kwargs):
+        return pd.read_excel(source, engine=self.engine_for(source), **kwargs)
+
+    def excel_file(self, source):
+        return pd.ExcelFile(source, engine=self.engine_for(source))
+
+
+EXCEL_BACKENDS = {}
+
+
+def register_backend(backend):
+    EXCEL_BACKENDS[backend.name] = backend
+    return backend
+
+
+def available_backends():
+    return [name for name, backend in EXCEL_BACKENDS.items() if backend.available()]
+
+
+def excel_backend(name=None):
+    """Backend called `name`, else SHEETSYNC_EXCEL_BACKEND, else the first
+    installed one of BACKEND_PREFERENCE."""
+    name = name or os.environ.get("SHEETSYNC_EXCEL_BACKEND")
+    if name:
+        backend = EXCEL_BACKENDS.get(name)
+        if backend is None or not backend.available():
+            raise ValueError(f"Moteur de lecture Excel indisponible: {name}")
+        return backend
+    for name in BACKEND_PREFERENCE:
+        if EXCEL_BACKENDS[name].available():
+            return EXCEL_BACKENDS[name]
+    raise ValueError("Aucun moteur de lecture Excel installé")
+
+
+def read_excel(source, backend=None, **kwargs):
+    """pd.read_excel through the selected backend."""
+    return excel_backend(backend).read_excel(source, **kwargs)
+
+
+def sheet_names(source, backend=None, xlsx=False):
+    """Names of the sheets of a workbook, in order.
+
+    For .xlsx files (`xlsx`) they are read from xl/workbook.xml alone, which
+    avoids loading the stylesheet and shared strings of the workbook.
+    """
+    if xlsx:
+        with zipfile.ZipFile(source) as archive:
+            root = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        return [el.get('name') for el in root.iter() if el.tag.endswith('}sheet')]
+    with excel_backend(backend).excel_file(source) as xl:
+        return xl.sheet_names
+
+
+@contextmanager
+def openpyxl_sheet(source, sheet=None):
+    from openpyxl import load_workbook
+
+    wb = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0] if sheet is None else wb[sheet]
+        ws.reset_dimensions()
+        yield ws.title, ws.iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def convert_openpyxl_cell(value):
+    """Mirror pandas' openpyxl cell conversion for values_only rows."""
+    from openpyxl.cell.cell import ERROR_CODES
+
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value in ERROR_CODES:
+        return np.nan
+    return value
+
+
+@contextmanager
+def calamine_sheet(source, sheet=None):
+    from python_calamine import SheetTypeEnum, load_workbook
+
+    wb = load_workbook(source)
+    try:
+        name = sheet or next(s.name for s in wb.sheets_metadata if s.typ == SheetTypeEnum.WorkSheet)
+        rows = wb.get_sheet_by_name(name).to_python(skip_empty_area=False)
+        yield name, iter(rows)
+    finally:
+        if hasattr(wb, "close"):
+            wb.close()
+
+
+def convert_calamine_cell(value):
+    """Mirror pandas' calamine cell conversion."""
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    if isinstance(value, date):
+        return pd.Timestamp(value)
+    if isinstance(value, timedelta):
+        return pd.Timedelta(value)
+    return value
+
+
+register_backend(ExcelBackend(
+    "calamine", "python_calamine", (".xlsx", ".xlsm", ".xlsb", ".xls", ".ods"),
+    calamine_sheet, convert_calamine_cell,
+))
+register_backend(ExcelBackend(
+    "openpyxl", "openpyxl", (".xlsx", ".xlsm"),
+    openpyxl_sheet, convert_openpyxl_cell,
+))
@@ -0,0 +1,294 @@
+"""Column-wise building blocks of the compare_files reconciliations.
+
+Every status, message and validation of a comparison is computed on whole
+columns of the merged frame; rows only become Python dicts in records(),
+when the response is built. Cell values are taken with Series.tolist(), so
+they are the same Python objects iterrows() used to give.
+"""
+import numpy as np
+import pandas as pd
+
+# Two amounts match when they differ by no more than this.
+TOLERANCE = 0.01
+
+INVALID_CINS = ['', 'NAN', 'N/A']
+
+# paieValidations of main.py and sbbc.py: check -> key -> column of their
+# merged frame (see add_merged_validations)
+MERGED_VALIDATIONS = {
+    "amoCnssCheck": {key: f"amoCnssCheck.{key}" for key in ("amo", "cnss", "status")},
+    "embaucheDateCheck": {key: f"embaucheDateCheck.{key}" for key in ("dateEmbauche", "anciennete", "status")},
+}
+
+
+def outer_merge(left, right, flags, on="CIN"):
+    """pd.merge(left, right, on=on, how="outer").fillna(0), plus two boolean
+    columns named by `flags` telling whether each row's key is in `left`
+    and in `right`.
+
+    They come from the merge indicator, so knowing which file an employee
+    is in costs nothing once the frames are joined.
+    """
+    df = pd.merge(left, right, on=on, how="outer", indicator=True)
+    side = df.pop("_merge")
+    df = df.fillna(0)
+    df[flags[0]] = (side != "right_only").to_numpy()
+    df[flags[1]] = (side != "left_only").to_numpy()
+    return df
+
+
+def known_cin(cins):
+    """Mask of the CINs that are set (not empty, "NAN" or "N/A")."""
+    return (cins.notna() & ~cins.astype(str).str.strip().isin(INVALID_CINS)).to_numpy()
+
+
+def values(df, col):
+    """Cells of `col` as Python values."""
+    return df[col].tolist()
+
+
+def flags(mask):
+    """"Incohérence" where `mask` is set, "Correct" elsewhere."""
+    return np.where(mask, "Incohérence", "Correct").tolist()
+
+
+def pick(mask, chosen, other):
+    """`chosen[i]` where `mask` is set, `other` elsewhere."""
+    return [value if flag else other for value, flag in zip(chosen, mask)]
+
+
+def messages(mask, template, **columns):
+    """`template` formatted with the values of `columns` ({name}) on the rows
+    of `mask`, None on the others.
+
+    Only the flagged rows' values are turned into Python objects; a column
+    is a list, an array or a Series.
+    """
+    out = [None] * len(mask)
+    for i, cells in flagged(mask, columns):
+        out[i] = template.format(**cells)
+    return out
+
+
+def coded(mask, code, **columns):
+    """[code, values of `columns`...] on the rows of `mask`, None on the
+    others: messages() without the formatting, see rules.RuleProfile.render."""
+    out = [None] * len(mask)
+    for i, cells in flagged(mask, columns):
+        out[i] = [code, *cells.values()]
+    return out
+
+
+def flagged(mask, columns):
+    """(row, {name: value}) of the rows of `mask`."""
+    rows = np.flatnonzero(mask)
+    if not len(rows):
+        return []
+    picked = {name: taken(column, rows) for name, column in columns.items()}
+    return [(i, {name: cells[n] for name, cells in picked.items()}) for n, i in enumerate(rows)]
+
+
+def taken(column, rows):
+    """The cells of `column` at the positions `rows`, as Python values."""
+    if isinstance(column, list):
+        return [column[i] for i in rows]
+    return np.asarray(column)[rows].tolist()
+
+
+def collect(size, *columns):
+    """Per-row lists of the messages of `columns` that are not None, in order."""
+    if not columns:
+        return [[] for _ in range(size)]
+    return [[m for m in row if m is not None] for row in zip(*columns)]
+
+
+def records(columns):
+    """One dict per row from a mapping of result keys to per-row values."""
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+def optional_values(df, fields):
+    """{result key: values} of the `fields` ({result key: column}) present in `df`."""
+    return {key: values(df, col) for key, col in fields.items() if col in df.columns}
+
+
+def embauche_check(value, today):
+    """Contract duration check of one DATE_EMBAUCHE cell."""
+    try:
+        date_embauche = pd.to_datetime(value)
+        anciennete = (today - date_embauche).days / 30  # Convert to months
+        return {
+            "dateEmbauche": date_embauche.strftime('%Y-%m-%d') if not pd.isna(date_embauche) else "Non spécifiée",
+            "anciennete": f"{anciennete:.1f} mois",
+            "status": "Fin de Contrat" if anciennete > 5 else "Valide"
+        }
+    except Exception as e:
+        return {
+            "dateEmbauche": "Format invalide",
+            "anciennete": "Non calculée",
+            "status": "Non vérifié",
+            "error": str(e)
+        }
+
+
+def embauche_columns(col, today):
+    """embauche_check() of every cell of `col`, as columns (see
+    paie_validation_columns); cells that are not dates go through
+    embauche_check itself."""
+    present = col.notna().to_numpy()
+    dates = pd.to_datetime(col, errors="coerce")
+    parsed = dates.notna().to_numpy()
+    months = ((today - dates).dt.days / 30).tolist()
+    checks = {
+        "dateEmbauche": pick(parsed, dates.dt.strftime('%Y-%m-%d').tolist(), None),
+        "anciennete": [f"{anciennete:.1f} mois" if is_date else None for anciennete, is_date in zip(months, parsed)],
+        "status": np.select([~present, np.array(months) > 5], ["Valid", "Fin de Contrat"], "Valide").tolist(),
+        "error": [None] * len(col),
+    }
+    cells = col.tolist()
+    for i in np.flatnonzero(present & ~parsed):
+        check = embauche_check(cells[i], today)
+        for key, column in checks.items():
+            column[i] = check.get(key)
+    return checks
+
+
+def paie_validation_columns(df, today=None):
+    """paieValidations as columns, {check: {key: per-row values}}: AMO &
+    CNSS declared, and contract duration from the hiring date (over 5
+    months: "Fin de Contrat"). A row whose check has no such key has None."""
+    today = pd.to_datetime('today') if today is None else today
+    if "AMO" in df.columns and "CNSS" in df.columns:
+        amo = df["AMO"].astype(float).fillna(0)
+        cnss = df["CNSS"].astype(float).fillna(0)
+        amo_cnss = {
+            "amo": amo.tolist(),
+            "cnss": cnss.tolist(),
+            "status": np.where((amo > 0) & (cnss > 0), "Valid", "Employé non déclaré").tolist(),
+        }
+    else:
+        amo_cnss = {"status": ["Valid"] * len(df)}
+    if "DATE_EMBAUCHE" in df.columns:
+        embauche = embauche_columns(df["DATE_EMBAUCHE"], today)
+    else:
+        embauche = {"status": ["Valid"] * len(df)}
+    return {"amoCnssCheck": amo_cnss, "embaucheDateCheck": embauche}
+
+
+def paie_validations(df, today=None):
+    """paieValidations of each row (see paie_validation_columns)."""
+    return validation_rows(paie_validation_columns(df, today))
+
+
+def validation_rows(checks):
+    """One paieValidations dict per row from paie_validation_columns()."""
+    per_check = [set_values(columns) for columns in checks.values()]
+    return [dict(zip(checks, row)) for row in zip(*per_check)]
+
+
+def set_values(columns):
+    """records() of `columns`, without the keys whose value is None."""
+    keys = list(columns)
+    return [{key: value for key, value in zip(keys, cells) if value is not None} for cells in zip(*columns.values())]
+
+
+def date_values(col):
+    """DATE_EMBAUCHE cells for the response: dates as 'YYYY-MM-DD', other
+    values as they are."""
+    text = pd.to_datetime(col, errors="coerce").dt.strftime('%Y-%m-%d').tolist()
+    return [t if isinstance(v, pd.Timestamp) else v for v, t in zip(col.tolist(), text)]
+
+
+def status_totals(status, **columns):
+    """Per distinct value of `status`, in order of first appearance,
+    {"count": rows, name: sum of `columns[name]` over those rows, ...}:
+    one bincount per column over the status codes. Boolean columns are
+    counted."""
+    codes, statuses = pd.factorize(pd.Series(status, dtype=object))
+    size = len(statuses)
+    sums = {"count": np.bincount(codes, minlength=size).tolist()}
+    for name, cells in columns.items():
+        cells = np.asarray(cells)
+        if cells.dtype == bool:
+            sums[name] = np.bincount(codes[cells], minlength=size).tolist()
+        else:
+            sums[name] = np.bincount(codes, weights=cells.astype(float), minlength=size).tolist()
+    return {value: {name: column[i] for name, column in sums.items()} for i, value in enumerate(statuses.tolist())}
+
+
+def add_merged_validations(merged_df, today=None):
+    """The merged frame of main.py or sbbc.py with its paieValidations
+    added as the flat columns of MERGED_VALIDATIONS (None where a check has
+    no such key): AMO & CNSS declared, and contract duration against one
+    reference date, `today` (over 5 months: "Fin de Contrat"). They are
+    nested into each result by merged_records()."""
+    today = pd.Timestamp('today') if today is None else today
+    columns = {check: dict.fromkeys(fields.values()) for check, fields in MERGED_VALIDATIONS.items()}
+    amo_cnss = MERGED_VALIDATIONS["amoCnssCheck"]
+    if 'amo' in merged_df.columns and 'cnss' in merged_df.columns:
+        amo = merged_df['amo'].astype(float).fillna(0)
+        cnss = merged_df['cnss'].astype(float).fillna(0)
+        columns["amoCnssCheck"].update({
+            amo_cnss["amo"]: amo,
+            amo_cnss["cnss"]: cnss,
+            amo_cnss["status"]: np.where((amo > 0) & (cnss > 0), "Valid", "Employé non déclaré"),
+        })
+    else:
+        columns["amoCnssCheck"][amo_cnss["status"]] = "Valid"
+    embauche = MERGED_VALIDATIONS["embaucheDateCheck"]
+    if 'dateEmbauche' in merged_df.columns:
+        dates = pd.to_datetime(merged_df['dateEmbauche'], errors='coerce')
+        dated = dates.notna().to_numpy()
+        months = (today - dates).dt.days / 30
+        columns["embaucheDateCheck"].update({
+            embauche["dateEmbauche"]: np.where(dated, dates.dt.strftime('%Y-%m-%d'), "Non spécifiée"),
+            embauche["anciennete"]: np.where(dated, months.map("{:.1f} mois".format), "Non calculée"),
+            embauche["status"]: np.select([~dated, months > 5], ["Non vérifié", "Fin de Contrat"], "Valide"),
+        })
+    else:
+        columns["embaucheDateCheck"][embauche["status"]] = "Valid"
+    return merged_df.assign(**{column: cells for fields in columns.values() for column, cells in fields.items()})
+
+
+def merged_records(df):
+    """df.to_dict('records'), the MERGED_VALIDATIONS columns nested into each
+    record's paieValidations."""
+    flat = [column for fields in MERGED_VALIDATIONS.values() for column in fields.values()]
+    records = df.drop(columns=flat).to_dict('records')
+    checks = {check: {key: df[column].tolist() for key, column in fields.items()} for check, fields in MERGED_VALIDATIONS.items()}
+    for record, validations in zip(records, validation_rows(checks)):
+        record['paieValidations'] = validations
+    return records
+
+
+def merged_summary(merged_df):
+    """Summary of the /api/compare results of main.py and sbbc.py, from
+    their merged frame: the counts of rows with and without incoherence,
+    of undeclared employees and of ending contracts, and byStatus, the
+    count and hours of each status (see status_totals)."""
+    hours = {"hoursWorked": "hoursWorked", "hoursPaid": "hoursPaid", "hoursDelta": "difference"}
+    by_status = status_totals(
+        merged_df['status'],
+        **{key: merged_df[column] for key, column in hours.items()},
+        inconsistencies=merged_df['hasIncoherence'],
+        employeesNotDeclared=merged_df[MERGED_VALIDATIONS["amoCnssCheck"]["status"]].eq("Employé non déclaré"),
+        contractEnding=merged_df[MERGED_VALIDATIONS["embaucheDateCheck"]["status"]].eq("Fin de Contrat"),
+    )
+    totals = {key: sum(sums[key] for sums in by_status.values()) for key in next(iter(by_status.values()), {})}
+    return {
+        "total": len(merged_df),
+        "correct": len(merged_df) - totals.get("inconsistencies", 0),
+        "inconsistencies": totals.get("inconsistencies", 0),
+        "employeesNotDeclared": totals.get("employeesNotDeclared", 0),
+        "contractEnding": totals.get("contractEnding", 0),
+        "byStatus": {status: {key: sums[key] for key in ["count", *hours]} for status, sums in by_status.items()},
+        **{key: totals.get(key, 0) for key in hours},
+    }
+
+
+def encoded(cells):
+    """Dictionary encoding of `cells`: {"values": the distinct values,
+    "codes": per row, the index of its value in "values" (-1: None)}."""
+    codes, distinct = pd.factorize(pd.Series(cells, dtype=object))
+    return {"values": distinct.tolist(), "codes": codes.tolist()}
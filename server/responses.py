@@ -0,0 +1,96 @@
+"""JSON responses of every service, encoded with orjson.
+
+use_fast_json(app) replaces the app's JSON provider, so jsonify() and
+request.get_json() go through orjson. It encodes numpy arrays and scalars
+and datetimes natively and sends NaN as null; pandas values are handled
+by default(): Timestamps in ISO format, NaT as null. Flask's own encoder
+sent dates as HTTP dates, NaN as an invalid NaN literal, and failed on
+NaT.
+
+ndjson() streams a response as newline-delimited JSON: a header line (the
+summary), then one line per result, encoded chunk by chunk while the
+response is sent, so the whole document is never held in memory.
+"""
+import numpy as np
+import orjson
+import pandas as pd
+from flask import Response
+from flask.json.provider import JSONProvider
+
+# Results encoded per chunk of an NDJSON response
+NDJSON_CHUNK_ROWS = 1000
+
+# Keys are sorted as Flask's encoder did.
+JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+
+
+def default(value):
+    """JSON value of what orjson does not encode by itself."""
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (pd.Series, pd.Index)):
+        return value.tolist()
+    if isinstance(value, pd.DataFrame):
+        return value.to_dict("records")
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type non sérialisable en JSON: {type(value).__name__}")
+
+
+def dumps(obj):
+    """`obj` as JSON bytes."""
+    return orjson.dumps(obj, default=default, option=JSON_OPTIONS)
+
+
+class RequestError(Exception):
+    """Error answered to the client with its own HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+    def __reduce__(self):
+        # Keeps the status when raised in a job worker (see jobs.py)
+        return RequestError, (str(self), self.status)
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider on orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype="application/json")
+
+
+def use_fast_json(app):
+    """Encode `app`'s JSON with orjson."""
+    app.json = OrjsonProvider(app)
+    return app
+
+
+def ndjson(header, chunks):
+    """application/x-ndjson response: `header` on the first line, then one
+    line per result of each list of `chunks`, encoded as they come."""
+    def lines():
+        yield dumps(header) + b"\n"
+        for results in chunks:
+            yield b"".join(dumps(result) + b"\n" for result in results)
+    return Response(lines(), mimetype="application/x-ndjson")
+
+
+def record_chunks(df, records=None, size=NDJSON_CHUNK_ROWS):
+    """records(rows), df.to_dict('records') by default, of `size` rows of
+    `df` at a time."""
+    for start in range(0, len(df), size):
+        rows = df.iloc[start:start + size]
+        yield rows.to_dict('records') if records is None else records(rows)
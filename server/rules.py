@@ -0,0 +1,294 @@
+"""Declarative payroll-vs-pointage checks.
+
+A company's comparison is a RuleProfile: how absent employees are found,
+how the prime de rendement is computed, and a list of rule()s, each
+comparing two columns of the merged frame. evaluate() turns every rule
+into one boolean mask over the frame and builds the results from the masks
+(see reconcile.py), so adding a check costs one pass over two columns.
+
+Each inconsistency has a code. evaluate(df, codes=True) gives each result
+a list of issues, [code, operands...], instead of formatted messages;
+render() turns them into the messages, e.g. for the rows on screen only.
+
+columns() gives the results as one list per result key, before evaluate()
+turns them into one dict per employee; columnar() is the same columns with
+the statuses dictionary-encoded, for format=columnar responses, and
+row_chunks() the dicts a chunk at a time, for format=ndjson.
+
+summary() counts the statuses of columns() and sums the hours and primes
+of each status in one grouped aggregation.
+"""
+from string import Formatter
+
+import numpy as np
+
+from reconcile import (
+    TOLERANCE, coded, collect, date_values, encoded, flags, known_cin, messages, optional_values,
+    paie_validation_columns, pick, records, status_totals, validation_rows, values,
+)
+
+# Results built per chunk by row_chunks()
+CHUNK_ROWS = 1000
+
+ABSENT_POINTAGE = "Employé absent dans pointage"
+ABSENT_PAIE = "Employé absent dans journal de paie"
+STATUSES = ("Correct", "Incohérence", ABSENT_POINTAGE, ABSENT_PAIE)
+
+# Summed per status by summary(): summary key -> result key
+STATUS_TOTALS = {
+    "hoursWorked": "heuresTravaillees",
+    "hoursPaid": "heuresPayees",
+    "hoursDelta": "difference",
+    "primeRendement": "primeRendement",
+}
+
+
+def template_fields(template):
+    """Names of the fields of `template`, in order, each once."""
+    return list(dict.fromkeys(name for _, name, _, _ in Formatter().parse(template) if name))
+
+
+def subset(columns, rows):
+    """columns() restricted to `rows`, a slice or a list of row indexes."""
+    def cut(cells):
+        return cells[rows] if isinstance(rows, slice) else [cells[i] for i in rows]
+    out = {key: cut(cells) for key, cells in columns.items() if key != "paieValidations"}
+    out["paieValidations"] = {
+        check: {key: cut(cells) for key, cells in fields.items()}
+        for check, fields in columns["paieValidations"].items()
+    }
+    return out
+
+
+def rule(left, right, message=None, left_only=None, right_only=None, status=None, tolerance=TOLERANCE,
+         check="equal", only_if=None, employees="all", one_sided="inconsistent", code=None):
+    """One check comparing the columns `left` and `right` of the merged frame.
+
+    check: "equal" flags the rows where they differ by more than
+        `tolerance`, "at_least" those where `left` is below `right` by
+        more than `tolerance`.
+    message: inconsistency added to a flagged row, formatted with {left},
+        {right}, {gap} (absolute difference) and {prime}; None adds none.
+    left_only, right_only: when only that column exists, the rows where it
+        is positive are flagged with this message ({value}); None skips the
+        rule unless both columns exist.
+    one_sided: "inconsistent" if one-sided findings make the row an
+        Incohérence like the others, "flag" if they only set `status`.
+    status: result key of the rule's own "Correct"/"Incohérence" flag.
+    only_if: column that must be positive for a row to be checked.
+    employees: "all", or "both" to check only employees found in both files.
+    code: issue code of `message` (default: `status` without "Status");
+        `left_only` and `right_only` use code + ":left_only" / ":right_only".
+    """
+    if code is None and status:
+        code = status[:-len("Status")] if status.endswith("Status") else status
+    if code is None and (message or left_only or right_only):
+        raise ValueError(f"Règle {left} / {right}: code manquant")
+    return {
+        "code": code,
+        "left": left,
+        "right": right,
+        "message": message,
+        "left_only": left_only,
+        "right_only": right_only,
+        "status": status,
+        "tolerance": tolerance,
+        "check": check,
+        "only_if": only_if,
+        "employees": employees,
+        "one_sided": one_sided,
+    }
+
+
+class RuleProfile:
+    """The checks of one company, evaluated on the frame compare_files
+    builds: CIN, Heures_Pointage, Heures_Paie and Écart, the columns the
+    rules name, and IN_PAIE / IN_POINTAGE (see reconcile.outer_merge).
+
+    presence: "merge" (an employee is absent from a file the merge
+        indicator does not find it in) or "hours" (absent from the file
+        where its hours are 0 while positive in the other).
+    absent_prefix: put before the absence messages.
+    prime: the prime de rendement, worked minus paid hours, is given when
+        it is above prime["above"], to every employee or, with
+        prime["employees"] == "both", only to those in both files.
+    fields: {result key: column} copied into each result when present.
+    """
+
+    def __init__(self, rules, presence="merge", absent_prefix="", prime=None, fields=None):
+        self.rules = rules
+        self.presence = presence
+        self.absent_prefix = absent_prefix
+        self.prime = prime or {"above": TOLERANCE, "employees": "both"}
+        self.fields = fields or {}
+        # Issue code -> message template
+        self.templates = {
+            "absent_pointage": absent_prefix + ABSENT_POINTAGE,
+            "absent_paie": absent_prefix + ABSENT_PAIE,
+        }
+        for spec in rules:
+            for suffix, key in (("", "message"), (":left_only", "left_only"), (":right_only", "right_only")):
+                if spec[key]:
+                    self.templates[spec["code"] + suffix] = spec[key]
+        self.operands = {code: template_fields(template) for code, template in self.templates.items()}
+
+    def render(self, issues):
+        """The messages of a result's issues (see evaluate)."""
+        return [
+            self.templates[code].format(**dict(zip(self.operands[code], operands)))
+            for code, *operands in issues
+        ]
+
+    def found(self, mask, code, fields, codes):
+        """Messages, or issues with `codes`, of the rows of `mask`."""
+        if codes:
+            return coded(mask, code, **{name: fields[name] for name in self.operands[code]})
+        return messages(mask, self.templates[code], **fields)
+
+    def absent(self, df, pointage, paie):
+        if self.presence == "hours":
+            return (pointage == 0) & (paie > 0), (pointage > 0) & (paie == 0)
+        in_pointage = df["IN_POINTAGE"].to_numpy()
+        in_paie = df["IN_PAIE"].to_numpy()
+        return ~in_pointage & in_paie, in_pointage & ~in_paie
+
+    def check(self, spec, df, both, prime, codes=False):
+        """(flagged, makes the row inconsistent, messages or issues) of one rule."""
+        left, right = spec["left"], spec["right"]
+        none = np.zeros(len(df), dtype=bool)
+        one_sided = False
+        if left in df.columns and right in df.columns:
+            a, b = df[left].to_numpy(), df[right].to_numpy()
+            gap = np.abs(a - b)
+            mask = (b - a > spec["tolerance"]) if spec["check"] == "at_least" else (gap > spec["tolerance"])
+            template, code = spec["message"], spec["code"]
+            fields = {"left": a, "right": b, "gap": gap, "prime": prime}
+        elif left in df.columns and spec["left_only"]:
+            mask = (df[left] > 0).to_numpy()
+            template, code = spec["left_only"], spec["code"] + ":left_only"
+            fields, one_sided = {"value": df[left]}, True
+        elif right in df.columns and spec["right_only"]:
+            mask = (df[right] > 0).to_numpy()
+            template, code = spec["right_only"], spec["code"] + ":right_only"
+            fields, one_sided = {"value": df[right]}, True
+        else:
+            return none, none, [None] * len(df)
+        if spec["only_if"]:
+            mask = mask & (df[spec["only_if"]] > 0).to_numpy()
+        if spec["employees"] == "both":
+            mask = mask & both
+        inconsistent = none if one_sided and spec["one_sided"] == "flag" else mask
+        found = self.found(mask, code, fields, codes) if template else [None] * len(df)
+        return mask, inconsistent, found
+
+    def evaluate(self, df_comparaison, today=None, codes=False):
+        """One result per employee of the merged frame. Its inconsistencies
+        are messages, or with `codes` "issues" to render()."""
+        return self.rows(self.columns(df_comparaison, today, codes))
+
+    def rows(self, columns):
+        """One result dict per employee from columns()."""
+        return records({**columns, "paieValidations": validation_rows(columns["paieValidations"])})
+
+    def row_chunks(self, columns, size=CHUNK_ROWS):
+        """rows() of `columns`, `size` results at a time."""
+        for start in range(0, len(columns["status"]), size):
+            yield self.rows(subset(columns, slice(start, start + size)))
+
+    def columnar(self, columns):
+        """columns() with every status dictionary-encoded (see
+        reconcile.encoded), paieValidations included."""
+        out = dict(columns)
+        for key in ["status"] + [spec["status"] for spec in self.rules if spec["status"]]:
+            out[key] = encoded(columns[key])
+        out["paieValidations"] = {
+            check: {key: encoded(cells) if key == "status" else cells for key, cells in fields.items()}
+            for check, fields in columns["paieValidations"].items()
+        }
+        return out
+
+    def summary(self, columns):
+        """Summary of the results in `columns`.
+
+        total, correct and inconsistencies; totalPrimeRendement, summed
+        row by row in result order as before (0 when there are no rows);
+        <code>Inconsistencies per rule with a status; employeesNotDeclared
+        and contractEnding from the paieValidations; byStatus, the count,
+        hours and prime of each of STATUSES (see reconcile.status_totals),
+        and the same hour totals over all employees.
+        """
+        by_status = status_totals(columns["status"], **{key: columns[column] for key, column in STATUS_TOTALS.items()})
+        by_status = {
+            status: {key: by_status.get(status, {}).get(key, 0) for key in ["count", *STATUS_TOTALS]}
+            for status in STATUSES
+        }
+        totals = {key: sum(sums[key] for sums in by_status.values()) for key in STATUS_TOTALS if key != "primeRendement"}
+        correct = by_status["Correct"]["count"]
+        checks = columns["paieValidations"]
+        return {
+            "total": len(columns["status"]),
+            "correct": correct,
+            "inconsistencies": len(columns["status"]) - correct,
+            "totalPrimeRendement": sum(columns["primeRendement"]),
+            **{
+                f"{spec['status'][:-len('Status')]}Inconsistencies": columns[spec["status"]].count("Incohérence")
+                for spec in self.rules if spec["status"]
+            },
+            "employeesNotDeclared": checks["amoCnssCheck"]["status"].count("Employé non déclaré"),
+            "contractEnding": checks["embaucheDateCheck"]["status"].count("Fin de Contrat"),
+            "byStatus": by_status,
+            **totals,
+        }
+
+    def columns(self, df_comparaison, today=None, codes=False):
+        """The results of evaluate() as {result key: per-employee values};
+        paieValidations is in paie_validation_columns() form."""
+        # Skip rows with empty/NaN CIN values in the final results
+        df = df_comparaison[known_cin(df_comparaison["CIN"])]
+        pointage = df["Heures_Pointage"].to_numpy()
+        paie = df["Heures_Paie"].to_numpy()
+        absent_pointage, absent_paie = self.absent(df, pointage, paie)
+        both = ~(absent_pointage | absent_paie)
+
+        difference = pointage - paie
+        granted = difference > self.prime["above"]
+        if self.prime["employees"] == "both":
+            granted = granted & both
+        prime = pick(granted, difference.tolist(), 0)
+
+        inconsistent = np.zeros(len(df), dtype=bool)
+        statuses = {}
+        found = []
+        for spec in self.rules:
+            mask, makes_inconsistent, rule_messages = self.check(spec, df, both, prime, codes)
+            inconsistent |= makes_inconsistent
+            if spec["status"]:
+                statuses[spec["status"]] = flags(mask)
+            found.append(rule_messages)
+
+        status = np.select(
+            [absent_pointage, absent_paie, inconsistent],
+            [ABSENT_POINTAGE, ABSENT_PAIE, "Incohérence"],
+            "Correct",
+        )
+        columns = {
+            "CIN": values(df, "CIN"),
+            "heuresTravaillees": pointage.tolist(),
+            "heuresPayees": paie.tolist(),
+            "difference": values(df, "Écart"),
+            "status": status.tolist(),
+            "primeRendement": prime,
+            **statuses,
+            "issues" if codes else "inconsistencies": collect(
+                len(df),
+                self.found(absent_pointage, "absent_pointage", {}, codes),
+                self.found(absent_paie, "absent_paie", {}, codes),
+                *found,
+            ),
+            "paieValidations": paie_validation_columns(df, today),
+        }
+        # Add optional fields if they exist in the dataframe
+        columns.update(optional_values(df, self.fields))
+        if "DATE_EMBAUCHE" in df.columns:
+            columns["dateEmbauche"] = date_values(df["DATE_EMBAUCHE"])
+        return columns
@@ -0,0 +1,160 @@
+"""Comparison runs kept server-side for paginated browsing.
+
+With size=N in the upload form, compare_files stores its results column by
+column (see rules.RuleProfile.columns) under a run id and returns the
+summary with the first page only; /runs/<id>/results serves the others:
+
+    /runs/<id>/results?page=0&size=50&status=Incohérence&sort=-difference
+
+Each run keeps the rows of each status, computed when it is stored, and
+one sort order per key and direction, computed the first time it is asked
+for; a filtered page sorts only the rows of its status by their position
+in that order. A page costs a few array operations on at most the rows it
+filters on, plus building its own rows. Messages are rendered for the rows
+of the page only.
+"""
+import math
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from flask import jsonify, request
+
+from rules import subset
+from stages import identify
+
+RUNS_MAX = int(os.environ.get("SHEETSYNC_RUNS_MAX", "20"))
+PAGE_SIZE = 50
+PAGE_SIZE_MAX = 1000
+
+# Result keys pages can be sorted on ("-key": descending)
+SORT_KEYS = ("CIN", "heuresTravaillees", "heuresPayees", "difference", "primeRendement", "status")
+
+
+class Run:
+    """The results of one comparison.
+
+    `columns` come from RuleProfile.columns(); with `render`, their issues
+    are rendered into inconsistencies for each page.
+    """
+
+    def __init__(self, profile, columns, summary, company=None, render=True):
+        self.id = uuid.uuid4().hex
+        self.profile = profile
+        self.columns = columns
+        self.summary = summary
+        self.company = company
+        self.render = render
+        self.size = len(columns["status"])
+        codes, statuses = pd.factorize(pd.Series(columns["status"], dtype=object))
+        # Status -> its row indexes, in file order (rows without one, code
+        # -1, sort first and are dropped)
+        counts = np.bincount(codes + 1, minlength=len(statuses) + 1)
+        groups = np.split(np.argsort(codes, kind="stable"), np.cumsum(counts)[:-1])
+        self.status_rows = dict(zip(statuses.tolist(), groups[1:]))
+        self._orders = {}
+        self._lock = threading.Lock()
+
+    def order(self, key, descending=False):
+        """(row indexes sorted on `key`, position of each row in them), ties
+        in file order whichever the direction."""
+        with self._lock:
+            order = self._orders.get((key, descending))
+            if order is None:
+                cells = pd.Series(self.columns[key])
+                if cells.dtype == object:
+                    cells = cells.astype(str)
+                if descending:
+                    cells = -cells.rank(method="dense")
+                rows = np.argsort(cells.to_numpy(), kind="stable")
+                positions = np.empty(self.size, dtype=np.intp)
+                positions[rows] = np.arange(self.size)
+                order = self._orders[(key, descending)] = (rows, positions)
+            return order
+
+    def page(self, page=0, size=PAGE_SIZE, status=None, sort=None):
+        """One page of results, filtered on `status` and sorted on `sort`.
+        `size` must be at least 1; above PAGE_SIZE_MAX, pages have
+        PAGE_SIZE_MAX rows and "size" says so."""
+        if page < 0 or size < 1:
+            raise ValueError('Paramètres de page invalides')
+        size = min(size, PAGE_SIZE_MAX)
+        if status:
+            rows = self.status_rows.get(status, np.empty(0, dtype=np.intp))
+        else:
+            rows = np.arange(self.size)
+        if sort:
+            order, positions = self.order(sort.lstrip("-"), sort.startswith("-"))
+            rows = rows[np.argsort(positions[rows])] if status else order
+        picked = rows[page * size:(page + 1) * size].tolist()
+        return {
+            "page": page,
+            "size": size,
+            "total": len(rows),
+            "pages": math.ceil(len(rows) / size),
+            "results": self.rows(picked),
+        }
+
+    def rows(self, picked):
+        """The result dicts of the rows `picked`."""
+        results = self.profile.rows(subset(self.columns, picked))
+        if self.render:
+            for result in results:
+                if "issues" in result:
+                    result["inconsistencies"] = self.profile.render(result.pop("issues"))
+        return results
+
+
+class RunStore:
+    """The last `max_runs` runs, in memory."""
+
+    def __init__(self, max_runs=RUNS_MAX):
+        self.max_runs = max_runs
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, profile, columns, summary, company=None, render=True):
+        run = Run(profile, columns, summary, company, render)
+        with self._lock:
+            self._runs[run.id] = run
+            while len(self._runs) > self.max_runs:
+                self._runs.popitem(last=False)
+        identify(run.id)
+        return run
+
+    def get(self, run_id):
+        """The run `run_id`, or None if unknown or evicted."""
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None:
+                self._runs.move_to_end(run_id)
+            return run
+
+
+runs = RunStore()
+
+
+def run_results(run_id):
+    run = runs.get(run_id)
+    if run is None:
+        return jsonify({'error': 'Résultats introuvables ou expirés'}), 404
+    try:
+        page = int(request.args.get('page', 0))
+        size = int(request.args.get('size', PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Paramètres de page invalides'}), 400
+    if page < 0 or size < 1:
+        return jsonify({'error': 'Paramètres de page invalides'}), 400
+    sort = request.args.get('sort')
+    if sort and sort.lstrip('-') not in SORT_KEYS:
+        return jsonify({'error': f"Tri impossible sur: {sort}"}), 400
+    return jsonify({"run": run.id, **run.page(page, size, request.args.get('status'), sort)}), 200
+
+
+def add_run_routes(app):
+    """Serve /runs/<id>/results on `app`."""
+    app.add_url_rule('/runs/<run_id>/results', 'run_results', run_results, methods=['GET'])
+    return app
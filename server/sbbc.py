@@ -1,43 +1,78 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
+import logging
 from io import BytesIO
+from readers import read_excel
+from reconcile import add_merged_validations, merged_records, merged_summary
 from datetime import datetime
-
+from responses import RequestError, ndjson, record_chunks, use_fast_json
+from jobs import add_job_routes, maybe_submit
+from stages import count, stage
+from timings import timed, with_timings
+from logs import event, logger
+from metrics import add_metrics
+
+log = logger("sbbc")
 app = Flask(__name__)
 CORS(app)
+use_fast_json(app)
+add_job_routes(app)
 
 @app.route('/api/compare', methods=['POST'])
+@timed("sbbc")
 def compare():
-    try:
-        if 'timesheet' not in request.files or 'payroll' not in request.files:
-            return jsonify({'error': 'Les deux fichiers sont requis'}), 400
-
-        timesheet_file = request.files['timesheet']
-        payroll_file = request.files['payroll']
+    if 'timesheet' not in request.files or 'payroll' not in request.files:
+        return jsonify({'error': 'Les deux fichiers sont requis'}), 400
+    timesheet_data = request.files['timesheet'].read()
+    payroll_data = request.files['payroll'].read()
+    # format=ndjson: le résumé, puis une ligne par employé, envoyées au fil de l'eau
+    response_format = request.form.get('format', 'rows')
+
+    # mode=async: comparaison dans le pool de jobs, suivie sur /jobs/<id> (voir jobs.py)
+    submission = maybe_submit(request, compare_files, timesheet_data, payroll_data, company="sbbc", paged=False)
+    if submission is not None:
+        return submission
 
+    try:
+        results = compare_files(timesheet_data, payroll_data, response_format)
+    except RequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    stage("serialize")
+    # timings=1: durée de chaque étape jusqu'ici (voir timings.py)
+    if response_format == 'ndjson':
+        return ndjson(with_timings({'status': results['status'], 'summary': results['summary']}), results['data'])
+    return jsonify(with_timings(results))
+
+def compare_files(timesheet_data, payroll_data, response_format="rows"):
+    """Comparaison des contenus des deux fichiers; RequestError avec le code HTTP en cas d'erreur."""
+    try:
+        stage("parse")
         try:
-            timesheet_df = pd.read_excel(BytesIO(timesheet_file.read()))
-            payroll_df = pd.read_excel(BytesIO(payroll_file.read()), skiprows=9)
+            timesheet_df = read_excel(BytesIO(timesheet_data))
+            payroll_df = read_excel(BytesIO(payroll_data), skiprows=9)
         except Exception as e:
-            print("Erreur de lecture des fichiers Excel:", str(e))
-            return jsonify({'error': 'Erreur de lecture des fichiers Excel. Vérifiez le format des fichiers.'}), 400
+            event(log, "read_failed", logging.WARNING, company="sbbc", error=str(e))
+            raise RequestError('Erreur de lecture des fichiers Excel. Vérifiez le format des fichiers.')
+        count(pointage=len(timesheet_df), paie=len(payroll_df))
+        stage("map")
 
-        print("Colonnes du fichier de pointage :", timesheet_df.columns.tolist())
-        print("Colonnes du fichier de paie :", payroll_df.columns.tolist())
+        # Colonnes lues, journalisées au niveau debug (voir logs.py)
+        event(log, "columns", logging.DEBUG, company="sbbc", pointage=timesheet_df.columns.tolist(),
+              paie=payroll_df.columns.tolist())
 
         if 'NCIN' not in timesheet_df.columns or 'NCIN' not in payroll_df.columns:
-            return jsonify({'error': 'La colonne NCIN est requise dans les deux fichiers.'}), 400
+            raise RequestError('La colonne NCIN est requise dans les deux fichiers.')
 
         # Trouver la colonne "Total des heures"
         total_hours_col = next((col for col in timesheet_df.columns if "total" in col.lower() and "heure" in col.lower()), None)
         if not total_hours_col:
-            return jsonify({'error': 'La colonne contenant "Total des heures" est introuvable dans le fichier de pointage.'}), 400
+            raise RequestError('La colonne contenant "Total des heures" est introuvable dans le fichier de pointage.')
 
         # Trouver les colonnes nécessaires dans le journal de paie
         jrs_hrs_col = next((col for col in payroll_df.columns if "jrs" in col.lower() and "hrs" in col.lower()), None)
         if not jrs_hrs_col:
-            return jsonify({'error': 'La colonne "Jrs/Hrs" est introuvable dans le journal de paie.'}), 400
+            raise RequestError('La colonne "Jrs/Hrs" est introuvable dans le journal de paie.')
 
         # Trouver les colonnes HS 25 et HS 50
         hs25_col = next((col for col in payroll_df.columns if "hs" in str(col).lower() and "25" in str(col)), None)
@@ -86,6 +121,7 @@ def compare():
 
         payroll_mapped.loc[payroll_mapped['hoursPaid'] == 0, 'statusPayroll'] = 'Employé absent dans journal de paie'
 
+        stage("merge")
         merged_df = pd.merge(timesheet_mapped, payroll_mapped, on='employeeId', how='outer', indicator=True)
 
         merged_df.loc[merged_df['_merge'] == 'left_only', 'statusPayroll'] = 'Employé absent dans journal de paie'
@@ -103,72 +139,33 @@ def compare():
             (merged_df['statusPayroll'] == 'Employé absent dans journal de paie')
         )
 
-        merged_df['status'] = merged_df.apply(lambda row:
-            f"{row['statusTimesheet']}, {row['statusPayroll']}" if row['statusTimesheet'] != row['statusPayroll']
-            else row['statusTimesheet'], axis=1)
+        merged_df['status'] = merged_df['statusTimesheet'].where(
+            merged_df['statusTimesheet'] == merged_df['statusPayroll'],
+            merged_df['statusTimesheet'] + ", " + merged_df['statusPayroll'])
 
         merged_df = merged_df[merged_df['employeeId'].astype(str).str.strip() != '']
         merged_df = merged_df[~merged_df['employeeId'].astype(str).str.upper().str.contains('NAN')]
 
-        def add_paie_validations(row):
-            paie_validations = {}
-
-            amo_cnss_check = {"status": "Valid"}
-            if 'amo' in row and 'cnss' in row:
-                amo = float(row['amo']) if pd.notna(row['amo']) else 0
-                cnss = float(row['cnss']) if pd.notna(row['cnss']) else 0
-                amo_cnss_check = {
-                    "amo": amo,
-                    "cnss": cnss,
-                    "status": "Valid" if amo > 0 and cnss > 0 else "Employé non déclaré"
-                }
-            paie_validations["amoCnssCheck"] = amo_cnss_check
-
-            embauche_date_check = {"status": "Valid"}
-            if 'dateEmbauche' in row:
-                date_embauche = row['dateEmbauche']
-                if pd.notna(date_embauche) and isinstance(date_embauche, pd.Timestamp):
-                    today = pd.to_datetime('today')
-                    anciennete_days = (today - date_embauche).days
-                    anciennete_months = anciennete_days / 30
-                    embauche_date_check = {
-                        "dateEmbauche": date_embauche.strftime('%Y-%m-%d'),
-                        "anciennete": f"{anciennete_months:.1f} mois",
-                        "status": "Fin de Contrat" if anciennete_months > 5 else "Valide"
-                    }
-                else:
-                    embauche_date_check = {
-                        "dateEmbauche": "Non spécifiée",
-                        "anciennete": "Non calculée",
-                        "status": "Non vérifié"
-                    }
-            paie_validations["embaucheDateCheck"] = embauche_date_check
-
-            return paie_validations
-
-        merged_df['paieValidations'] = merged_df.apply(add_paie_validations, axis=1)
-
-        results = merged_df.to_dict('records')
-
-        summary = {
-            "total": len(results),
-            "correct": sum(1 for r in results if not r["hasIncoherence"]),
-            "inconsistencies": sum(1 for r in results if r["hasIncoherence"]),
-            "employeesNotDeclared": sum(1 for r in results if 'paieValidations' in r and
-                                        r['paieValidations']['amoCnssCheck']['status'] == "Employé non déclaré"),
-            "contractEnding": sum(1 for r in results if 'paieValidations' in r and
-                                  r['paieValidations']['embaucheDateCheck']['status'] == "Fin de Contrat")
-        }
-
-        return jsonify({
-            'status': 'success',
-            'data': results,
-            'summary': summary
-        })
+        count(results=len(merged_df))
+        stage("validations")
+        merged_df = add_merged_validations(merged_df)
+
+        stage("summary")
+        summary = merged_summary(merged_df)
 
+        stage("results")
+        # format=ndjson: les résultats construits par paquets pendant l'envoi
+        if response_format == 'ndjson':
+            return {'status': 'success', 'data': record_chunks(merged_df, merged_records), 'summary': summary}
+        return {'status': 'success', 'data': merged_records(merged_df), 'summary': summary}
+
+    except RequestError:
+        raise
     except Exception as e:
-        print(f"Erreur: {str(e)}")
-        return jsonify({'error': f'Erreur lors du traitement des fichiers: {str(e)}'}), 500
+        event(log, "failed", logging.ERROR, company="sbbc", error=str(e))
+        raise RequestError(f'Erreur lors du traitement des fichiers: {str(e)}', 500) from e
+
+add_metrics(app, "sbbc")
 
 if __name__ == '__main__':
     app.run(debug=True, port=8004)
\ No newline at end of file
@@ -1,162 +1,184 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pandas as pd
+import logging
 import os
-from werkzeug.utils import secure_filename
+from ingest import read_files_with_header
+from layout_cache import resolve_columns
+from upload_store import uploads
+from rules import RuleProfile, rule
+from columns import ColumnMatcher, field, NCIN, HS25, FERIE, AMO, CNSS, DATE_EMBAUCHE
+from responses import ndjson, use_fast_json
+from runs import add_run_routes, runs
+from jobs import add_job_routes, maybe_submit
+from stages import count, stage
+from timings import timed, with_timings
+from logs import event, logger
+from metrics import add_metrics
 
+log = logger("scif")
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+use_fast_json(app)
+add_run_routes(app)
+add_job_routes(app)
 
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Fields compare_files reads from each file (see columns.py). Columns none
+# of them can match are skipped while the workbooks are read.
+POINTAGE_FIELDS = ColumnMatcher({
+    "CIN": NCIN,
+    "NORMAL": field("NORMAL"),
+    "TAUX_HORAIRE": field(("TAUX", "HORA")),
+    "FERIE": FERIE,
+    "PCT25": field("25%"),
+})
+# How compare_files aggregates the pointage per employee; CSV pointage files
+# are aggregated this way while they are read.
+POINTAGE_TOTALS = {"NORMAL": "sum", "TAUX_HORAIRE": "first", "FERIE": "sum", "PCT25": "sum"}
+PAIE_FIELDS = ColumnMatcher({
+    "NCIN": NCIN,
+    "JRS/HRS": field("JRS", "HRS"),
+    "SALAIRE": field("SALAIRE"),
+    "FERIE": FERIE,
+    "HS25": HS25,
+    "MT_HS25": field("MT HS 25"),
+    "AMO": AMO,
+    "CNSS": CNSS,
+    "DATE_EMBAUCHE": DATE_EMBAUCHE,
+})
+# What compare_files checks on the merged frame (see rules.py). scif has no
+# presence flags: an employee is absent from the file where it has no hours.
+COMPARISON_RULES = RuleProfile(
+    [
+        # Hours comparison: worked hours beyond the paid ones are Prime de
+        # Rendement, fewer are an inconsistency
+        rule("Heures_Pointage", "Heures_Paie", check="at_least", employees="both"),
+        # TAUX Horaire vs Salaire comparison - They should be exactly equal
+        rule("TAUX_HORAIRE", "Salaire_Paie", "TAUX Horaire ({left}) ≠ Salaire ({right}) - Devraient être identiques",
+             status="tauxSalaireStatus"),
+        # Férié and 25% only turn a correct status into an inconsistency when
+        # both files have the column
+        rule("FERIE_POINTAGE", "FERIE_PAIE", "Férié Pointage ({left}) ≠ Férié Paie ({right})",
+             left_only="Férié Pointage ({value}) mais absent dans Paie",
+             right_only="Férié Paie ({value}) mais absent dans Pointage",
+             status="ferieStatus", one_sided="flag"),
+        rule("PCT25_POINTAGE", "HS25_PAIE", "25% Pointage ({left}) ≠ HS 25 Paie ({right})",
+             left_only="25% Pointage ({value}) mais absent dans Paie",
+             right_only="HS 25 Paie ({value}) mais absent dans Pointage",
+             status="pct25Status", one_sided="flag"),
+        # MT HS 25 calculation check
+        rule("MT_HS25_PAIE", "MT_HS25_EXPECTED", "MT HS 25 ({left}) ≠ HS 25 * TAUX * 1.25 ({right})",
+             status="mtHs25Status", only_if="HS25_PAIE"),
+    ],
+    presence="hours",
+    absent_prefix="Heures: ",
+    prime={"above": 0, "employees": "both"},
+    fields={
+        "tauxHoraire": "TAUX_HORAIRE",
+        "salairePaie": "Salaire_Paie",
+        "feriePointage": "FERIE_POINTAGE",
+        "feriePaie": "FERIE_PAIE",
+        "pct25Pointage": "PCT25_POINTAGE",
+        "hs25Paie": "HS25_PAIE",
+        "mtHs25Paie": "MT_HS25_PAIE",
+        "mtHs25Expected": "MT_HS25_EXPECTED",
+        "amo": "AMO",
+        "cnss": "CNSS",
+    },
+)
+
 @app.route('/test', methods=['GET'])
 def test():
     return jsonify({"message": "Backend is working"}), 200
 
 @app.route('/upload', methods=['POST'])
+@timed("scif")
 def upload_files():
     if 'pointage' not in request.files or 'paie' not in request.files:
         return jsonify({'error': 'Les deux fichiers sont requis'}), 400
 
-    pointage_file = request.files['pointage']
-    paie_file = request.files['paie']
+    # Several files per side (e.g. CENTRE and SUD) are compared as one
+    pointage_files = request.files.getlist('pointage')
+    paie_files = request.files.getlist('paie')
 
-    if pointage_file.filename == '' or paie_file.filename == '':
+    if any(f.filename == '' for f in pointage_files + paie_files):
         return jsonify({'error': 'Aucun fichier sélectionné'}), 400
 
-    pointage_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(pointage_file.filename))
-    paie_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(paie_file.filename))
+    # Parsed from memory or from the content-addressed store (see upload_store.py)
+    month = request.form.get('month')
+    pointage = [uploads.accept(f, "scif", month) for f in pointage_files]
+    paie = [uploads.accept(f, "scif", month) for f in paie_files]
+    # sheets=all: every sheet of each workbook that has the header is read
+    all_sheets = request.form.get('sheets') == 'all'
+    # messages=codes: inconsistencies as codes and operands (see rules.py)
+    codes = request.form.get('messages') == 'codes'
+    # format=columnar: one array per field instead of one object per employee;
+    # format=ndjson: the summary, then one line per employee, streamed
+    response_format = request.form.get('format', 'rows')
+    # size=N: results kept server-side, first page only (see runs.py)
+    page_size = request.form.get('size', type=int)
+    if page_size is not None and page_size < 1:
+        return jsonify({'error': 'Paramètres de page invalides'}), 400
 
-    pointage_file.save(pointage_path)
-    paie_file.save(paie_path)
+    # mode=async: compared in the job pool, followed at /jobs/<id> (see jobs.py)
+    submission = maybe_submit(request, compare_files, pointage, paie, all_sheets, codes, response_format, company="scif")
+    if submission is not None:
+        return submission
 
     try:
-        comparison_results = compare_files(pointage_path, paie_path)
-        return jsonify(comparison_results), 200
+        comparison_results = compare_files(pointage, paie, all_sheets, codes, response_format, page_size)
+        stage("serialize")
+        # timings=1: time spent in each stage so far (see timings.py)
+        if response_format == 'ndjson' and not page_size:
+            return ndjson(with_timings({"summary": comparison_results["summary"]}), comparison_results["results"]), 200
+        return jsonify(with_timings(comparison_results)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def find_header_row(file_path, search_terms):
-    """Find the row number that contains all search terms in an Excel file."""
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=None)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=None, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Convert all cells to strings and uppercase for case-insensitive search
-    df = df.applymap(lambda x: str(x).upper().strip() if pd.notna(x) else "")
-    
-    for idx, row in df.iterrows():
-        row_values = ' '.join(row.values.astype(str))
-        if all(term.upper() in row_values for term in search_terms):
-            return idx
-    return None
-
-def read_file_with_header(file_path, header_terms):
-    """Read file with dynamic header row detection."""
-    header_row = find_header_row(file_path, header_terms)
-    if header_row is None:
-        raise ValueError(f"Could not find header row containing: {header_terms}")
-    
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=header_row)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=header_row, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Clean column names
-    df.columns = [str(col).strip().upper() for col in df.columns]
-    return df
-
-def compare_files(pointage_path, paie_path):
+def compare_files(pointage_path, paie_path, all_sheets=False, codes=False, response_format="rows", page_size=None):
+    stage("read")
     # Read files with dynamic header detection
     try:
         # Pointage uses CIN, Journal de Paie uses NCIN
-        df_pointage = read_file_with_header(pointage_path, ["CIN", "NORMAL"])
-        df_paie = read_file_with_header(paie_path, ["NCIN", "JRS/HRS"])
+        df_pointage = read_files_with_header(pointage_path, ["CIN", "NORMAL"], keep=POINTAGE_FIELDS,
+                                             group_by="CIN", agg=POINTAGE_TOTALS, all_sheets=all_sheets)
+        df_paie = read_files_with_header(paie_path, ["NCIN", "JRS/HRS"], keep=PAIE_FIELDS, all_sheets=all_sheets)
     except ValueError as e:
         raise Exception(f"Erreur lors de la lecture des fichiers: {str(e)}")
+    count(pointage=len(df_pointage), paie=len(df_paie))
     
-    # Print column names for debugging
-    print("Pointage columns:", df_pointage.columns.tolist())
-    print("Paie columns:", df_paie.columns.tolist())
-    
-    # Identify the correct columns - using more flexible matching
-    cin_col_pointage = next((col for col in df_pointage.columns if "CIN" in col), None)
-    normal_col = next((col for col in df_pointage.columns if "NORMAL" in col), None)
-    taux_col = next((col for col in df_pointage.columns if "TAUX" in col and "HORA" in col), None)
-    
-    # For the "jour férié" column in pointage - simplified approach
-    ferie_pointage_col = None
-    for col in df_pointage.columns:
-        if "FERIE" in col or "FÉRIÉ" in col:
-            ferie_pointage_col = col
-            break
-    
-    # Also check for "JOUR FERIE" pattern separately to avoid duplication issues
-    if not ferie_pointage_col:
-        for col in df_pointage.columns:
-            if "JOUR" in col and ("FERIE" in col or "FÉRIÉ" in col):
-                ferie_pointage_col = col
-                break
-            
-    # Find the 25% column in pointage
-    pct25_pointage_col = None
-    for col in df_pointage.columns:
-        if "25%" in col:
-            pct25_pointage_col = col
-            break
-            
-    if not pct25_pointage_col:
-        print("Warning: Could not find 25% column in pointage file!")
-        print("Available columns:", df_pointage.columns.tolist())
-        
-    ncin_col_paie = next((col for col in df_paie.columns if "NCIN" in col or "CIN" in col), None)
-    jrs_hrs_col = next((col for col in df_paie.columns if "JRS" in col or "HRS" in col), None)
-    salaire_col = next((col for col in df_paie.columns if "SALAIRE" in col), None)
-    
-    # For the "Férié" column in paie - simplified approach
-    ferie_paie_col = None
-    for col in df_paie.columns:
-        if "FERIE" in col or "FÉRIÉ" in col:
-            ferie_paie_col = col
-            break
-    
-    # Find HS 25 column in paie
-    hs25_paie_col = None
-    for col in df_paie.columns:
-        if "HS 25" in col and "MT" not in col:  # Exclude MT HS 25
-            hs25_paie_col = col
-            break
-            
-    # Find MT HS 25 column in paie
-    mt_hs25_paie_col = None
-    for col in df_paie.columns:
-        if "MT HS 25" in col:
-            mt_hs25_paie_col = col
-            break
-            
-    # ADDED: Find AMO column in paie
-    amo_col = next((col for col in df_paie.columns if "AMO" in col), None)
-    
-    # ADDED: Find CNSS column in paie
-    cnss_col = next((col for col in df_paie.columns if "CNSS" in col), None)
-    
-    # ADDED: Find DATE EMBAUCHE column in paie
-    date_embauche_col = next((col for col in df_paie.columns if "DATE" in col and "EMBAUCHE" in col), None)
+    # Columns read, logged at debug level (see logs.py)
+    event(log, "columns", logging.DEBUG, company="scif", pointage=df_pointage.columns.tolist(),
+          paie=df_paie.columns.tolist())
     
-    if not hs25_paie_col:
-        print("Warning: Could not find HS 25 column in paie file!")
-        print("Available columns:", df_paie.columns.tolist())
-        
-    if not mt_hs25_paie_col:
-        print("Warning: Could not find MT HS 25 column in paie file!")
-        print("Available columns:", df_paie.columns.tolist())
+    # Identify the correct columns (cached per header layout)
+    pointage_fields = resolve_columns(df_pointage, "scif.pointage", POINTAGE_FIELDS)
+    paie_fields = resolve_columns(df_paie, "scif.paie", PAIE_FIELDS)
+    cin_col_pointage = pointage_fields["CIN"]
+    normal_col = pointage_fields["NORMAL"]
+    taux_col = pointage_fields["TAUX_HORAIRE"]
+    ferie_pointage_col = pointage_fields["FERIE"]
+    pct25_pointage_col = pointage_fields["PCT25"]
+    ncin_col_paie = paie_fields["NCIN"]
+    jrs_hrs_col = paie_fields["JRS/HRS"]
+    salaire_col = paie_fields["SALAIRE"]
+    ferie_paie_col = paie_fields["FERIE"]
+    hs25_paie_col = paie_fields["HS25"]
+    mt_hs25_paie_col = paie_fields["MT_HS25"]
+    amo_col = paie_fields["AMO"]
+    cnss_col = paie_fields["CNSS"]
+    date_embauche_col = paie_fields["DATE_EMBAUCHE"]
+
+    for side, column, name, df in [("pointage", pct25_pointage_col, "25%", df_pointage),
+                                   ("paie", hs25_paie_col, "HS 25", df_paie),
+                                   ("paie", mt_hs25_paie_col, "MT HS 25", df_paie)]:
+        if not column:
+            event(log, "column_missing", logging.WARNING, company="scif", file=side, column=name,
+                  available=df.columns.tolist())
         
     # Check required columns
     required_pointage_cols = {
@@ -174,6 +196,7 @@ def compare_files(pointage_path, paie_path):
     if missing_paie:
         raise Exception(f"Colonnes manquantes dans Journal de Paie: {', '.join(missing_paie)}. Colonnes disponibles: {df_paie.columns.tolist()}")
         
+    stage("ncin")
     # Clean and standardize CIN/NCIN for better matching
     df_pointage[cin_col_pointage] = df_pointage[cin_col_pointage].astype(str).str.strip().str.upper()
     df_paie[ncin_col_paie] = df_paie[ncin_col_paie].astype(str).str.strip().str.upper()
@@ -183,6 +206,7 @@ def compare_files(pointage_path, paie_path):
     df_paie = df_paie[df_paie[ncin_col_paie] != 'NAN']
     df_paie = df_paie[df_paie[ncin_col_paie] != 'N/A']
     
+    stage("numeric")
     # Convert columns to numeric
     df_pointage[normal_col] = pd.to_numeric(df_pointage[normal_col], errors="coerce").fillna(0)
     df_paie[jrs_hrs_col] = pd.to_numeric(df_paie[jrs_hrs_col], errors="coerce").fillna(0)
@@ -217,6 +241,7 @@ def compare_files(pointage_path, paie_path):
     if date_embauche_col:
         df_paie[date_embauche_col] = pd.to_datetime(df_paie[date_embauche_col], errors="coerce")
     
+    stage("groupby")
     # Group pointage by CIN and aggregate data
     agg_dict = {normal_col: 'sum'}
     
@@ -229,6 +254,7 @@ def compare_files(pointage_path, paie_path):
         
     df_pointage_grouped = df_pointage.groupby(cin_col_pointage).agg(agg_dict).reset_index()
     
+    stage("merge")
     # Rename columns for the grouped dataframe
     rename_dict_pointage = {
         cin_col_pointage: "CIN",
@@ -293,181 +319,27 @@ def compare_files(pointage_path, paie_path):
     if "HS25_PAIE" in df_comparaison.columns and "TAUX_HORAIRE" in df_comparaison.columns:
         df_comparaison["MT_HS25_EXPECTED"] = df_comparaison["HS25_PAIE"] * df_comparaison["TAUX_HORAIRE"] * 1.25
     
-    # Print columns in the comparison dataframe for debugging
-    print("Columns in comparison dataframe:", df_comparaison.columns.tolist())
+    event(log, "comparison_columns", logging.DEBUG, company="scif", columns=df_comparaison.columns.tolist())
     
-    # Generate results
-    results = []
-    for _, row in df_comparaison.iterrows():
-        # Skip rows with empty/NaN CIN values in the final results
-        if pd.isna(row["CIN"]) or str(row["CIN"]).strip() in ['', 'NAN', 'N/A']:
-            continue
-            
-        prime_rendement = 0
-        status = "Incohérence"
-        inconsistencies = []
-        
-        # Hours comparison
-        if row["Heures_Pointage"] == 0 and row["Heures_Paie"] > 0:
-            status = "Employé absent dans pointage"
-            inconsistencies.append("Heures: Employé absent dans pointage")
-        elif row["Heures_Pointage"] > 0 and row["Heures_Paie"] == 0:
-            status = "Employé absent dans journal de paie"
-            inconsistencies.append("Heures: Employé absent dans journal de paie")
-        elif row["Heures_Pointage"] > row["Heures_Paie"]:
-            # Calculate Prime de Rendement when worked hours exceed paid hours
-            prime_rendement = row["Heures_Pointage"] - row["Heures_Paie"]
-            # If prime de rendement equals the difference, status is Correct
-            if abs(prime_rendement - row["Écart"]) <= 0.01:
-                status = "Correct"
-        elif abs(row["Écart"]) <= 0.01:
-            status = "Correct"
-        
-        # TAUX Horaire vs Salaire comparison - They should be exactly equal
-        taux_salaire_status = "Correct"
-        if "TAUX_HORAIRE" in df_comparaison.columns and "Salaire_Paie" in df_comparaison.columns:
-            if abs(row["TAUX_HORAIRE"] - row["Salaire_Paie"]) > 0.01:
-                taux_salaire_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"TAUX Horaire ({row['TAUX_HORAIRE']}) ≠ Salaire ({row['Salaire_Paie']}) - Devraient être identiques")
-        
-        # Férié comparison
-        ferie_status = "Correct"
-        if "FERIE_POINTAGE" in df_comparaison.columns and "FERIE_PAIE" in df_comparaison.columns:
-            if abs(row["FERIE_POINTAGE"] - row["FERIE_PAIE"]) > 0.01:
-                ferie_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"Férié Pointage ({row['FERIE_POINTAGE']}) ≠ Férié Paie ({row['FERIE_PAIE']})")
-        elif "FERIE_POINTAGE" in df_comparaison.columns and row["FERIE_POINTAGE"] > 0:
-            ferie_status = "Incohérence"
-            inconsistencies.append(f"Férié Pointage ({row['FERIE_POINTAGE']}) mais absent dans Paie")
-        elif "FERIE_PAIE" in df_comparaison.columns and row["FERIE_PAIE"] > 0:
-            ferie_status = "Incohérence"
-            inconsistencies.append(f"Férié Paie ({row['FERIE_PAIE']}) mais absent dans Pointage")
-        
-        # 25% comparison
-        pct25_status = "Correct"
-        if "PCT25_POINTAGE" in df_comparaison.columns and "HS25_PAIE" in df_comparaison.columns:
-            if abs(row["PCT25_POINTAGE"] - row["HS25_PAIE"]) > 0.01:
-                pct25_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"25% Pointage ({row['PCT25_POINTAGE']}) ≠ HS 25 Paie ({row['HS25_PAIE']})")
-        elif "PCT25_POINTAGE" in df_comparaison.columns and row["PCT25_POINTAGE"] > 0:
-            pct25_status = "Incohérence"
-            inconsistencies.append(f"25% Pointage ({row['PCT25_POINTAGE']}) mais absent dans Paie")
-        elif "HS25_PAIE" in df_comparaison.columns and row["HS25_PAIE"] > 0:
-            pct25_status = "Incohérence"
-            inconsistencies.append(f"HS 25 Paie ({row['HS25_PAIE']}) mais absent dans Pointage")
-        
-        # MT HS 25 calculation check
-        mt_hs25_status = "Correct"
-        if "MT_HS25_PAIE" in df_comparaison.columns and "MT_HS25_EXPECTED" in df_comparaison.columns:
-            if row["HS25_PAIE"] > 0 and abs(row["MT_HS25_PAIE"] - row["MT_HS25_EXPECTED"]) > 0.01:
-                mt_hs25_status = "Incohérence"
-                if status == "Correct":
-                    status = "Incohérence"
-                inconsistencies.append(f"MT HS 25 ({row['MT_HS25_PAIE']}) ≠ HS 25 * TAUX * 1.25 ({row['MT_HS25_EXPECTED']})")
-        
-        # ADDED: Paie validations
-        paie_validations = {}
-        
-        # AMO & CNSS Check
-        amo_cnss_check = {"status": "Valid"}  # Default to Valid
-        if "AMO" in df_comparaison.columns and "CNSS" in df_comparaison.columns:
-            amo = float(row["AMO"]) if pd.notna(row["AMO"]) else 0
-            cnss = float(row["CNSS"]) if pd.notna(row["CNSS"]) else 0
-            
-            amo_cnss_check = {
-                "amo": amo,
-                "cnss": cnss,
-                "status": "Valid" if amo > 0 and cnss > 0 else "Employé non déclaré"
-            }
-        paie_validations["amoCnssCheck"] = amo_cnss_check
-        
-        # Date d'Embauche Check with updated contract duration logic
-        embauche_date_check = {"status": "Valid"}  # Default to Valid
-        if "DATE_EMBAUCHE" in df_comparaison.columns and pd.notna(row["DATE_EMBAUCHE"]):
-            try:
-                date_embauche = pd.to_datetime(row["DATE_EMBAUCHE"])
-                today = pd.to_datetime('today')
-                anciennete = (today - date_embauche).days / 30  # Convert to months
-                
-                embauche_date_check = {
-                    "dateEmbauche": date_embauche.strftime('%Y-%m-%d') if not pd.isna(date_embauche) else "Non spécifiée",
-                    "anciennete": f"{anciennete:.1f} mois",
-                    "status": "Fin de Contrat" if anciennete > 5 else "Valide"
-                }
-            except Exception as e:
-                embauche_date_check = {
-                    "dateEmbauche": "Format invalide",
-                    "anciennete": "Non calculée",
-                    "status": "Non vérifié",
-                    "error": str(e)
-                }
-        paie_validations["embaucheDateCheck"] = embauche_date_check
-        
-        result_item = {
-            "CIN": row["CIN"],
-            "heuresTravaillees": row["Heures_Pointage"],
-            "heuresPayees": row["Heures_Paie"],
-            "difference": row["Écart"],
-            "status": status,
-            "primeRendement": prime_rendement,
-            "tauxSalaireStatus": taux_salaire_status,
-            "ferieStatus": ferie_status,
-            "pct25Status": pct25_status,
-            "mtHs25Status": mt_hs25_status,
-            "inconsistencies": inconsistencies,
-            "paieValidations": paie_validations  # ADDED: Include paie validations
-        }
-        
-        # Add optional fields if they exist in the dataframe
-        if "TAUX_HORAIRE" in df_comparaison.columns:
-            result_item["tauxHoraire"] = row["TAUX_HORAIRE"]
-        if "Salaire_Paie" in df_comparaison.columns:
-            result_item["salairePaie"] = row["Salaire_Paie"]
-        if "FERIE_POINTAGE" in df_comparaison.columns:
-            result_item["feriePointage"] = row["FERIE_POINTAGE"]
-        if "FERIE_PAIE" in df_comparaison.columns:
-            result_item["feriePaie"] = row["FERIE_PAIE"]
-        if "PCT25_POINTAGE" in df_comparaison.columns:
-            result_item["pct25Pointage"] = row["PCT25_POINTAGE"]
-        if "HS25_PAIE" in df_comparaison.columns:
-            result_item["hs25Paie"] = row["HS25_PAIE"]
-        if "MT_HS25_PAIE" in df_comparaison.columns:
-            result_item["mtHs25Paie"] = row["MT_HS25_PAIE"]
-        if "MT_HS25_EXPECTED" in df_comparaison.columns:
-            result_item["mtHs25Expected"] = row["MT_HS25_EXPECTED"]
-        # ADDED: Include AMO, CNSS, and DATE_EMBAUCHE fields if they exist
-        if "AMO" in df_comparaison.columns:
-            result_item["amo"] = row["AMO"]
-        if "CNSS" in df_comparaison.columns:
-            result_item["cnss"] = row["CNSS"]
-        if "DATE_EMBAUCHE" in df_comparaison.columns:
-            # Format date as string for JSON serialization if it's a datetime
-            if isinstance(row["DATE_EMBAUCHE"], pd.Timestamp):
-                result_item["dateEmbauche"] = row["DATE_EMBAUCHE"].strftime('%Y-%m-%d')
-            else:
-                result_item["dateEmbauche"] = row["DATE_EMBAUCHE"]
-            
-        results.append(result_item)
-    
-    return {
-        "results": results,
-        "summary": {
-            "total": len(results),
-            "correct": sum(1 for r in results if r["status"] == "Correct"),
-            "inconsistencies": sum(1 for r in results if r["status"] != "Correct"),
-            "totalPrimeRendement": sum(r["primeRendement"] for r in results),
-            "tauxSalaireInconsistencies": sum(1 for r in results if r.get("tauxSalaireStatus") == "Incohérence"),
-            "ferieInconsistencies": sum(1 for r in results if r.get("ferieStatus") == "Incohérence"),
-            "pct25Inconsistencies": sum(1 for r in results if r.get("pct25Status") == "Incohérence"),
-            "mtHs25Inconsistencies": sum(1 for r in results if r.get("mtHs25Status") == "Incohérence")
-        }
-    }
+    # Generate results from the rule profile
+    stage("rules")
+    columns = COMPARISON_RULES.columns(df_comparaison, codes=codes or bool(page_size))
+    count(results=len(columns["status"]))
+    stage("summary")
+    summary = COMPARISON_RULES.summary(columns)
+    stage("results")
+    if page_size:
+        run = runs.add(COMPARISON_RULES, columns, summary, company="scif", render=not codes)
+        return {"run": run.id, "summary": summary, **run.page(size=page_size)}
+    # format=columnar: one list per result key, statuses dictionary-encoded
+    if response_format == "columnar":
+        return {"format": "columnar", "results": COMPARISON_RULES.columnar(columns), "summary": summary}
+    # format=ndjson: result dicts built chunk by chunk while they are sent
+    if response_format == "ndjson":
+        return {"results": COMPARISON_RULES.row_chunks(columns), "summary": summary}
+    return {"results": COMPARISON_RULES.rows(columns), "summary": summary}
+
+add_metrics(app, "scif")
 
 if __name__ == '__main__':
     app.run(debug=True, port=8001)
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""One service for every company.
+
+Each company module (cobco.py, scif.py, ...) still defines its own Flask
+app; this one imports them all at startup and serves their routes under
+/<company>/, e.g. /cobco/upload or /sbbc/api/compare. main.py and sbbc.py,
+which only have /api/compare, also answer on /<company>/upload.
+
+All companies share the process: the ingest worker pool (see
+ingest.worker_pool), the frame and layout caches and the upload store.
+At most COMPARE_SLOTS comparisons run at once, whatever the company; the
+others wait for a slot. The wait is not part of the request's own timings
+(see timings.py, metrics.py): it is sent as "slot" in its Server-Timing
+header and observed in sheetsync_compare_slot_wait_seconds.
+
+Companies with a rule profile (see rules.py) also get /<company>/messages,
+which renders the issues of results uploaded with messages=codes: the
+frontend sends the rows it shows, or all of them for an export.
+
+Runs uploaded with size=N (see runs.py) are browsed with /runs/<id>/results,
+and comparisons uploaded with mode=async (see jobs.py) followed with
+/jobs/<id>, whichever company they belong to. Async comparisons run in
+the job pool, not in a comparison slot.
+
+/metrics (see metrics.py) covers the requests of every company, labelled
+with the company; the company modules' own /metrics are not mounted.
+
+Usage:
+    python service.py
+    waitress-serve --port=8080 --threads=8 service:app
+    gunicorn --workers 1 --threads 8 --bind :8080 service:app
+
+`service:app` is the WSGI application. python service.py serves it with
+waitress and SERVICE_THREADS request threads, or with Werkzeug's
+development server if waitress is not installed. Run a single process
+(gunicorn --workers 1) with threads: the pools, caches, runs and jobs are
+kept in that process, and a job or run created by one worker process
+could not be found by another.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import Flask, jsonify, make_response, request
+from flask_cors import CORS
+
+from ingest import INGEST_WORKERS
+from jobs import add_job_routes
+from logs import event, logger
+from metrics import add_metrics, slot_wait
+from responses import use_fast_json
+from runs import add_run_routes
+
+# Company name in the URL -> module defining its routes
+COMPANIES = {
+    "novometal": "main",
+    "scif": "scif",
+    "cobco": "cobco",
+    "casaEaro": "casaEaro",
+    "sbbc": "sbbc",
+    "other": "other",
+    "temp": "temp",
+    "tempT": "tempT",
+}
+
+SERVICE_PORT = int(os.environ.get("SHEETSYNC_SERVICE_PORT", "8080"))
+# Comparisons running at the same time, all companies together
+COMPARE_SLOTS = int(os.environ.get("SHEETSYNC_COMPARE_SLOTS", INGEST_WORKERS))
+# Request threads of the WSGI server started by python service.py
+SERVICE_THREADS = int(os.environ.get("SHEETSYNC_SERVICE_THREADS", max(8, 2 * COMPARE_SLOTS)))
+
+log = logger("service")
+
+app = Flask(__name__)
+CORS(app, resources={r"/*": {"origins": "*"}})
+use_fast_json(app)
+add_run_routes(app)
+add_job_routes(app)
+
+compare_slots = threading.BoundedSemaphore(COMPARE_SLOTS)
+# Company -> rule profile
+profiles = {}
+
+
+def in_slot(view, company):
+    """`view`, run once a comparison slot is free; the wait is added to
+    the Server-Timing header as "slot" and observed in the metrics."""
+    @wraps(view)
+    def run(*args, **kwargs):
+        started = time.perf_counter()
+        with compare_slots:
+            waited = time.perf_counter() - started
+            slot_wait.observe(waited, company=company)
+            response = make_response(view(*args, **kwargs))
+        timing = f"slot;dur={round(waited * 1000, 3)}"
+        if response.headers.get("Server-Timing"):
+            timing += ", " + response.headers["Server-Timing"]
+        response.headers["Server-Timing"] = timing
+        return response
+    return run
+
+
+def mount(company, module):
+    """Serve the routes of `module`'s app under /<company>/."""
+    views = module.app.view_functions
+    routes = {}
+    for rule in module.app.url_map.iter_rules():
+        if rule.endpoint in ("static", "metrics"):
+            continue
+        view = views[rule.endpoint]
+        if "POST" in rule.methods:
+            view = in_slot(view, company)
+        routes[rule.rule] = (rule.endpoint, view, rule.methods)
+    if "/upload" not in routes and "/api/compare" in routes:
+        endpoint, view, methods = routes["/api/compare"]
+        routes["/upload"] = (endpoint + "_upload", view, methods)
+    for path, (endpoint, view, methods) in routes.items():
+        app.add_url_rule(f"/{company}{path}", endpoint=f"{company}.{endpoint}", view_func=view,
+                         methods=sorted(methods - {"HEAD", "OPTIONS"}))
+
+
+def load_companies():
+    """Import every company module and mount its routes."""
+    for company, module_name in COMPANIES.items():
+        module = importlib.import_module(module_name)
+        mount(company, module)
+        if hasattr(module, "COMPARISON_RULES"):
+            profiles[company] = module.COMPARISON_RULES
+        event(log, "company_loaded", company=company, module=f"{module_name}.py")
+
+
+@app.route('/<company>/messages', methods=['POST'])
+def render_messages(company):
+    """{"issues": [issues of a result, ...]} -> {"inconsistencies": [messages, ...]}"""
+    profile = profiles.get(company)
+    if profile is None:
+        return jsonify({'error': f"Société inconnue: {company}"}), 404
+    body = request.get_json(silent=True) or {}
+    try:
+        return jsonify({"inconsistencies": [profile.render(issues) for issues in body.get("issues", [])]}), 200
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f"Codes invalides: {e}"}), 400
+
+
+@app.route('/test', methods=['GET'])
+def test():
+    return jsonify({"message": "Backend is working", "companies": sorted(COMPANIES)}), 200
+
+
+load_companies()
+add_metrics(app)
+
+
+def serve():
+    """Serve `app` with waitress, or Werkzeug's development server if
+    waitress is not installed."""
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        event(log, "server", logging.WARNING, server="werkzeug", reason="waitress non installé")
+        app.run(port=SERVICE_PORT, threaded=True)
+        return
+    waitress_serve(app, port=SERVICE_PORT, threads=SERVICE_THREADS)
+
+
+if __name__ == '__main__':
+    serve()
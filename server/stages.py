@@ -0,0 +1,94 @@
+"""Stages of a comparison.
+
+compare_files marks each stage it enters with stage(name), and the row
+counts it knows with count(name=rows); identify(run_id) reports the id the
+client will follow the comparison with (a run of runs.py, a job of
+jobs.py). Outside of listening() this does nothing; jobs.py listens to report the stage of a running job, timings.py
+to time each stage of a request.
+
+The stages, in order (a stage may be entered more than once, e.g. "header"
+and "parse" for each file):
+
+    upload     the upload request is read and its files accepted
+    read       files are read (cache lookups, parsing in worker processes)
+    header     header row detection (ingest.py)
+    parse      parsing of a sheet or CSV file (ingest.py)
+    ncin       NCIN cleaning and filtering
+    numeric    numeric (and date) coercion of the compared columns
+    groupby    aggregation of the pointage per employee
+    merge      merge of the two files
+    rules      rule evaluation ("validations" in main.py and sbbc.py)
+    summary    summary of the results
+    results    result dicts (or a run's first page)
+    serialize  the response body is serialised
+
+main.py and sbbc.py read both files with fixed header rows ("parse" only)
+and map them in one step, "map", which covers NCIN cleaning and numeric
+coercion.
+"""
+import threading
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+def stage(name):
+    """Enter the stage `name` of the current comparison."""
+    for listener in getattr(_local, "listeners", ()):
+        listener.stage(name)
+
+
+def count(**rows):
+    """Report row counts of the current comparison, e.g. count(paie=120)."""
+    for listener in getattr(_local, "listeners", ()):
+        listener.count(**rows)
+
+
+def identify(run_id):
+    """Report that the current comparison is kept as `run_id`."""
+    for listener in getattr(_local, "listeners", ()):
+        listener.identify(run_id)
+
+
+class Listener:
+    """What listening() calls; subclasses override what they need."""
+
+    def stage(self, name):
+        pass
+
+    def count(self, **rows):
+        pass
+
+    def identify(self, run_id):
+        pass
+
+
+@contextmanager
+def listening(listener):
+    """Call listener.stage(name), listener.count(**rows) and
+    listener.identify(run_id), along with the listeners already active, for
+    each stage entered, count and id reported in this thread until the
+    block exits."""
+    previous = getattr(_local, "listeners", ())
+    _local.listeners = previous + (listener,)
+    try:
+        yield
+    finally:
+        _local.listeners = previous
+
+
+def run_id():
+    """The id of the comparison being served in this thread (see
+    timings.Timer, identify), or None."""
+    for active in reversed(getattr(_local, "listeners", ())):
+        if getattr(active, "id", None):
+            return active.id
+    return None
+
+
+def listener(kind):
+    """The innermost active listener of class `kind`, or None."""
+    for active in reversed(getattr(_local, "listeners", ())):
+        if isinstance(active, kind):
+            return active
+    return None
@@ -1,24 +1,50 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import numpy as np
 import pandas as pd
+import logging
 import os
-from werkzeug.utils import secure_filename
+from ingest import read_file_with_header
+from layout_cache import resolve_columns
+from upload_store import uploads
+from reconcile import TOLERANCE, collect, known_cin, messages, outer_merge, records, status_totals, values
+from columns import ColumnMatcher, field, NCIN
+from responses import use_fast_json
+from jobs import add_job_routes, maybe_submit
+from stages import count, stage
+from timings import timed, with_timings
+from logs import event, logger
+from metrics import add_metrics
 
+log = logger("tempT")
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
+use_fast_json(app)
+add_job_routes(app)
 
 UPLOAD_FOLDER = 'uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Fields compare_files reads from each file (see columns.py). Columns none
+# of them can match are skipped while the workbooks are read.
+FILE1_FIELDS = ColumnMatcher({
+    "NCIN": NCIN,
+    "COLUMN_1": field("COLUMN_1"),
+})
+FILE2_FIELDS = ColumnMatcher({
+    "NCIN": NCIN,
+    "COLUMN_2": field("COLUMN_2"),
+})
+
 @app.route('/test', methods=['GET'])
 def test():
     return jsonify({"message": "Backend is working"}), 200
 
 @app.route('/upload', methods=['POST'])
+@timed("tempT")
 def upload_files():
-    # Debug: Print all received files
-    print("Files received:", list(request.files.keys()))
+    event(log, "files", logging.DEBUG, company="tempT", files=list(request.files.keys()))
     
     # More flexible file name checking
     file_keys = list(request.files.keys())
@@ -33,72 +59,47 @@ def upload_files():
     if file1.filename == '' or file2.filename == '':
         return jsonify({'error': 'Aucun fichier sélectionné'}), 400
 
-    file1_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file1.filename))
-    file2_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file2.filename))
+    # Parsed from memory or from the content-addressed store (see upload_store.py)
+    month = request.form.get('month')
+    file1_source = uploads.accept(file1, "tempT", month)
+    file2_source = uploads.accept(file2, "tempT", month)
 
-    file1.save(file1_path)
-    file2.save(file2_path)
+    # mode=async: compared in the job pool, followed at /jobs/<id> (see jobs.py)
+    submission = maybe_submit(request, compare_files, file1_source, file2_source, company="tempT",
+                              paged=False, streamed=False)
+    if submission is not None:
+        return submission
 
     try:
-        comparison_results = compare_files(file1_path, file2_path)
-        return jsonify(comparison_results), 200
+        comparison_results = compare_files(file1_source, file2_source)
+        stage("serialize")
+        # timings=1: time spent in each stage so far (see timings.py)
+        return jsonify(with_timings(comparison_results)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-def find_header_row(file_path, search_terms):
-    """Find the row number that contains all search terms in an Excel file."""
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=None)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=None, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Convert all cells to strings and uppercase for case-insensitive search
-    df = df.applymap(lambda x: str(x).upper().strip() if pd.notna(x) else "")
-    
-    for idx, row in df.iterrows():
-        row_values = ' '.join(row.values.astype(str))
-        if all(term.upper() in row_values for term in search_terms):
-            return idx
-    return None
-
-def read_file_with_header(file_path, header_terms):
-    """Read file with dynamic header row detection."""
-    header_row = find_header_row(file_path, header_terms)
-    if header_row is None:
-        raise ValueError(f"Could not find header row containing: {header_terms}")
-    
-    if file_path.endswith('.xlsx') or file_path.endswith('.xls'):
-        df = pd.read_excel(file_path, header=header_row)
-    elif file_path.endswith('.csv'):
-        df = pd.read_csv(file_path, delimiter=";", encoding="ISO-8859-1", header=header_row, low_memory=False)
-    else:
-        raise ValueError("Format de fichier non supporté")
-    
-    # Clean column names
-    df.columns = [str(col).strip().upper() for col in df.columns]
-    return df
-
 def compare_files(file1_path, file2_path):
+    stage("read")
     # Read files with dynamic header detection
     try:
         # Assuming both files have NCIN and we need to compare column_1 from file1 with column_2 from file2
-        df_file1 = read_file_with_header(file1_path, ["NCIN", "COLUMN_1"])
-        df_file2 = read_file_with_header(file2_path, ["NCIN", "COLUMN_2"])
+        df_file1 = read_file_with_header(file1_path, ["NCIN", "COLUMN_1"], keep=FILE1_FIELDS)
+        df_file2 = read_file_with_header(file2_path, ["NCIN", "COLUMN_2"], keep=FILE2_FIELDS)
     except ValueError as e:
         raise Exception(f"Erreur lors de la lecture des fichiers: {str(e)}")
+    count(file1=len(df_file1), file2=len(df_file2))
     
-    # Print column names for debugging
-    print("File1 columns:", df_file1.columns.tolist())
-    print("File2 columns:", df_file2.columns.tolist())
+    # Columns read, logged at debug level (see logs.py)
+    event(log, "columns", logging.DEBUG, company="tempT", file1=df_file1.columns.tolist(),
+          file2=df_file2.columns.tolist())
     
-    # Identify the correct columns - using more flexible matching
-    ncin_col_file1 = next((col for col in df_file1.columns if "NCIN" in col or "CIN" in col), None)
-    column1_file1 = next((col for col in df_file1.columns if "COLUMN_1" in col), None)
-    
-    ncin_col_file2 = next((col for col in df_file2.columns if "NCIN" in col or "CIN" in col), None)
-    column2_file2 = next((col for col in df_file2.columns if "COLUMN_2" in col), None)
+    # Identify the correct columns (cached per header layout)
+    file1_fields = resolve_columns(df_file1, "tempT.file1", FILE1_FIELDS)
+    file2_fields = resolve_columns(df_file2, "tempT.file2", FILE2_FIELDS)
+    ncin_col_file1 = file1_fields["NCIN"]
+    column1_file1 = file1_fields["COLUMN_1"]
+    ncin_col_file2 = file2_fields["NCIN"]
+    column2_file2 = file2_fields["COLUMN_2"]
     
     # Check required columns
     required_file1_cols = {
@@ -116,6 +117,7 @@ def compare_files(file1_path, file2_path):
     if missing_file2:
         raise Exception(f"Colonnes manquantes dans File2: {', '.join(missing_file2)}. Colonnes disponibles: {df_file2.columns.tolist()}")
         
+    stage("ncin")
     # Clean and standardize NCIN for better matching
     df_file1[ncin_col_file1] = df_file1[ncin_col_file1].astype(str).str.strip().str.upper()
     df_file2[ncin_col_file2] = df_file2[ncin_col_file2].astype(str).str.strip().str.upper()
@@ -129,10 +131,12 @@ def compare_files(file1_path, file2_path):
     df_file2 = df_file2[df_file2[ncin_col_file2] != 'NAN']
     df_file2 = df_file2[df_file2[ncin_col_file2] != 'N/A']
     
+    stage("numeric")
     # Convert columns to numeric
     df_file1[column1_file1] = pd.to_numeric(df_file1[column1_file1], errors="coerce").fillna(0)
     df_file2[column2_file2] = pd.to_numeric(df_file2[column2_file2], errors="coerce").fillna(0)
     
+    stage("merge")
     # Prepare dataframes for merge
     df_file1_prepared = df_file1[[ncin_col_file1, column1_file1]].rename(
         columns={ncin_col_file1: "CIN", column1_file1: "COLUMN_1_VALUE"}
@@ -142,58 +146,67 @@ def compare_files(file1_path, file2_path):
         columns={ncin_col_file2: "CIN", column2_file2: "COLUMN_2_VALUE"}
     )
     
-    # Merge on CIN - using outer join to catch all cases
-    df_comparison = pd.merge(df_file1_prepared, df_file2_prepared, on="CIN", how="outer").fillna(0)
+    # Merge on CIN - using outer join to catch all cases; IN_FILE1 / IN_FILE2
+    # tell which file each NCIN is in
+    df_comparison = outer_merge(df_file1_prepared, df_file2_prepared, ("IN_FILE1", "IN_FILE2"))
     df_comparison["DIFFERENCE"] = df_comparison["COLUMN_1_VALUE"] - df_comparison["COLUMN_2_VALUE"]
     
-    # Generate results
-    results = []
-    for _, row in df_comparison.iterrows():
-        # Skip rows with empty/NaN CIN values in the final results
-        if pd.isna(row["CIN"]) or str(row["CIN"]).strip() in ['', 'NAN', 'N/A']:
-            continue
-            
-        status = "Correct"  # Default to correct unless we find issues
-        inconsistencies = []
-        
-        # Check for record existence in both files
-        in_file1 = any(df_file1[ncin_col_file1] == row["CIN"])
-        in_file2 = any(df_file2[ncin_col_file2] == row["CIN"])
-        
-        if not in_file1 and in_file2:
-            status = "NCIN absent dans fichier 1"
-            inconsistencies.append("NCIN absent dans fichier 1")
-        elif in_file1 and not in_file2:
-            status = "NCIN absent dans fichier 2"
-            inconsistencies.append("NCIN absent dans fichier 2")
-        else:
-            # Values comparison
-            if abs(row["DIFFERENCE"]) > 0.01:
-                status = "Incohérence"
-                inconsistencies.append(f"Valeur fichier 1: {row['COLUMN_1_VALUE']:.2f} Valeur fichier 2: {row['COLUMN_2_VALUE']:.2f} Différence de {abs(row['DIFFERENCE']):.2f}")
-        
-        result_item = {
-            "CIN": row["CIN"],
-            "column1Value": row["COLUMN_1_VALUE"],
-            "column2Value": row["COLUMN_2_VALUE"],
-            "difference": row["DIFFERENCE"],
-            "status": status,
-            "inconsistencies": inconsistencies
-        }
-        
-        results.append(result_item)
-    
+    stage("rules")
+    # Rows with empty/NaN CIN values are left out of the results
+    df_comparison = df_comparison[known_cin(df_comparison["CIN"])]
+    in_file1 = df_comparison["IN_FILE1"].to_numpy()
+    in_file2 = df_comparison["IN_FILE2"].to_numpy()
+    missing_in_file1 = ~in_file1 & in_file2
+    missing_in_file2 = in_file1 & ~in_file2
+    value_differs = in_file1 & in_file2 & (df_comparison["DIFFERENCE"].abs() > TOLERANCE).to_numpy()
+    status = np.select(
+        [missing_in_file1, missing_in_file2, value_differs],
+        ["NCIN absent dans fichier 1", "NCIN absent dans fichier 2", "Incohérence"],
+        "Correct",
+    ).tolist()
+    inconsistencies = collect(
+        len(status),
+        messages(missing_in_file1, "NCIN absent dans fichier 1"),
+        messages(missing_in_file2, "NCIN absent dans fichier 2"),
+        messages(value_differs, "Valeur fichier 1: {column1:.2f} Valeur fichier 2: {column2:.2f} Différence de {difference:.2f}",
+                 column1=df_comparison["COLUMN_1_VALUE"], column2=df_comparison["COLUMN_2_VALUE"],
+                 difference=df_comparison["DIFFERENCE"].abs()),
+    )
+    results = records({
+        "CIN": values(df_comparison, "CIN"),
+        "column1Value": values(df_comparison, "COLUMN_1_VALUE"),
+        "column2Value": values(df_comparison, "COLUMN_2_VALUE"),
+        "difference": values(df_comparison, "DIFFERENCE"),
+        "status": status,
+        "inconsistencies": inconsistencies,
+    })
+    count(results=len(results))
+    
+    stage("summary")
+    # Count and sums of each status, in one pass (see reconcile.status_totals)
+    by_status = status_totals(
+        status,
+        column1Value=df_comparison["COLUMN_1_VALUE"],
+        column2Value=df_comparison["COLUMN_2_VALUE"],
+        difference=df_comparison["DIFFERENCE"],
+    )
+    counts = {value: sums["count"] for value, sums in by_status.items()}
+    summary = {
+        "total": len(results),
+        "correct": counts.get("Correct", 0),
+        "inconsistencies": len(results) - counts.get("Correct", 0),
+        "missingInFile1": counts.get("NCIN absent dans fichier 1", 0),
+        "missingInFile2": counts.get("NCIN absent dans fichier 2", 0),
+        "valueDifferences": counts.get("Incohérence", 0),
+        "byStatus": by_status,
+    }
+    stage("results")
     return {
         "results": results,
-        "summary": {
-            "total": len(results),
-            "correct": sum(1 for r in results if r["status"] == "Correct"),
-            "inconsistencies": sum(1 for r in results if r["status"] != "Correct"),
-            "missingInFile1": sum(1 for r in results if r["status"] == "NCIN absent dans fichier 1"),
-            "missingInFile2": sum(1 for r in results if r["status"] == "NCIN absent dans fichier 2"),
-            "valueDifferences": sum(1 for r in results if "Incohérence" == r["status"])
-        }
+        "summary": summary
     }
 
+add_metrics(app, "tempT")
+
 if __name__ == '__main__':
     app.run(debug=True, port=8007)
\ No newline at end of file
@@ -0,0 +1,70 @@
+"""compare_files on bundled fixture pairs against their stored responses.
+
+tests/expected/<company>.json is the JSON response of the company's
+compare_files on its pair of FIXTURES, with contract durations computed on
+TODAY. After a change of the results that is intended, rewrite them with:
+
+    python tests/test_equivalence.py
+"""
+import importlib
+import json
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER)
+
+import responses  # noqa: E402
+import rules  # noqa: E402
+
+EXPECTED_FOLDER = os.path.join(SERVER, "tests", "expected")
+
+# Company module -> (pointage, paie) in uploads/
+FIXTURES = {
+    "cobco": ("Pointage_Mars_GRH_2025-_CIN-Cobco.xlsx", "JournalPaieExport_COBCO_0325.xlsx"),
+    "tempT": ("Book_14.xlsx", "Book_15_1.xlsx"),
+}
+
+# Reference date of the contract durations (anciennete, "Fin de Contrat")
+TODAY = pd.Timestamp("2025-05-01")
+
+
+def response(company):
+    """The company's compare_files on its fixtures, as the JSON sent."""
+    pointage, paie = (os.path.join(SERVER, "uploads", name) for name in FIXTURES[company])
+    module = importlib.import_module(company)
+    return json.loads(responses.dumps(module.compare_files(pointage, paie)))
+
+
+def expected_path(company):
+    return os.path.join(EXPECTED_FOLDER, f"{company}.json")
+
+
+def frozen_today(monkeypatch):
+    """Contract durations computed on TODAY instead of the current date."""
+    validations = rules.paie_validation_columns
+    monkeypatch.setattr(rules, "paie_validation_columns",
+                        lambda df, today=None: validations(df, TODAY if today is None else today))
+
+
+@pytest.mark.parametrize("company", sorted(FIXTURES))
+def test_same_response(company, monkeypatch):
+    monkeypatch.chdir(SERVER)
+    frozen_today(monkeypatch)
+    with open(expected_path(company), encoding="utf-8") as f:
+        expected = json.load(f)
+    assert response(company) == expected
+
+
+if __name__ == "__main__":
+    os.chdir(SERVER)
+    with pytest.MonkeyPatch.context() as patch:
+        frozen_today(patch)
+        os.makedirs(EXPECTED_FOLDER, exist_ok=True)
+        for name in sorted(FIXTURES):
+            with open(expected_path(name), "w", encoding="utf-8") as f:
+                json.dump(response(name), f, ensure_ascii=False, indent=1, sort_keys=True)
+                f.write("\n")
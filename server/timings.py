@@ -0,0 +1,129 @@
+"""Time spent in each stage of a comparison.
+
+Views wrapped with timed(company) time the stages (see stages.py) their
+request goes through and report them:
+
+- in the Server-Timing header of the response, in milliseconds:
+
+      Server-Timing: upload;dur=2.1, read;dur=0.4, header;dur=1.3, ..., total;dur=48.2
+
+- in a "timings" block of the JSON body (the first line of an NDJSON body)
+  when the upload form has timings=1, see with_timings;
+- in one JSON line per request on the "sheetsync.timings" logger (see
+  logs.py), with the run id, company, HTTP status, row counts and timings:
+
+      {"event": "comparison", "run": "...", "company": "cobco", "status": 200,
+       "rows": {"pointage": 120, "paie": 118, "results": 121}, "timings": {...}, "total": 48.2}
+
+The run id is the id of the run (size=N, see runs.py) or of the job
+(mode=async, see jobs.py) the request creates, reported with
+stages.identify, or else a fresh one. It is sent in the X-Run-Id header.
+
+NDJSON bodies are serialised while they are sent, after the headers: their
+Server-Timing stops at "serialize", and their log line is written once the
+body is sent, "serialize" then covering the whole stream. Jobs (see
+jobs.py) are timed in their worker, under the job id.
+
+Stages of files or sheets parsed in ingest worker processes are not seen
+and count as "read".
+"""
+import time
+import uuid
+from functools import wraps
+
+from flask import make_response, request
+
+from logs import event, logger
+from stages import Listener, listener, listening, stage
+
+log = logger("timings")
+
+
+class Timer(Listener):
+    """Time spent in each stage entered while it listens, and the row
+    counts reported."""
+
+    def __init__(self, company=None, run_id=None):
+        self.id = run_id or uuid.uuid4().hex
+        self.company = company
+        self.rows = {}
+        self.seconds = {}
+        self.current = None
+        self.started = self.lap = time.perf_counter()
+        self.stopped = None
+
+    def stage(self, name):
+        now = time.perf_counter()
+        if self.current is not None:
+            self.seconds[self.current] = self.seconds.get(self.current, 0.0) + now - self.lap
+        self.current, self.lap = name, now
+
+    def count(self, **rows):
+        self.rows.update(rows)
+
+    def identify(self, run_id):
+        self.id = run_id
+
+    def stop(self):
+        self.stage(None)
+        self.stopped = self.lap
+
+    def milliseconds(self):
+        """Stage -> milliseconds, in the order first entered; the current
+        stage counts until now."""
+        seconds = dict(self.seconds)
+        if self.current is not None:
+            seconds[self.current] = seconds.get(self.current, 0.0) + time.perf_counter() - self.lap
+        return {name: round(value * 1000, 3) for name, value in seconds.items()}
+
+    def total(self):
+        return round(((self.stopped or time.perf_counter()) - self.started) * 1000, 3)
+
+    def server_timing(self):
+        entries = [f"{name};dur={ms}" for name, ms in self.milliseconds().items()]
+        return ", ".join(entries + [f"total;dur={self.total()}"])
+
+    def log(self, **fields):
+        event(log, "comparison", run=self.id, company=self.company, **fields,
+              rows=self.rows, timings=self.milliseconds(), total=self.total())
+
+
+def with_timings(body):
+    """`body` with a "timings" block (stage -> milliseconds so far) if the
+    request has timings=1."""
+    timer = listener(Timer)
+    if timer is None or not request.form.get('timings'):
+        return body
+    return {**body, "timings": timer.milliseconds()}
+
+
+def timed(company):
+    """Decorator timing the comparison view of `company`, see above."""
+    def decorate(view):
+        @wraps(view)
+        def run(*args, **kwargs):
+            timer = Timer(company)
+            try:
+                with listening(timer):
+                    stage("upload")
+                    response = make_response(view(*args, **kwargs))
+            except Exception:
+                timer.stop()
+                timer.log(status=500)
+                raise
+
+            def finish():
+                timer.stop()
+                timer.log(status=response.status_code)
+
+            if response.is_streamed:
+                response.call_on_close(finish)
+            else:
+                finish()
+            response.headers["Server-Timing"] = timer.server_timing()
+            response.headers["X-Run-Id"] = timer.id
+            # Readable by the frontend, served from another origin
+            response.headers["Access-Control-Expose-Headers"] = "Server-Timing, X-Run-Id"
+            return response
+        return run
+    return decorate
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from werkzeug.utils import secure_filename
+
+from frame_cache import remember_digest
+from logs import event, logger
+
+UPLOAD_STORE_FOLDER = os.path.join('uploads', 'store')
+UPLOAD_CHUNK_SIZE = 2**20
+# Uploads are kept in memory up to this size while they are hashed, so a
+# duplicate below it never touches the disk. In "memory" mode, larger
+# uploads are stored on disk and parsed from there, as in "disk" mode.
+UPLOAD_SPOOL_MAX_BYTES = 16 * 2**20
+
+# "memory": uploads are parsed from memory and, if UPLOAD_ARCHIVE, written
+# to the store in the background after the response; "disk": uploads are
+# written to the store first and parsed from there.
+UPLOAD_MODE = os.environ.get("SHEETSYNC_UPLOAD_MODE", "memory")
+UPLOAD_ARCHIVE = os.environ.get("SHEETSYNC_UPLOAD_ARCHIVE", "1") != "0"
+
+log = logger("uploads")
+
+
+def stored_name(filename):
+    """secure_filename with a lower-case extension."""
+    base, ext = os.path.splitext(secure_filename(filename))
+    return base + ext.lower()
+
+
+class UploadedFile:
+    """An upload held in memory; ingest reads it like a path (see
+    ingest.open_source), through a fresh buffer each time."""
+
+    def __init__(self, filename, data, digest):
+        self.filename = filename
+        self.name = stored_name(filename)
+        self.data = data
+        self.digest = digest
+
+    def open(self):
+        return BytesIO(self.data)
+
+
+def receive(file, max_bytes=UPLOAD_SPOOL_MAX_BYTES):
+    """Read and hash a werkzeug FileStorage into an UploadedFile, or return
+    None, the stream rewound, if it is larger than `max_bytes`.
+
+    werkzeug has already spooled the request body (in memory, or in a
+    temporary file for large ones), so nothing is written to uploads/.
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+        size += len(chunk)
+        if size > max_bytes:
+            file.stream.seek(0)
+            return None
+        digest.update(chunk)
+        chunks.append(chunk)
+    return UploadedFile(file.filename, b''.join(chunks), digest.hexdigest())
+
+
+class UploadStore:
+    """Content-addressed store for uploaded files.
+
+    Each distinct content is written once, as `<sha256><ext>` in `folder`;
+    uploading the same bytes again, under any name, reuses that file. Every
+    upload is appended to `index.jsonl` (one JSON object per line: sha256,
+    original name, company, month, upload time, size, duplicate flag).
+
+    Files are written under a unique temporary name and moved into place
+    with os.replace, and index lines are appended in a single write, so
+    concurrent requests, including from the other services sharing the
+    folder, never see partial files or overwrite each other.
+    """
+
+    def __init__(self, folder=UPLOAD_STORE_FOLDER):
+        self.folder = folder
+        self.index_path = os.path.join(folder, 'index.jsonl')
+        self._lock = threading.Lock()
+        self._archiver = None
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.folder, f"{digest}{ext}")
+
+    def save(self, file, company, month=None):
+        """Store a werkzeug FileStorage and return the path of its content.
+
+        The upload is hashed while it is read; if the content is already in
+        the store the bytes are dropped without being written.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        ext = os.path.splitext(stored_name(file.filename))[1]
+
+        digest = hashlib.sha256()
+        size = 0
+        buffer = BytesIO()
+        tmp_path = None
+        out = buffer
+        try:
+            for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+                if tmp_path is None and size > UPLOAD_SPOOL_MAX_BYTES:
+                    tmp_path = os.path.join(self.folder, f".{uuid.uuid4().hex}.tmp")
+                    out = open(tmp_path, 'wb')
+                    out.write(buffer.getvalue())
+                    buffer = None
+            digest = digest.hexdigest()
+            path = self.path_for(digest, ext)
+
+            duplicate = os.path.exists(path)
+            if not duplicate:
+                if tmp_path is None:
+                    tmp_path = os.path.join(self.folder, f".{uuid.uuid4().hex}.tmp")
+                    with open(tmp_path, 'wb') as f:
+                        f.write(buffer.getvalue())
+                else:
+                    out.close()
+                os.replace(tmp_path, path)
+                tmp_path = None
+        finally:
+            if out is not buffer:
+                out.close()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        remember_digest(path, digest)
+        self._record(path, digest, file.filename, company, month, size, duplicate)
+        return path
+
+    def store(self, uploaded, company, month=None):
+        """Write an UploadedFile to the store unless its content is there."""
+        os.makedirs(self.folder, exist_ok=True)
+        path = self.path_for(uploaded.digest, os.path.splitext(uploaded.name)[1])
+        duplicate = os.path.exists(path)
+        if not duplicate:
+            tmp_path = os.path.join(self.folder, f".{uuid.uuid4().hex}.tmp")
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(uploaded.data)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        remember_digest(path, uploaded.digest)
+        self._record(path, uploaded.digest, uploaded.filename, company, month, len(uploaded.data), duplicate)
+        return path
+
+    def archive(self, uploaded, company, month=None):
+        """store() in a background thread; returns the Future."""
+        with self._lock:
+            if self._archiver is None:
+                self._archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-archive")
+        future = self._archiver.submit(self.store, uploaded, company, month)
+        future.add_done_callback(report_archive_error)
+        return future
+
+    def accept(self, file, company, month=None):
+        """Take an upload as UPLOAD_MODE says: the stored path ("disk"), or an
+        UploadedFile ("memory"), archived in the background if UPLOAD_ARCHIVE.
+        Uploads over UPLOAD_SPOOL_MAX_BYTES are stored in either mode, so
+        none is held in memory whole."""
+        if UPLOAD_MODE == "disk":
+            return self.save(file, company, month)
+        uploaded = receive(file)
+        if uploaded is None:
+            return self.save(file, company, month)
+        if UPLOAD_ARCHIVE:
+            self.archive(uploaded, company, month)
+        return uploaded
+
+    def _record(self, path, digest, filename, company, month, size, duplicate):
+        uploaded_at = datetime.now()
+        self._append({
+            "sha256": digest,
+            "name": filename,
+            "company": company,
+            "month": month or uploaded_at.strftime('%Y-%m'),
+            "uploadedAt": uploaded_at.isoformat(timespec='seconds'),
+            "size": size,
+            "duplicate": duplicate,
+        })
+        event(log, "upload", logging.DEBUG, name=filename, stored=os.path.basename(path), duplicate=duplicate)
+
+    def _append(self, entry):
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode('utf-8')
+        with self._lock:
+            fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+    def entries(self, digest=None):
+        """Index entries, oldest first, optionally only those of one content."""
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if digest is None or entry["sha256"] == digest:
+                entries.append(entry)
+        return entries
+
+
+def report_archive_error(future):
+    if future.exception() is not None:
+        event(log, "archive_failed", logging.WARNING, error=str(future.exception()))
+
+
+uploads = UploadStore()
@@ -113,7 +113,7 @@ const casaEaro = () => {
     setLoading(true);
     
     try {
-      const response = await fetch('http://localhost:8003/upload', {
+      const response = await fetch('http://localhost:8080/casaEaro/upload', {
         method: 'POST',
         body: createFormData(),
       });
@@ -97,7 +97,7 @@ const Novometal = () => {
     formData.append('payroll', files.payroll);
 
     try {
-      const response = await axios.post('http://localhost:8000/api/compare', formData, {
+      const response = await axios.post('http://localhost:8080/novometal/api/compare', formData, {
         headers: { 'Content-Type': 'multipart/form-data' },
       });
 
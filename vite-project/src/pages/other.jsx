@@ -134,7 +134,7 @@ const Other = () => {
     setLoading(true);
     
     try {
-      const response = await fetch('http://localhost:8005/upload', {
+      const response = await fetch('http://localhost:8080/other/upload', {
         method: 'POST',
         body: createFormData(),
       });
@@ -99,7 +99,7 @@ const Sbbc = () => {
     formData.append('payroll', files.payroll);
 
     try {
-      const response = await axios.post('http://localhost:8004/api/compare', formData, {
+      const response = await axios.post('http://localhost:8080/sbbc/api/compare', formData, {
         headers: { 'Content-Type': 'multipart/form-data' },
       });
 
@@ -140,7 +140,7 @@ const Scif = () => {
     formData.append('paie', paieFile);
     
     try {
-      const response = await fetch('http://localhost:8001/upload', {
+      const response = await fetch('http://localhost:8080/scif/upload', {
         method: 'POST',
         body: formData,
       });
@@ -128,7 +128,7 @@ const TempT = () => {
     setLoading(true);
     
     try {
-      const response = await fetch('http://localhost:8007/upload', {
+      const response = await fetch('http://localhost:8080/tempT/upload', {
         method: 'POST',
         body: createFormData(),
       });
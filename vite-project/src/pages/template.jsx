@@ -139,7 +139,7 @@ if (incoherenceTypeFilter !== 'all' && statusFilter !== 'Correct') {
     setLoading(true);
     
     try {
-      const response = await fetch('http://localhost:8006/upload', {
+      const response = await fetch('http://localhost:8080/temp/upload', {
         method: 'POST',
         body: createFormData(),
       });